@@ -0,0 +1,194 @@
+"""On-disk cache of decompressed and validated datasets, so that decompression
+and line validation only happen once per corpus instead of once per epoch. And
+of shuffled epochs, so a restarted trainer does not have to shuffle again.
+"""
+import glob
+import hashlib
+import json
+import os
+
+from array import array
+from tempfile import gettempdir, mkstemp
+from typing import Any, BinaryIO, Callable, List, Optional, Tuple
+
+from opustrainer.shuffle import BUFSIZE, Reader, LineIndex, split_carriage_returns
+
+
+def fingerprint(files:List[str], *settings:Any) -> str:
+    """Hash of the path, size and modification time of each of the files,
+    together with any (json serializable) settings."""
+    identity = list(settings)
+    for file in files:
+        stat = os.stat(file)
+        identity.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+
+class CorpusCache:
+    """Decompressed, validated copy of a dataset's files with a line index next
+    to it. The cache is keyed by the path, size and modification time of each
+    of the files, and by the `num_fields` setting, so it is reused by every
+    epoch and every restart until one of the files changes.
+    """
+    files: List[str]
+    path: str
+    index_path: str
+
+    # Bump this when the format of the cache files changes
+    VERSION = 2
+
+    def __init__(self, files:List[str], *, tmpdir:Optional[str]=None, num_fields:Optional[int]=None):
+        self.files = files
+        self.tmpdir = tmpdir or gettempdir()
+
+        key = fingerprint(files, self.VERSION, num_fields)
+
+        self.path = os.path.join(self.tmpdir, f'opustrainer-cache-{key}.tsv')
+        self.index_path = f'{self.path}.idx'
+
+    def exists(self) -> bool:
+        # The index is written last, so it doubles as the completion marker.
+        return os.path.exists(self.path) and os.path.exists(self.index_path)
+
+    def build(self, validate:Callable[[str], Optional[str]]) -> None:
+        """Write the decompressed lines of `files` that pass `validate` to the
+        cache, split at carriage returns like DatasetReader does. `validate`
+        returns the line, possibly altered, or `None` if it should be skipped."""
+        offsets = array('Q', [0])
+
+        fd, tmp_path = mkstemp(dir=self.tmpdir, prefix='opustrainer-cache-')
+        try:
+            with open(fd, 'wb', buffering=BUFSIZE) as fh:
+                for file in self.files:
+                    for raw in Reader(file):
+                        for part in split_carriage_returns(raw) if b'\r' in raw else [raw]:
+                            line = validate(part.decode('utf-8'))
+                            if line is None:
+                                continue
+                            data = line.encode('utf-8')
+                            if not data.endswith(b'\n'):
+                                data += b'\n'
+                            fh.write(data)
+                            offsets.append(offsets[-1] + len(data))
+            os.replace(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        fd, tmp_path = mkstemp(dir=self.tmpdir, prefix='opustrainer-cache-')
+        os.close(fd)
+        try:
+            LineIndex(offsets).dump(tmp_path)
+            os.replace(tmp_path, self.index_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def index(self) -> LineIndex:
+        return LineIndex.load(self.index_path)
+
+
+class LineCount:
+    """Number of lines in a dataset's files, remembered in `tmpdir` so they
+    only have to be counted once, e.g. to sample a number of lines from them
+    every epoch. Keyed by the path, size and modification time of each of
+    the files, like CorpusCache.
+    """
+    path: str
+
+    def __init__(self, files:List[str], *, tmpdir:Optional[str]=None):
+        self.tmpdir = tmpdir or gettempdir()
+        self.path = os.path.join(self.tmpdir, f'opustrainer-lines-{fingerprint(files)}')
+
+    def get(self, count:Callable[[], int]) -> int:
+        """The remembered number of lines, or else the result of `count()`,
+        which is remembered for next time."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                return int(fh.read())
+        except (OSError, ValueError):
+            pass
+
+        lines = count()
+
+        fd, tmp_path = mkstemp(dir=self.tmpdir, prefix='opustrainer-lines-')
+        try:
+            with open(fd, 'w', encoding='utf-8') as fh:
+                fh.write(str(lines))
+            os.replace(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return lines
+
+
+class EpochFile:
+    """Shuffled copy of a dataset for a single epoch, with the line offsets
+    written by the shuffler next to it. It is named after the dataset files and
+    the seed and settings of the shuffle, so a restarted trainer only reuses it
+    if shuffling again would produce the same file.
+    """
+    seed: int
+    path: str
+    offsets_path: str
+
+    _tmp_paths: Optional[Tuple[str, str]] = None
+
+    def __init__(self, files:List[str], seed:int, *, tmpdir:Optional[str]=None, settings:Tuple[Any, ...]=()):
+        self.tmpdir = tmpdir or gettempdir()
+        self.seed = seed
+        # Epochs of the same files and settings only differ in their seed
+        self._prefix = os.path.join(self.tmpdir, f'opustrainer-epoch-{fingerprint(files, *settings)}-')
+        self.path = f'{self._prefix}{seed}.tsv'
+        self.offsets_path = f'{self.path}.offsets'
+
+    def exists(self) -> bool:
+        # The offsets are moved into place last, so they double as the completion marker.
+        return os.path.exists(self.path) and os.path.exists(self.offsets_path)
+
+    def open(self) -> Tuple[BinaryIO, BinaryIO]:
+        """Open a previously written epoch for reading."""
+        return open(self.path, 'rb'), open(self.offsets_path, 'rb')
+
+    def create(self) -> Tuple[BinaryIO, BinaryIO]:
+        """Temporary files to write the epoch and its offsets to. They are moved
+        into place by `commit()`, or removed again by `discard()`."""
+        fd, tmp_path = mkstemp(dir=self.tmpdir, prefix='opustrainer-epoch-')
+        fh = open(fd, 'w+b')
+        fd, tmp_offsets_path = mkstemp(dir=self.tmpdir, prefix='opustrainer-epoch-')
+        offsets = open(fd, 'w+b')
+        self._tmp_paths = (tmp_path, tmp_offsets_path)
+        return fh, offsets
+
+    def commit(self) -> None:
+        assert self._tmp_paths is not None
+        tmp_path, tmp_offsets_path = self._tmp_paths
+        os.replace(tmp_path, self.path)
+        os.replace(tmp_offsets_path, self.offsets_path)
+        self._tmp_paths = None
+
+    def discard(self) -> None:
+        if self._tmp_paths is not None:
+            for path in self._tmp_paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+            self._tmp_paths = None
+
+    def remove(self) -> None:
+        """Delete the epoch, e.g. once it has been read completely."""
+        for path in [self.offsets_path, self.path]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def remove_earlier(self) -> None:
+        """Delete the epochs of the same files and settings with a lower seed,
+        e.g. the ones an earlier run left behind that have been read since."""
+        for path in glob.glob(f'{glob.escape(self._prefix)}*.tsv'):
+            try:
+                seed = int(path[len(self._prefix):-len('.tsv')])
+            except ValueError:
+                continue
+            if seed < self.seed:
+                for stale in [f'{path}.offsets', path]:
+                    if os.path.exists(stale):
+                        os.unlink(stale)
@@ -2,14 +2,35 @@ import logging
 import os
 import random
 
+from collections import deque
+from dataclasses import dataclass, field
 from multiprocessing import Queue, Process
 from logging.handlers import QueueHandler, QueueListener
-from typing import List, Union
-from itertools import chain
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Union
+from itertools import chain, count
 
 from opustrainer.modifiers import Modifier
 
 
+def apply_modifiers(modifiers:List[Modifier], batch:List[Any]) -> List[Any]:
+    """Runs a chunk of lines through `modifiers`. The lines can also be UTF-8
+    encoded bytes. The modifiers then get them decoded, and only the lines they
+    changed are encoded again; the ones they passed on as is come back as the
+    original bytes."""
+    if not batch or not isinstance(batch[0], bytes):
+        for modifier in modifiers:
+            batch = list(modifier(batch))
+        return batch
+
+    # Keeping `decoded` alive means no other line can end up with the same id
+    decoded = [line.decode('utf-8') for line in batch]
+    originals = {id(text): line for text, line in zip(decoded, batch)}
+    lines = decoded
+    for modifier in modifiers:
+        lines = list(modifier(lines))
+    return [originals[id(line)] if id(line) in originals else line.encode('utf-8') for line in lines]
+
+
 class ModifierWorker(Process):
     """Process that runs batches of sentences through a list of modifiers"""
     tasks: Queue
@@ -35,27 +56,64 @@ class ModifierWorker(Process):
             if task is None:
                 break
 
-            # A task consists of a chunk id, batch seed, and lines
-            chunk, seed, batch = task
+            # A task consists of a batch id, chunk id, chunk seed, and lines
+            ticket, chunk, seed, batch = task
 
             try:
                 # Set random seed for this batch, so the worker and the order
                 # in which batches are processed are no longer relevant
                 random.seed(seed)
 
-                for modifier in self.modifiers:
-                    batch = list(modifier(batch))
-
-                self.results.put((chunk, batch, None))
+                self.results.put((ticket, chunk, apply_modifiers(self.modifiers, batch), None))
             except Exception as exc:
-                self.results.put((chunk, None, exc))
+                self.results.put((ticket, chunk, None, exc))
         self.results.close()
 
 
+def chunk_slices(size:int, chunksize:int, chunks:int) -> List[slice]:
+    """Slices that split a batch of `size` lines into chunks of `chunksize`
+    lines, or into `chunks` chunks if `chunksize` is 0. Leftover lines go into
+    an extra chunk. The number of chunks determines the number of seeds drawn
+    for a batch, so this has to stay the same for the same batches to come
+    out."""
+    if chunksize > 0:
+        chunks, remainder = divmod(size, chunksize)
+    else:
+        chunksize, remainder = divmod(size, chunks)
+
+    return [
+        slice(chunk * chunksize, chunk * chunksize + (chunksize if chunk < chunks else remainder))
+        for chunk in range(chunks + (1 if remainder > 0 else 0))
+    ]
+
+
+@dataclass
+class PendingBatch:
+    """Batch of which ModifierPool.imap() has submitted chunks to the workers"""
+    ticket: int
+    lines: List[str]
+    chunks: List[List[str]]
+    seeds: List[float]
+    random_state: Any # Random state after drawing the seeds
+    results: List[Optional[List[str]]]
+    order: Optional[List[int]] = None # Order shuffling `lines` would put them in
+    shuffled_state: Any = None # Random state after that
+    submitted: int = 0
+    remaining: int = field(init=False)
+    exception: Optional[Exception] = None
+
+    def __post_init__(self):
+        self.remaining = len(self.chunks)
+
+
 class ModifierPool:
     """Pool of ModifierWorker that exposes `map()` to run a batch of sentences
     through a predefined list of modifiers. Similar to multiprocessing.Pool
     except that the `func` argument doesn't need to be passed for each call.
+    `imap()` runs multiple batches through them, submitting the chunks of the
+    next batches while the workers are still busy with the current one.
+    Batches can be lines of text or of UTF-8 encoded bytes, see
+    `apply_modifiers()`.
     """
 
     """Number of worker processes in the pool"""
@@ -64,6 +122,9 @@ class ModifierPool:
     """Modifier list each worker applies to the batches"""
     modifiers: List[Modifier]
 
+    """Maximum number of chunks submitted to the workers but not yet collected"""
+    max_pending: int
+
     """Queue for submitting chunks of work to the workers"""
     tasks: Queue
 
@@ -74,13 +135,18 @@ class ModifierPool:
 
     log_worker: QueueListener
 
-    def __init__(self, modifiers:List[Modifier], processes:int=0):
+    def __init__(self, modifiers:List[Modifier], processes:int=0, *, max_pending:Optional[int]=None):
         self.modifiers = modifiers
         self.workers = processes if processes > 0 else min(os.cpu_count() or 1, 8)
+        self.max_pending = max_pending or 4 * self.workers
+        self._tickets = count()
 
     def __enter__(self) -> 'ModifierPool':
-        self.tasks = Queue()
-        self.results = Queue()
+        # Never more chunks in flight than max_pending, so the queues can be
+        # bounded without putting to them ever blocking. (Plus room for the
+        # stop signal for each worker.)
+        self.tasks = Queue(self.max_pending + self.workers)
+        self.results = Queue(self.max_pending)
         
         self.messages = Queue()
         self.log_worker = QueueListener(self.messages, *logging.getLogger().handlers, respect_handler_level=True)
@@ -110,34 +176,131 @@ class ModifierPool:
         self.messages.close()
 
     def map(self, batch:List[str], chunksize:int=0) -> List[str]:
-        if chunksize > 0:
-            chunks, remainder = divmod(len(batch), chunksize)
-        else:
-            chunks = len(self.processes)
-            chunksize, remainder = divmod(len(batch), chunks)
-
-        # Shortcut for getting the slice of batch for each chunk
-        chunk_slice = lambda chunk: slice(
-            chunk * chunksize,
-            chunk * chunksize + (chunksize if chunk < chunks else remainder)
-        )
-
-        # Submit tasks to workers
-        for chunk in range(chunks + (1 if remainder > 0 else 0)):
-            self.tasks.put((chunk, random.random(), batch[chunk_slice(chunk)]))
-
-        # Placeholder for the returned chunks, in order
-        chunk_results = [[]] * (chunks + (1 if remainder > 0 else 0))
-
-        # Retrieve results from workers
-        for _ in range(chunks + (1 if remainder > 0 else 0)):
-            chunk, result, exc = self.results.get()
-            if exc is not None:
-                raise exc
-            chunk_results[chunk] = result
-
-        # Stitch the ordered result chunks back together into a single batch
-        return list(chain(*chunk_results))
+        # Nothing to modify, but still draw a seed for each chunk so the random
+        # state ends up the same as when the chunks are processed.
+        if not self.modifiers:
+            for _ in chunk_slices(len(batch), chunksize, len(self.processes)):
+                random.random()
+            return list(batch)
+
+        return next(self.imap([batch], chunksize))
+
+    def imap(self, batches:Iterable[List[str]], chunksize:int=0, *, shuffle:bool=False) -> Iterator[List[str]]:
+        """Yields the same batches, and leaves the same random state behind, as
+        calling `map()` for each of `batches` would, followed by
+        `random.shuffle()` if `shuffle` is set. But the chunks of the next
+        batches are already submitted while those of the earlier ones are
+        being processed, so the workers don't wait for each other or for the
+        next batch. At most `max_pending` chunks are in flight.
+
+        The seeds of the next batch depend on how many lines the previous
+        batch had to shuffle. Batches are submitted assuming the modifiers
+        don't change that number. If they do after all, e.g. Merge, the next
+        batches are submitted again with the right seeds, and from then on
+        each batch is only submitted once the previous one is done.
+        """
+        if not self.modifiers:
+            for batch in batches:
+                batch = self.map(batch, chunksize)
+                if shuffle:
+                    random.shuffle(batch)
+                yield batch
+            return
+
+        # Draw seeds ahead from a copy of the random state
+        rng = random.Random()
+        rng.setstate(random.getstate())
+
+        inputs = iter(batches)
+        backlog: Deque[List[str]] = deque() # Batches to submit before taking new ones from `inputs`
+        pending: Deque[PendingBatch] = deque()
+        by_ticket: Dict[int, PendingBatch] = {}
+        in_flight = 0 # Chunks submitted, including ones of abandoned batches
+        ahead = True # Whether to submit batches before the previous one is done
+
+        def start(lines:List[str]) -> None:
+            chunks = [lines[s] for s in chunk_slices(len(lines), chunksize, len(self.processes))]
+            seeds = [rng.random() for _ in chunks]
+            batch = PendingBatch(next(self._tickets), lines, chunks, seeds, rng.getstate(), [None] * len(chunks))
+            pending.append(batch)
+            by_ticket[batch.ticket] = batch
+            # Move the random state along as shuffling the batch would, if the
+            # modifiers leave the number of lines unchanged. Shuffling only
+            # depends on the number of lines, so the order can be reused.
+            if shuffle:
+                batch.order = list(range(len(lines)))
+                rng.shuffle(batch.order)
+                batch.shuffled_state = rng.getstate()
+
+        try:
+            while True:
+                # Keep the workers busy
+                while in_flight < self.max_pending:
+                    if pending and pending[-1].submitted < len(pending[-1].chunks):
+                        batch = pending[-1]
+                        n = batch.submitted
+                        self.tasks.put((batch.ticket, n, batch.seeds[n], batch.chunks[n]))
+                        batch.submitted += 1
+                        in_flight += 1
+                    elif backlog and (ahead or not pending):
+                        start(backlog.popleft())
+                    elif inputs is not None and (ahead or not pending):
+                        lines = next(inputs, None)
+                        if lines is None:
+                            inputs = None
+                        else:
+                            start(lines)
+                    else:
+                        break
+
+                # Nothing left to submit or to wait for
+                if not pending and in_flight == 0:
+                    break
+
+                # Collect chunks until the first batch is done
+                if not pending or pending[0].remaining > 0:
+                    ticket, chunk, result, exc = self.results.get()
+                    in_flight -= 1
+                    if ticket in by_ticket: # else it was abandoned
+                        by_ticket[ticket].results[chunk] = result
+                        by_ticket[ticket].remaining -= 1
+                        by_ticket[ticket].exception = by_ticket[ticket].exception or exc
+                    continue
+
+                done = pending.popleft()
+                del by_ticket[done.ticket]
+                if done.exception is not None:
+                    raise done.exception
+
+                # Stitch the ordered result chunks back together into a single batch
+                batch = list(chain(*done.results))
+
+                if not shuffle:
+                    random.setstate(done.random_state)
+                elif done.order is not None and len(batch) == len(done.order):
+                    # Same as random.shuffle(batch) from done.random_state
+                    batch = [batch[i] for i in done.order]
+                    random.setstate(done.shuffled_state)
+                else:
+                    random.setstate(done.random_state)
+                    random.shuffle(batch)
+
+                    # The next batches were submitted with the wrong seeds
+                    if pending:
+                        backlog.extendleft(reversed([abandoned.lines for abandoned in pending]))
+                        pending.clear()
+                        by_ticket.clear()
+                        ahead = False
+
+                if shuffle and not ahead:
+                    rng.setstate(random.getstate())
+
+                yield batch
+        finally:
+            # Collect what is still being worked on, so the workers can stop
+            while in_flight > 0:
+                self.results.get()
+                in_flight -= 1
 
 
 class ErzatsModifierPool:
@@ -152,25 +315,26 @@ class ErzatsModifierPool:
         pass
 
     def map(self, batch:List[str], chunksize:int=0) -> List[str]:
-        if chunksize > 0:
-            chunks, remainder = divmod(len(batch), chunksize)
-        else:
+        if chunksize <= 0:
             raise ValueError("Need a chunksize > 0")
 
-        # Shortcut for getting the slice of batch for each chunk
-        chunk_slice = lambda chunk: slice(
-            chunk * chunksize,
-            chunk * chunksize + (chunksize if chunk < chunks else remainder)
-        )
+        slices = chunk_slices(len(batch), chunksize, 0)
+
+        # Nothing to modify, but still draw a seed for each chunk so the random
+        # state ends up the same as when the chunks are processed.
+        if not self.modifiers:
+            for _ in slices:
+                random.random()
+            return list(batch)
 
         tasks = []
 
         # Submit tasks to workers
-        for chunk in range(chunks + (1 if remainder > 0 else 0)):
-            tasks.append((chunk, random.random(), batch[chunk_slice(chunk)]))
+        for chunk, chunk_slice in enumerate(slices):
+            tasks.append((chunk, random.random(), batch[chunk_slice]))
 
         # Placeholder for the returned chunks, in order
-        chunk_results = [[]] * (chunks + (1 if remainder > 0 else 0))
+        chunk_results = [[]] * len(slices)
 
         random_state = random.getstate()
 
@@ -179,16 +343,21 @@ class ErzatsModifierPool:
             # in which batches are processed are no longer relevant
             random.seed(seed)
 
-            for modifier in self.modifiers:
-                batch = list(modifier(batch))
-
-            chunk_results[chunk] = batch
+            chunk_results[chunk] = apply_modifiers(self.modifiers, batch)
 
         random.setstate(random_state)
         
         # Stitch the ordered result chunks back together into a single batch
         return list(chain(*chunk_results))
 
+    def imap(self, batches:Iterable[List[str]], chunksize:int=0, *, shuffle:bool=False) -> Iterator[List[str]]:
+        """Same as `ModifierPool.imap()`, one batch after the other."""
+        for batch in batches:
+            batch = self.map(batch, chunksize)
+            if shuffle:
+                random.shuffle(batch)
+            yield batch
+
 
 def make_modifier_pool(modifiers:List[Modifier], processes:int) -> Union[ModifierPool, ErzatsModifierPool]:
     if processes == 0:
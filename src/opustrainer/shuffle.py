@@ -1,27 +1,287 @@
 #!/usr/bin/env python3
+import bz2
+import gzip
 import heapq
+import io
+import lzma
+import mmap
 import os
+import resource
 import subprocess
+import sys
+import zlib
 from argparse import ArgumentParser, FileType
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import islice, chain
+from functools import partial
+from itertools import accumulate, islice, chain, repeat
+from multiprocessing.shared_memory import SharedMemory
 from operator import itemgetter
 from queue import Queue
 from random import Random
 from shutil import which
 from struct import Struct
 from tempfile import mkstemp
-from threading import Thread
-from typing import TypeVar, Iterator, Iterable, List, Optional, Tuple, Callable
+from threading import Condition, Event, Thread
+from typing import TypeVar, Iterator, Iterable, List, Optional, Tuple, Callable, Sequence, Deque, Dict, BinaryIO, Union
 
 
 # Buffer size for reading files. Bufsize that Python assigns is generally too small?
 BUFSIZE=2**16
 
-# Prefer pigz if available, but fall back to calling gzip
-PATH_TO_GZIP = which("pigz") or which("gzip")
+# Decompression commands per file extension, in order of preference. Reader
+# uses the first one that is installed, and falls back to Python's own module
+# for the format (see PY_DECOMPRESSORS) if none are.
+DECOMPRESSORS: Dict[str, List[List[str]]] = {
+	'.gz': [['pigz', '-cd'], ['gzip', '-cd']],
+	'.zst': [['zstd', '-cdq']],
+	'.xz': [['xz', '-cd', '-T0']], # -T0 decompresses multi-block files on all cores
+	'.bz2': [['lbzip2', '-cd'], ['pbzip2', '-cd'], ['bzip2', '-cd']],
+}
 
-HEADER = Struct('@fI') # f for random float, I for line length
+PY_DECOMPRESSORS: Dict[str, Callable[[str], BinaryIO]] = {
+	'.gz': gzip.open,
+	'.xz': lzma.open,
+	'.bz2': bz2.open,
+}
+
+# Gzip member header up to and including XLEN: magic, CM and FLG, then MTIME,
+# XFL and OS, then the length of the extra field. In BGZF files each member
+# has a BC subfield in that extra field with the size of the member, so they
+# can be split up without decompressing them first.
+GZIP_HEADER = Struct('<4s6xH')
+
+# Gzip member trailer: CRC32 and size of the uncompressed data
+GZIP_TRAILER = Struct('<II')
+
+# Magic, CM (deflate) and FLG (FEXTRA) of a BGZF member
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+# Number of BGZF members decompressed together by a single thread. Members
+# are at most 64K each.
+BGZF_MEMBERS_PER_TASK = 16
+
+# Default number of lines between the offsets recorded by --offsets
+OFFSETS_INTERVAL = 1024
+
+# Number of lines per batch, and number of batches per file, that read_files()
+# reads ahead in the background.
+READAHEAD_LINES = 4096
+READAHEAD_BATCHES = 8
+
+# Chunk files are a sequence of blocks, each a header followed by a payload
+# of (possibly compressed) keys as float32, line lengths as uint32, and lines.
+BLOCK_HEADER = Struct('@II') # I for number of lines, I for payload size
+
+# Approximate number of bytes of lines per block in a chunk file
+BLOCKSIZE=2**18
+
+# Maximum number of lines per block. Joining them into a payload takes about
+# 80 bytes per line on top of the lines themselves, which for short lines is
+# more than the lines.
+BLOCK_LINES = 2**11
+
+# Estimate of the memory merging takes per chunk file: its current block, the
+# compressed payload it was read from, and the keys, lengths and offsets of
+# its lines.
+BLOCK_MEMORY = 2 * BLOCKSIZE
+
+
+@dataclass(frozen=True)
+class Codec:
+	"""Compression for the blocks of the temporary chunk files"""
+	name: str
+	compress: Callable[[bytes], bytes]
+	decompress: Callable[[bytes], bytes]
+
+
+CODECS: Dict[str, Codec] = {
+	'none': Codec('none', bytes, bytes),
+	'zlib': Codec('zlib', partial(zlib.compress, level=1), zlib.decompress),
+}
+
+try:
+	import zstandard
+	CODECS['zstd'] = Codec('zstd',
+		lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+		lambda data: zstandard.ZstdDecompressor().decompress(data))
+	PY_DECOMPRESSORS['.zst'] = partial(zstandard.open, mode='rb')
+except ImportError:
+	pass
+
+try:
+	import lz4.frame
+	CODECS['lz4'] = Codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+	pass
+
+# Optional, for --numpy
+try:
+	import numpy
+except ImportError:
+	numpy = None # type: ignore
+
+
+def get_codec(name:str) -> Codec:
+	"""Looks up a codec by name. `auto` picks the fastest one available."""
+	if name == 'auto':
+		name = next(codec for codec in ['zstd', 'lz4', 'zlib'] if codec in CODECS)
+	try:
+		return CODECS[name]
+	except KeyError:
+		raise ValueError(f'Compression {name} is not available. Available are: {", ".join(CODECS)}')
+
+
+class ShuffleStopped(Exception):
+	"""Raised inside a shuffle once its `stop` event is set."""
+
+
+def check_stopped(stop:Optional[Event]) -> None:
+	if stop is not None and stop.is_set():
+		raise ShuffleStopped()
+
+
+def stoppable(lines:Iterable[bytes], stop:Optional[Event]) -> Iterator[bytes]:
+	"""Passes on `lines`, but raises ShuffleStopped once `stop` is set. It is
+	checked every READAHEAD_LINES lines, not for every line."""
+	it = iter(lines)
+	try:
+		while True:
+			check_stopped(stop)
+			batch = list(islice(it, READAHEAD_LINES))
+			if not batch:
+				break
+			yield from batch
+	finally:
+		if hasattr(it, 'close'):
+			it.close() # type: ignore
+
+
+def write_chunk_file(fh:BinaryIO, keys:Sequence[float], lines:Sequence[bytes], order:Sequence[int], codec:Codec, stop:Optional[Event]=None) -> None:
+	"""Writes the lines and their keys in the given order as blocks of about
+	BLOCKSIZE bytes (or BLOCK_LINES lines), so that reading them back takes one
+	read per block instead of two per line. Everything per line is done with
+	map() and friends instead of Python loops, otherwise this is slower than
+	writing a record per line. Once `stop` is set it stops, leaving the file
+	incomplete."""
+	sorted_keys: Sequence[float]
+	if numpy is not None and isinstance(keys, numpy.ndarray):
+		indices = numpy.asarray(order)
+		sorted_keys = keys[indices].astype(numpy.float32)
+		order = indices.tolist()
+	else:
+		sorted_keys = array('f', map(keys.__getitem__, order))
+	lines = list(map(lines.__getitem__, order))
+	lengths = array('I', map(len, lines))
+	ends = array('Q', accumulate(lengths))
+	start = 0
+	while start < len(lines) and not (stop is not None and stop.is_set()):
+		# Block ends with the first line that makes it at least BLOCKSIZE bytes
+		end = min(bisect_left(ends, (ends[start - 1] if start else 0) + BLOCKSIZE, start) + 1, start + BLOCK_LINES, len(lines))
+		write_block(fh, sorted_keys[start:end], lengths[start:end], lines[start:end], codec)
+		start = end
+
+
+def write_block(fh:BinaryIO, keys:Sequence[float], lengths:array, lines:Sequence[bytes], codec:Codec) -> None:
+	"""Writes a single block of a chunk file. `keys` is a float32 array with a
+	key for each of the `lengths`. `lines` may also be all lines joined."""
+	payload = codec.compress(b''.join([keys.tobytes(), lengths.tobytes(), *lines])) # type: ignore # keys is an array
+	fh.write(BLOCK_HEADER.pack(len(lengths), len(payload)))
+	fh.write(payload)
+
+
+def write_merged_chunk_file(fh:BinaryIO, pairs:Iterable[Tuple[float,bytes]], codec:Codec) -> None:
+	"""Writes (key, line) pairs that are already in order, e.g. those of
+	`merge_chunk_files()`, as a chunk file. Only holds on to one block at a
+	time, and its lines as one bytearray instead of a bytes object each."""
+	keys, lengths, body = array('f'), array('I'), bytearray()
+	for key, line in pairs:
+		keys.append(key)
+		lengths.append(len(line))
+		body += line
+		if len(body) >= BLOCKSIZE or len(lengths) >= BLOCK_LINES:
+			write_block(fh, keys, lengths, [body], codec)
+			keys, lengths, body = array('f'), array('I'), bytearray()
+	if body:
+		write_block(fh, keys, lengths, [body], codec)
+
+
+def argsort(keys:Sequence[float]) -> Sequence[int]:
+	"""Stable sort of line numbers by key. Same order as sorting (key, line)
+	pairs by key. Keys drawn by NumPy are sorted by NumPy as well."""
+	if numpy is not None and isinstance(keys, numpy.ndarray):
+		return numpy.argsort(keys, kind='stable')
+	return sorted(range(len(keys)), key=keys.__getitem__)
+
+# Estimate of the memory a line in a chunk takes on top of its own length: the
+# bytes object, its random key, its entry in the sort order, and the list slots
+# pointing to each of them. Plus what sorting adds: the keys and temporary
+# space sorted() uses, or the sorted list of lines and the float32 key, uint32
+# length and uint64 end offset of each that write_chunk_file() makes.
+LINE_OVERHEAD = sys.getsizeof(b'') + sys.getsizeof(0.0) + sys.getsizeof(2**32) + 3 * 8 + 4 * 8
+
+
+class MemoryBudget:
+	"""Counting semaphore, but for bytes of memory. Used to bound the memory
+	taken up by chunks that are being read, waiting in a queue, or sorted."""
+	limit: int
+	used: int
+
+	def __init__(self, limit:int):
+		self.limit = limit
+		self.used = 0
+		self._cond = Condition()
+
+	def acquire(self, size:int) -> None:
+		"""Blocks until `size` bytes are available. If nothing is acquired at
+		all, `size` is always granted so a too small limit can't deadlock."""
+		with self._cond:
+			self._cond.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+			self.used += size
+
+	def release(self, size:int) -> None:
+		with self._cond:
+			self.used -= size
+			self._cond.notify_all()
+
+
+@dataclass(frozen=True)
+class Chunk:
+	"""Lines of a chunk and the random key for each of them, as two lists (or
+	a list and a NumPy array). The ingest thread only has to draw the keys.
+	Pairing them up and sorting is left to the thread that handles the
+	SortTask."""
+	keys: Sequence[float]
+	lines: List[bytes]
+
+	@classmethod
+	def read(cls, lines:Iterator[bytes], size:int, random:Random, *, max_bytes:Optional[int]=None, use_numpy:bool=False) -> 'Chunk':
+		"""Read up to `size` lines from `lines` and assign each a random key.
+		Keys are drawn in line order, one `random.random()` call per line, so
+		the result only depends on the seed of `random`. If `max_bytes` is given,
+		stop reading once the lines take up about that much memory instead.
+		With `use_numpy` the keys are drawn all at once by a NumPy generator
+		seeded from `random`, which is faster but gives different keys."""
+		if max_bytes is None:
+			chunk = list(islice(lines, size))
+		else:
+			chunk = []
+			total = 0
+			for line in lines:
+				chunk.append(line)
+				total += len(line) + LINE_OVERHEAD
+				if total >= max_bytes:
+					break
+		if use_numpy:
+			return cls(numpy.random.default_rng(random.getrandbits(64)).random(len(chunk)), chunk)
+		draw = random.random
+		return cls([draw() for _ in repeat(None, len(chunk))], chunk)
+
+	def __len__(self) -> int:
+		return len(self.lines)
 
 
 @dataclass(frozen=True)
@@ -31,14 +291,68 @@ class SortTask:
 	random.random() calls are predictable. The order in which Shuffling tasks
 	are picked up and finished may not be."""
 	fileno: int
-	chunk: List[Tuple[float,bytes]]
+	chunk: Chunk
+	codec: Codec = CODECS['none']
+	# Memory to give back once the chunk is written
+	budget: Optional[MemoryBudget] = None
+	size: int = 0
+	# Skip or abandon the chunk once this is set, the shuffle is stopping
+	stop: Optional[Event] = None
 
 	def __call__(self) -> None:
-		with os.fdopen(self.fileno, 'wb', buffering=BUFSIZE) as fh:
-			self.chunk.sort(key=itemgetter(0))
-			for rand, line in self.chunk:
-				fh.write(HEADER.pack(rand, len(line)))
-				fh.write(line)
+		try:
+			with os.fdopen(self.fileno, 'wb') as fh:
+				if self.stop is None or not self.stop.is_set():
+					keys, lines = self.chunk.keys, self.chunk.lines
+					order = argsort(keys)
+					write_chunk_file(fh, keys, lines, order, self.codec, self.stop)
+		finally:
+			if self.budget is not None:
+				self.budget.release(self.size)
+
+
+def sort_shared_chunk(filename:str, name:str, keys:Sequence[float], offsets:array, codec:str) -> None:
+	"""Same as SortTask, but runs in a worker process. The lines of the chunk
+	are read from the shared memory block `name`, at the given offsets, so they
+	don't have to be pickled to be sent to the worker."""
+	shm = SharedMemory(name)
+	try:
+		data = shm.buf
+		lines = [data[offsets[n]:offsets[n + 1]] for n in range(len(keys))]
+		order = argsort(keys)
+		with open(filename, 'wb') as fh:
+			write_chunk_file(fh, keys, lines, order, get_codec(codec))
+		# Release our views on the shared memory, otherwise close() will fail
+		for line in lines:
+			line.release()
+		del lines, data
+	finally:
+		shm.close()
+
+
+def submit_shared_chunk(pool:ProcessPoolExecutor, filename:str, chunk:Chunk, codec:Codec) -> "Future[None]":
+	"""Copies the lines of `chunk` into a block of shared memory and hands it
+	to `pool` to sort and write to `filename`. The shared memory is released
+	once the worker is done with it."""
+	data = b''.join(chunk.lines)
+	shm = SharedMemory(create=True, size=max(len(data), 1))
+	try:
+		shm.buf[:len(data)] = data
+		future = pool.submit(sort_shared_chunk, filename, shm.name,
+			chunk.keys if numpy is not None and isinstance(chunk.keys, numpy.ndarray) else array('d', chunk.keys),
+			array('Q', accumulate(map(len, chunk.lines), initial=0)),
+			codec.name)
+	except:
+		shm.close()
+		shm.unlink()
+		raise
+
+	def release(_:"Future[None]") -> None:
+		shm.close()
+		shm.unlink()
+
+	future.add_done_callback(release)
+	return future
 
 
 def task_worker(queue:"Queue[Optional[Callable[[],None]]]") -> None:
@@ -51,27 +365,138 @@ def task_worker(queue:"Queue[Optional[Callable[[],None]]]") -> None:
 		task()
 
 
-def iter_shuffled_file(filename:str) -> Iterable[Tuple[float,bytes]]:
-	with open(filename, 'rb', buffering=BUFSIZE) as fh:
+def iter_shuffled_file(filename:str, codec:Codec=CODECS['none'], stop:Optional[Event]=None) -> Iterable[Tuple[float,bytes]]:
+	"""Reads a chunk file written by `write_chunk_file()`, a block at a time.
+	Raises ShuffleStopped before reading the next block once `stop` is set."""
+	with open(filename, 'rb') as fh:
 		while True:
-			header = fh.read(HEADER.size)
+			check_stopped(stop)
+			header = fh.read(BLOCK_HEADER.size)
 			if header == b'':
 				break
-			random, length = HEADER.unpack(header)
-			yield random, fh.read(length)
+			count, size = BLOCK_HEADER.unpack(header)
+			payload = codec.decompress(fh.read(size))
+			keys, lengths = array('f'), array('I')
+			keys.frombytes(payload[:keys.itemsize * count])
+			lengths.frombytes(payload[keys.itemsize * count:(keys.itemsize + lengths.itemsize) * count])
+			offsets = array('Q', accumulate(lengths, initial=(keys.itemsize + lengths.itemsize) * count))
+			yield from zip(keys, map(payload.__getitem__, map(slice, offsets, islice(offsets, 1, None))))
+			# Let go of this block before reading the next one
+			del payload, keys, lengths, offsets
+
+
+def merge_chunk_files(filenames:Sequence[str], codec:Codec=CODECS['none'], stop:Optional[Event]=None) -> Iterable[Tuple[float,bytes]]:
+	"""Merges sorted chunk files into one sorted sequence of (key, line) pairs.
+	Pairs with the same key come out in the order of `filenames`."""
+	# Use heap merge to read the next smallest random element from the chunk
+	# files which are already sorted.
+	return heapq.merge(*[iter_shuffled_file(filename, codec, stop) for filename in filenames], key=itemgetter(0))
 
 
-def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads:int=1, tmpdir:Optional[str]=None) -> Iterable[bytes]:
+def reduce_chunk_files(chunks:List[str], fan_in:int, codec:Codec=CODECS['none'], tmpdir:Optional[str]=None, stop:Optional[Event]=None) -> None:
+	"""Merges runs of up to `fan_in` consecutive chunk files into a new chunk
+	file until at most `fan_in` are left, so the final merge doesn't have to
+	hold a block of every chunk file in memory. Updates `chunks` in place, such
+	that every file that exists is in it, and in it only once. Because only
+	consecutive chunk files are merged, the final merge gives the same order
+	as merging all of the original chunk files at once."""
+	start = 0
+	while len(chunks) > fan_in:
+		group = chunks[start:start + fan_in]
+		# Not enough chunk files left in this pass, start the next one
+		if len(group) < 2:
+			start = 0
+			continue
+		fileno, filename = mkstemp(dir=tmpdir)
+		chunks.insert(start, filename)
+		with os.fdopen(fileno, 'wb') as fh:
+			write_merged_chunk_file(fh, merge_chunk_files(group, codec, stop), codec)
+		del chunks[start + 1:start + 1 + len(group)]
+		for merged in group:
+			os.unlink(merged)
+		start += 1
+
+
+def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads:int=1, tmpdir:Optional[str]=None, processes:bool=False, memory_limit:Optional[int]=None, compression:str='none', use_numpy:bool=False, stop:Optional[Event]=None) -> Iterable[bytes]:
 	"""Shuffle a list by reading it into a bunch of files (of `lines` length)
-	and shuffling all of these with `threads` in-memory sorters."""
+	and shuffling all of these with `threads` in-memory sorters. If `processes`
+	is set, the sorters are processes instead of threads, so they are not held
+	back by the GIL. If `memory_limit` is given, chunks are sized by bytes
+	instead of `lines`, such that all chunks in memory at the same time (being
+	read, waiting, or being sorted) stay within `memory_limit` bytes. If
+	merging a block of every chunk file at once would take more than that, the
+	chunk files are first merged in groups, which takes extra passes over them
+	on disk but gives the same order. The temporary chunk files are compressed
+	with `compression` (see CODECS). With `use_numpy` the keys are drawn and
+	sorted by NumPy. That gives a different order for the same seed, but one
+	that is just as reproducible. Once `stop` is set the shuffle raises
+	ShuffleStopped between chunks, while sorting or while merging, and removes
+	its chunk files. Pass `fin` through `stoppable()` to stop while reading a
+	chunk as well."""
 	random = Random(seed)
 
+	if use_numpy and numpy is None:
+		raise ValueError('NumPy is not installed')
+
+	codec = get_codec(compression)
+
 	chunks: List[str] = []
 
+	# With a memory limit, the reading thread and each sorter can hold one chunk,
+	# and the block of it that is being written.
+	budget: Optional[MemoryBudget] = None
+	chunk_bytes: Optional[int] = None
+	if memory_limit is not None:
+		budget = MemoryBudget(memory_limit)
+		chunk_bytes = max(memory_limit // (threads + 1) - BLOCK_MEMORY, BLOCKSIZE)
+
+	def read_chunks() -> Iterable[Tuple[str, int, Chunk]]:
+		"""Reads the chunks, and creates a temporary file for each of them."""
+		line_it = iter(fin)
+		while True:
+			check_stopped(stop)
+			if budget is not None:
+				budget.acquire(chunk_bytes or 0)
+			chunk = Chunk.read(line_it, lines, random, max_bytes=chunk_bytes, use_numpy=use_numpy)
+			if not chunk:
+				if budget is not None:
+					budget.release(chunk_bytes or 0)
+				break
+
+			fileno, filename = mkstemp(dir=tmpdir)
+			# Remember the chunk's filename for later
+			chunks.append(filename)
+			yield filename, fileno, chunk
+			# Don't hold on to it while reading the next one, its memory may
+			# already be given back to the budget.
+			del chunk
+
 	try:
-		if threads > 0:
+		if threads > 0 and processes:
+			with ProcessPoolExecutor(threads) as pool:
+				pending: Deque[Future[None]] = deque()
+
+				for filename, fileno, chunk in read_chunks():
+					os.close(fileno)
+
+					# Same as the thread queue: at most `threads` chunks waiting
+					# in memory for a worker.
+					if len(pending) >= threads:
+						pending.popleft().result()
+
+					future = submit_shared_chunk(pool, filename, chunk, codec)
+					if budget is not None:
+						future.add_done_callback(lambda _: budget.release(chunk_bytes or 0)) # type: ignore # budget isn't None
+					pending.append(future)
+					del chunk
+
+				# Wait for the last chunks (and raise any errors they ran into)
+				while pending:
+					pending.popleft().result()
+		elif threads > 0:
 			# Limiting queue to 1 pending chunk otherwise we'll run out of memory quickly.
-			queue: "Queue[Optional[SortTask]]" = Queue(maxsize=threads)
+			# With a memory limit, the budget is what limits the queue.
+			queue: "Queue[Optional[SortTask]]" = Queue(maxsize=threads if budget is None else 0)
 
 			# Prepare shuffle workers to start shuffling chunks as soon as we've
 			# finished writing them.
@@ -84,19 +509,12 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 				for sorter in sorters:
 					sorter.start()
 
-				# Split the input file into separate temporary chunks
-				line_it = iter(fin)
-				while True:
-					chunk = [(random.random(), line) for line in islice(line_it, lines)]
-					if not chunk:
-						break
-
-					fileno, filename = mkstemp(dir=tmpdir)
-					# Remember the chunk's filename for later
-					chunks.append(filename)
-					# And immediately start shuffling & writing that chunk in another thread
-					# so we can use this thread to continue ingesting chunks
-					queue.put(SortTask(fileno, chunk))
+				# Split the input file into separate temporary chunks, and 
+				# immediately start shuffling & writing that chunk in another thread
+				# so we can use this thread to continue ingesting chunks
+				for _, fileno, chunk in read_chunks():
+					queue.put(SortTask(fileno, chunk, codec, budget, chunk_bytes or 0, stop))
+					del chunk
 			finally:
 				# Tell sorters that they can stop waiting
 				for _ in sorters:
@@ -106,24 +524,22 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 				for sorter in sorters:
 					sorter.join()
 		else:
-			line_it = iter(fin)
-			while True:
-				chunk = [(random.random(), line) for line in islice(line_it, lines)]
-				if not chunk:
-					break
+			for _, fileno, chunk in read_chunks():
+				task = SortTask(fileno, chunk, codec, budget, chunk_bytes or 0, stop)
+				task()
+				del task, chunk
 
-				fileno, filename = mkstemp(dir=tmpdir)
-				chunks.append(filename)
+		# Sorters may have abandoned their chunks half-way
+		check_stopped(stop)
 
-				task = SortTask(fileno, chunk)
-				task()				
+		# Merging holds a block of every chunk file in memory. If that doesn't
+		# fit the memory limit, merge chunk files in a few passes instead.
+		if memory_limit is not None:
+			# The chunk file that is being written takes about two blocks as well.
+			reduce_chunk_files(chunks, max(2, memory_limit // BLOCK_MEMORY - 2), codec, tmpdir, stop)
 
 		# Open all chunks. We'll be reading the next line from a random one of them.
-		chunk_fds = [iter_shuffled_file(filename) for filename in chunks]
-
-		# Use heap merge to read the next smallest random element from chunk_fds
-		# which are already sorted.
-		for _, line in heapq.merge(*chunk_fds, key=itemgetter(0)):
+		for _, line in merge_chunk_files(chunks, codec, stop):
 			yield line
 
 	finally:
@@ -133,56 +549,750 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 			os.unlink(filename)
 
 
+def scatter_shuffle(fin:Iterable[bytes], buckets:int, *, seed:Optional[int]=None, threads:int=1, tmpdir:Optional[str]=None) -> Iterable[bytes]:
+	"""Shuffle by scattering the lines randomly over `buckets` temporary files,
+	and then shuffling each of those in memory and reading them one after the
+	other. Since each line is equally likely to end up in any bucket, this
+	gives a uniformly random permutation without having to merge anything.
+	Each bucket has to fit in memory. With `threads` > 0 up to `threads`
+	buckets are read and shuffled ahead of the one that is being written out.
+	"""
+	random = Random(seed)
+
+	filenames: List[str] = []
+
+	try:
+		files = []
+		try:
+			for _ in range(buckets):
+				fileno, filename = mkstemp(dir=tmpdir)
+				filenames.append(filename)
+				files.append(os.fdopen(fileno, 'wb', buffering=BUFSIZE))
+
+			# First pass: write each line to a random bucket
+			writers = [fh.write for fh in files]
+			draw = random.random
+			for line in fin:
+				writers[int(draw() * buckets)](line)
+		finally:
+			for fh in files:
+				fh.close()
+
+		# Second pass: shuffle each bucket with its own seed, so the order in
+		# which the threads get to them does not matter.
+		seeds = [random.getrandbits(64) for _ in filenames]
+
+		def load(filename:str, seed:int) -> List[bytes]:
+			with open(filename, 'rb', buffering=BUFSIZE) as fh:
+				lines = fh.readlines()
+			Random(seed).shuffle(lines)
+			return lines
+
+		if threads > 0:
+			with ThreadPoolExecutor(threads) as pool:
+				pending: Deque[Future[List[bytes]]] = deque()
+				for filename, bucket_seed in zip(filenames, seeds):
+					pending.append(pool.submit(load, filename, bucket_seed))
+					if len(pending) > threads:
+						yield from pending.popleft().result()
+				while pending:
+					yield from pending.popleft().result()
+		else:
+			for filename, bucket_seed in zip(filenames, seeds):
+				yield from load(filename, bucket_seed)
+	finally:
+		for filename in filenames:
+			os.unlink(filename)
+
+
+def sample_lines(lines:Iterable[bytes], total:int, size:int, *, seed:int) -> Iterator[bytes]:
+	"""Selects `size` of the first `total` lines uniformly at random, keeping
+	their order (Knuth's Algorithm S). Only needs memory for a single line, but
+	the number of lines has to be known in advance."""
+	draw = Random(seed).random
+	needed = size
+	for remaining, line in zip(range(total, 0, -1), lines):
+		if needed == 0:
+			break
+		if draw() * remaining < needed:
+			needed -= 1
+			yield line
+
+
+def sample_fraction(lines:Iterable[bytes], fraction:float, *, seed:int) -> Iterator[bytes]:
+	"""Selects each line with probability `fraction`, keeping their order."""
+	draw = Random(seed).random
+	return (line for line in lines if draw() < fraction)
+
+
+def buffer_shuffle(lines:Iterable[bytes], size:int, *, seed:int) -> Iterator[bytes]:
+	"""Approximate shuffle in memory bounded by `size` lines, without any
+	temporary files. Each line read replaces a random line from the buffer, which
+	is yielded. Lines can move back any distance, but only forward by roughly
+	`size` places, so this works best if the input isn't sorted to begin with."""
+	random = Random(seed)
+	draw = random.random
+	it = iter(lines)
+	buffer = list(islice(it, size))
+	for line in it:
+		n = int(draw() * size)
+		yield buffer[n]
+		buffer[n] = line
+	random.shuffle(buffer)
+	yield from buffer
+
+
+class LineIndex:
+	"""Byte offsets of the start of each line in a file, followed by the size of
+	the file. Stored as an array of unsigned 64-bit integers, so it costs
+	8 bytes per line regardless of how long those lines are."""
+	offsets: array
+
+	def __init__(self, offsets:array):
+		self.offsets = offsets
+
+	@classmethod
+	def build(cls, data:bytes) -> 'LineIndex':
+		"""Scan `data` (e.g. an mmap of the file) for line endings."""
+		offsets = array('Q', [0])
+		pos = data.find(b'\n')
+		while pos != -1:
+			offsets.append(pos + 1)
+			pos = data.find(b'\n', pos + 1)
+		# Last line might not end with a newline
+		if offsets[-1] != len(data):
+			offsets.append(len(data))
+		return cls(offsets)
+
+	@classmethod
+	def load(cls, filename:str) -> 'LineIndex':
+		"""Read an index previously written by `dump()`."""
+		offsets = array('Q')
+		with open(filename, 'rb') as fh:
+			offsets.fromfile(fh, os.fstat(fh.fileno()).st_size // offsets.itemsize)
+		return cls(offsets)
+
+	def dump(self, filename:str) -> None:
+		with open(filename, 'wb') as fh:
+			self.offsets.tofile(fh)
+
+	def __len__(self) -> int:
+		return len(self.offsets) - 1
+
+	def span(self, line:int) -> slice:
+		return slice(self.offsets[line], self.offsets[line + 1])
+
+
+class SparseLineIndex:
+	"""Byte offsets of every `interval`-th line in a file, enough to start
+	reading at any line after skipping fewer than `interval` lines. Stored as
+	an array of unsigned 64-bit integers, the first of which is the interval."""
+	interval: int
+	offsets: array
+
+	def __init__(self, interval:int, offsets:Optional[array]=None):
+		self.interval = interval
+		self.offsets = offsets if offsets is not None else array('Q')
+
+	@classmethod
+	def load(cls, fh:BinaryIO) -> 'SparseLineIndex':
+		"""Read an index previously written by `dump()`."""
+		offsets = array('Q')
+		offsets.frombytes(fh.read())
+		return cls(offsets[0], offsets[1:])
+
+	def dump(self, fh:BinaryIO) -> None:
+		array('Q', [self.interval]).tofile(fh)
+		self.offsets.tofile(fh)
+
+	def locate(self, line:int) -> Tuple[int,int]:
+		"""Returns the byte offset to seek to and the number of lines to skip
+		from there to arrive at `line`."""
+		block = min(line // self.interval, len(self.offsets) - 1)
+		if block < 0:
+			return 0, line
+		return self.offsets[block], line - block * self.interval
+
+
+def index_lines(lines:Iterable[bytes], index:SparseLineIndex) -> Iterator[bytes]:
+	"""Passes through `lines` while recording the offset of every
+	`index.interval`-th line in `index`."""
+	it = iter(lines)
+	offset = 0
+	while True:
+		batch = list(islice(it, index.interval))
+		if not batch:
+			break
+		index.offsets.append(offset)
+		offset += sum(map(len, batch))
+		yield from batch
+
+
+class IndexedCorpus:
+	"""Random access to the lines of one or more uncompressed files. Files are
+	memory-mapped and indexed once, after which any permutation of the corpus
+	can be read without copying it. Alternatively, see `read()`."""
+	maps: List[Union[mmap.mmap, bytes]]
+	indices: List[LineIndex]
+	boundaries: List[int]
+
+	def __init__(self, filenames:Iterable[str], indices:Optional[Iterable[LineIndex]]=None):
+		"""If `indices` is given, it should contain a LineIndex for each file
+		in `filenames`. Otherwise the files will be scanned to build them."""
+		self.maps = []
+		self.indices = []
+		self.boundaries = []
+
+		for filename, index in zip(filenames, indices or repeat(None)):
+			with open(filename, 'rb') as fh:
+				# Can't mmap empty files, but they don't contribute lines anyway.
+				if os.fstat(fh.fileno()).st_size == 0:
+					continue
+				data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+			self._add(data, index)
+
+	@classmethod
+	def read(cls, filenames:Sequence[str], threads:int=1) -> 'IndexedCorpus':
+		"""Read (and decompress) the files into memory instead of mapping them,
+		as a single buffer. Costs as much memory as the decompressed files, plus
+		8 bytes per line for the index."""
+		chunks = []
+		for filename in filenames:
+			data = b''.join(Reader(filename, threads=threads))
+			# Make sure the last line of a file doesn't get glued to the next
+			if data and not data.endswith(b'\n'):
+				data += b'\n'
+			chunks.append(data)
+		corpus = cls([])
+		data = b''.join(chunks)
+		if data:
+			corpus._add(data, None)
+		return corpus
+
+	def _add(self, data:Union[mmap.mmap, bytes], index:Optional[LineIndex]) -> None:
+		if index is None:
+			index = LineIndex.build(data)
+		self.maps.append(data)
+		self.indices.append(index)
+		self.boundaries.append(len(self) + len(index))
+
+	def __len__(self) -> int:
+		return self.boundaries[-1] if self.boundaries else 0
+
+	def __getitem__(self, line:int) -> bytes:
+		file = bisect_right(self.boundaries, line)
+		if file > 0:
+			line -= self.boundaries[file - 1]
+		return self.maps[file][self.indices[file].span(line)]
+
+	def close(self) -> None:
+		for data in self.maps:
+			if isinstance(data, mmap.mmap):
+				data.close()
+		self.maps = []
+		self.indices = []
+		self.boundaries = []
+
+
+def shuffled_order(length:int, seed:Optional[int]) -> array:
+	"""Random permutation of `range(length)` as an array of line numbers."""
+	order = array('Q', range(length))
+	Random(seed).shuffle(order)
+	return order
+
+
+class LineReader(io.RawIOBase):
+	"""Read-only file object over an iterable of lines, e.g. a Reader. Wrap it
+	in `io.TextIOWrapper` to read it as text."""
+	lines: Iterator[bytes]
+	_pending: bytes
+
+	def __init__(self, lines:Iterable[bytes]):
+		super().__init__()
+		self.lines = iter(lines)
+		self._pending = b''
+
+	def readable(self) -> bool:
+		return True
+
+	def readinto(self, buffer) -> int:
+		view = memoryview(buffer).cast('B')
+		written = 0
+		while written < len(view):
+			if not self._pending:
+				try:
+					self._pending = next(self.lines)
+				except StopIteration:
+					break
+				# Make sure the last line of a file doesn't get glued to the next
+				if not self._pending.endswith(b'\n'):
+					self._pending += b'\n'
+			size = min(len(self._pending), len(view) - written)
+			view[written:written + size] = self._pending[:size]
+			self._pending = self._pending[size:]
+			written += size
+		return written
+
+	def close(self) -> None:
+		# Stop e.g. the decompression subprocess of a Reader that was not read
+		# until the end.
+		close = getattr(self.lines, 'close', None)
+		if close is not None:
+			close()
+		super().close()
+
+
+class IndexedReader(LineReader):
+	"""Read-only file object that yields the lines of an IndexedCorpus in the
+	order given by `order`. Wrap it in `io.TextIOWrapper` to read it as text."""
+	corpus: IndexedCorpus
+
+	def __init__(self, corpus:IndexedCorpus, order:Iterable[int]):
+		super().__init__(map(corpus.__getitem__, order))
+		self.corpus = corpus
+
+
+def find_decompressor(extension:str) -> Optional[List[str]]:
+	"""Command line of the preferred installed decompressor for files with this
+	extension, without the filename. None if there is none."""
+	for command in DECOMPRESSORS.get(extension, []):
+		path = which(command[0])
+		if path is not None:
+			return [path, *command[1:]]
+	return None
+
+
+def is_bgzf(filename:str) -> bool:
+	"""Whether the file is a BGZF file, i.e. gzip members with a BC subfield."""
+	with open(filename, 'rb') as fh:
+		header = fh.read(GZIP_HEADER.size + 6)
+	return len(header) == GZIP_HEADER.size + 6 \
+		and header.startswith(BGZF_MAGIC) \
+		and header[GZIP_HEADER.size:GZIP_HEADER.size+4] == b'BC\x02\x00'
+
+
+def iter_bgzf_members(fh:BinaryIO) -> Iterator[bytes]:
+	"""Yields each gzip member of a BGZF file, header excluded."""
+	while True:
+		header = fh.read(GZIP_HEADER.size)
+		if not header:
+			break
+		if len(header) < GZIP_HEADER.size or not header.startswith(BGZF_MAGIC):
+			raise ValueError('Not a BGZF member')
+		_, xlen = GZIP_HEADER.unpack(header)
+		extra = fh.read(xlen)
+		bsize = None
+		pos = 0
+		while pos + 4 <= len(extra):
+			slen = int.from_bytes(extra[pos+2:pos+4], 'little')
+			if extra[pos:pos+2] == b'BC' and slen == 2:
+				bsize = int.from_bytes(extra[pos+4:pos+6], 'little')
+			pos += 4 + slen
+		if bsize is None:
+			raise ValueError('BGZF member without BC subfield')
+		member = fh.read(bsize + 1 - GZIP_HEADER.size - xlen)
+		if len(member) < GZIP_TRAILER.size:
+			raise ValueError('Truncated BGZF member')
+		yield member
+
+
+def inflate_bgzf_members(members:List[bytes]) -> bytes:
+	"""Decompresses consecutive BGZF members. zlib releases the GIL while
+	inflating, so this can run in parallel in multiple threads."""
+	output = []
+	for member in members:
+		data = zlib.decompress(member[:-GZIP_TRAILER.size], wbits=-15)
+		crc, size = GZIP_TRAILER.unpack_from(member, len(member) - GZIP_TRAILER.size)
+		if zlib.crc32(data) != crc or len(data) & 0xffffffff != size:
+			raise ValueError('BGZF member failed its CRC check')
+		output.append(data)
+	return b''.join(output)
+
+
+def split_lines(buffers:Iterable[bytes]) -> Iterator[bytes]:
+	"""Splits a stream of buffers into lines, including their newline."""
+	tail = b''
+	for buffer in buffers:
+		lines = io.BytesIO(buffer).readlines()
+		if not lines:
+			continue
+		if tail:
+			lines[0] = tail + lines[0]
+		tail = lines.pop() if not lines[-1].endswith(b'\n') else b''
+		yield from lines
+	if tail:
+		yield tail
+
+
+def split_carriage_returns(line:bytes) -> List[bytes]:
+	"""Splits a line the way text mode's universal newlines do: `\r` and
+	`\r\n` end a line as well, and become `\n`. Lines are only split at `\n`
+	while shuffling."""
+	return line.replace(b'\r\n', b'\n').replace(b'\r', b'\n').splitlines(keepends=True)
+
+
 class Reader(Iterable[bytes]):
 	"""Lazily opens a file only once you start trying to read it. Also magically
-	reads gzipped files."""
-	def __init__(self, filename:str):
+	reads gzip, zstd, xz and bzip2 compressed files. With `threads` > 1 BGZF
+	files are decompressed in that many threads."""
+	def __init__(self, filename:str, threads:int=1):
 		self.filename = filename
+		self.threads = threads
 
-	def _read_gzip(self, filename:str) -> Iterable[bytes]:
-		"""Open gzipped files through gzip subprocess. It is faster than Python's
-		gzip submodule, and you get a bit of multiprocessing for free as the
-		external gzip process can decompress up to BUFSIZE while python is doing
-		other things."""
-		assert PATH_TO_GZIP is not None, 'No gzip executable found on system'
-		child = subprocess.Popen([PATH_TO_GZIP, '-cd', filename], stdout=subprocess.PIPE, bufsize=BUFSIZE)
-		assert child.stdout is not None
-		yield from child.stdout
-		if child.wait() != 0:
-			raise RuntimeError(f'`{PATH_TO_GZIP} -cd {filename}` failed with return code {child.returncode}')
-
-	def _read_plain(self, filename:str) -> Iterable[bytes]:
-		with open(filename, 'rb') as fh:
+	def _read_command(self, command:List[str]) -> Iterator[bytes]:
+		"""Decompress files through a subprocess, e.g. pigz. It is faster than
+		Python's own modules, and you get a bit of multiprocessing for free as the
+		external process can decompress up to BUFSIZE while python is doing other
+		things."""
+		with subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=BUFSIZE) as child:
+			assert child.stdout is not None
+			try:
+				yield from child.stdout
+			except GeneratorExit:
+				child.kill()
+				raise
+		if child.returncode != 0:
+			raise RuntimeError(f'`{" ".join(command)}` failed with return code {child.returncode}')
+
+	def _read_module(self, opener:Callable[[str], BinaryIO]) -> Iterator[bytes]:
+		with opener(self.filename) as fh:
+			yield from fh
+
+	def _read_bgzf(self) -> Iterator[bytes]:
+		"""BGZF members are independent, so they can be decompressed in parallel.
+		Reading them from disk happens in order, as does splitting the output
+		into lines."""
+		def inflate(pool:ThreadPoolExecutor, members:Iterator[bytes]) -> Iterator[bytes]:
+			pending: Deque[Future[bytes]] = deque()
+			while True:
+				while len(pending) < 2 * self.threads:
+					batch = list(islice(members, BGZF_MEMBERS_PER_TASK))
+					if not batch:
+						break
+					pending.append(pool.submit(inflate_bgzf_members, batch))
+				if not pending:
+					break
+				yield pending.popleft().result()
+
+		with open(self.filename, 'rb', buffering=BUFSIZE) as fh, ThreadPoolExecutor(self.threads) as pool:
+			yield from split_lines(inflate(pool, iter_bgzf_members(fh)))
+
+	def _read_plain(self) -> Iterator[bytes]:
+		with open(self.filename, 'rb') as fh:
 			yield from fh
 
 	def __iter__(self) -> Iterator[bytes]:
-		if self.filename.endswith('.gz'):
-			return iter(self._read_gzip(self.filename))
+		extension = os.path.splitext(self.filename)[1]
+		if extension == '.gz' and self.threads > 1 and is_bgzf(self.filename):
+			return self._read_bgzf()
+		if extension in DECOMPRESSORS:
+			command = find_decompressor(extension)
+			if command is not None:
+				return self._read_command([*command, self.filename])
+			if extension in PY_DECOMPRESSORS:
+				return self._read_module(PY_DECOMPRESSORS[extension])
+			raise RuntimeError(f'No decompressor found on system for {self.filename}')
+		return self._read_plain()
+
+
+def read_ahead(reader:Iterable[bytes], queue:'Queue[Union[List[bytes],BaseException]]', stop:Event) -> None:
+	"""Puts the lines of `reader` in `queue` in batches, followed by an empty
+	batch, until `stop` is set. Exceptions are put in the queue as well."""
+	try:
+		lines = iter(reader)
+		while not stop.is_set():
+			batch = list(islice(lines, READAHEAD_LINES))
+			queue.put(batch)
+			if not batch:
+				break
+	except BaseException as exc:
+		queue.put(exc)
+
+
+def read_files(filenames:Sequence[str], threads:int=1) -> Iterator[bytes]:
+	"""Yields the lines of all files, one file after the other. With `threads`
+	> 1 up to that many files are read and decompressed concurrently, each in
+	its own thread and a limited number of lines ahead."""
+	readers = [Reader(filename, threads=threads) for filename in filenames]
+
+	if threads <= 1 or len(readers) <= 1:
+		yield from chain.from_iterable(readers)
+		return
+
+	stop = Event()
+	queues: Deque['Queue[Union[List[bytes],BaseException]]'] = deque()
+	remaining = iter(readers)
+
+	def start(reader:Reader) -> None:
+		queue: 'Queue[Union[List[bytes],BaseException]]' = Queue(maxsize=READAHEAD_BATCHES)
+		Thread(target=read_ahead, args=(reader, queue, stop), daemon=True).start()
+		queues.append(queue)
+
+	try:
+		for reader in islice(remaining, threads):
+			start(reader)
+		while queues:
+			queue = queues[0]
+			while True:
+				batch = queue.get()
+				if isinstance(batch, BaseException):
+					raise batch
+				if not batch:
+					break
+				yield from batch
+			queues.popleft()
+			for reader in islice(remaining, 1):
+				start(reader)
+	finally:
+		# Unblock the threads that are still reading so they see `stop`
+		stop.set()
+		for queue in queues:
+			while not queue.empty():
+				queue.get_nowait()
+
+
+def shard_shuffle(filenames:Sequence[str], window:int, *, seed:int, threads:int=1, stop:Optional[Event]=None) -> Iterator[bytes]:
+	"""Shuffles the order of the shards (files), and then the lines within
+	each consecutive `window` of shards in memory. While the lines of one window
+	are yielded the next window is read, with up to `threads` of its shards
+	read concurrently. Memory use is bounded by the size of two windows. Once
+	`stop` is set, reading a window raises ShuffleStopped."""
+	random = Random(seed)
+	shards = list(filenames)
+	random.shuffle(shards)
+
+	def load(shards:List[str], seed:int) -> List[bytes]:
+		it: Iterable[bytes] = read_files(shards, threads=threads)
+		if stop is not None:
+			it = stoppable(it, stop)
+		lines = list(it)
+		Random(seed).shuffle(lines)
+		return lines
+
+	windows = [
+		(shards[offset:offset+window], random.getrandbits(64))
+		for offset in range(0, len(shards), window)
+	]
+
+	with ThreadPoolExecutor(1) as pool:
+		pending: Deque[Future[List[bytes]]] = deque()
+		for args in windows:
+			pending.append(pool.submit(load, *args))
+			if len(pending) > 1:
+				yield from pending.popleft().result()
+		while pending:
+			yield from pending.popleft().result()
+
+
+def parse_sample(sample:str) -> Union[int,float]:
+	"""Parses a number of lines, or a fraction of lines if it is written as
+	a decimal number."""
+	if '.' in sample or 'e' in sample.lower():
+		fraction = float(sample)
+		if not 0.0 < fraction <= 1.0:
+			raise ValueError(f'Fraction of lines to sample should be between 0 and 1: {sample}')
+		return fraction
+	return int(sample)
+
+
+def parse_size(size:str) -> int:
+	"""Parses a number of bytes with an optional K, M, G or T suffix."""
+	units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+	size = size.strip().upper().rstrip('B')
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+
+def shuffle_files(filenames:Sequence[str], seed:int, *, no_shuffle:bool=False, algorithm:str='merge', batch_size:int=1_000_000, memory_limit:Optional[int]=None, threads:int=0, read_threads:int=1, processes:bool=False, tmpdir:Optional[str]=None, compression:str='none', buffer_size:int=1_000_000, shard_window:int=1, sample:Optional[Union[int,float]]=None, buckets:int=64, use_numpy:bool=False, stop:Optional[Event]=None) -> Iterator[bytes]:
+	"""Yields the lines of all files, shuffled with `algorithm`. This is what
+	`main()` writes to its output, and the arguments are those of its command
+	line options, with `no_shuffle` for --no-shuffle. Once `stop` is set, it
+	raises ShuffleStopped soon after, also while it is still reading, counting
+	or sorting lines instead of yielding them."""
+	files = list(filenames)
+	random = Random(seed)
+
+	# The buffer algorithm can only move lines forward so far, so at least
+	# start every epoch with a different file.
+	if not no_shuffle and algorithm == 'buffer':
+		random.shuffle(files)
+
+	# Read the lines
+	it: Iterable[bytes] = read_files(files, threads=read_threads)
+	if stop is not None:
+		it = stoppable(it, stop)
+
+	# Only select the sample that will be shuffled
+	if sample is not None and algorithm == 'shards':
+		raise ValueError('sample is not supported by the shards algorithm')
+	elif isinstance(sample, float):
+		it = sample_fraction(it, sample, seed=random.getrandbits(64))
+	elif sample is not None:
+		# Imported here because opustrainer.cache imports this module. Counted
+		# by `filenames`, since `files` may have been shuffled.
+		from opustrainer.cache import LineCount
+		total = LineCount(list(filenames), tmpdir=tmpdir).get(lambda: sum(1 for _ in stoppable(read_files(files, threads=read_threads), stop)))
+		it = sample_lines(it, total, sample, seed=random.getrandbits(64))
+
+	# Shuffle the lines
+	if not no_shuffle and algorithm == 'shards':
+		it = shard_shuffle(files, shard_window, seed=seed, threads=read_threads, stop=stop)
+	elif not no_shuffle and algorithm == 'buffer':
+		it = buffer_shuffle(it, buffer_size, seed=random.getrandbits(64))
+	elif not no_shuffle and algorithm == 'scatter':
+		it = scatter_shuffle(it, buckets=buckets, seed=seed, threads=threads, tmpdir=tmpdir)
+	elif not no_shuffle:
+		it = shuffle(it, lines=batch_size, seed=seed, threads=threads, tmpdir=tmpdir, processes=processes, memory_limit=memory_limit, compression=compression, use_numpy=use_numpy, stop=stop)
+
+	yield from it
+
+
+class ShuffleThread(Thread):
+	"""Writes shuffled lines, e.g. from `shuffle_files()`, to a file descriptor
+	and optionally a sparse index of their offsets to another, like `main()`
+	does, but in a thread of this process instead of in a new one. Without a
+	file descriptor the lines are written to a pipe, which is read through
+	`stdout`. It implements the parts of `subprocess.Popen` needed to wait for
+	it or kill it, so it can be used in its place. Pass the same `stop` event
+	to `shuffle_files()` so that killing the thread also stops a shuffle that
+	has not yielded its first line yet."""
+	stdout: Optional[BinaryIO]
+	returncode: Optional[int]
+	exception: Optional[BaseException]
+
+	def __init__(self, lines:Iterator[bytes], fileno:Optional[int]=None, offsets_fileno:Optional[int]=None, *, interval:int=OFFSETS_INTERVAL, stop:Optional[Event]=None):
+		super().__init__(daemon=True)
+		self.lines = lines
+		self.offsets_fileno = offsets_fileno
+		self.interval = interval
+		self.returncode = None
+		self.exception = None
+		self._stop_event = stop if stop is not None else Event()
+
+		if fileno is None:
+			read_fd, self.fileno = os.pipe()
+			self.stdout = open(read_fd, 'rb', buffering=BUFSIZE)
+			self._closefd = True
 		else:
-			return iter(self._read_plain(self.filename))
+			self.fileno = fileno
+			self.stdout = None
+			self._closefd = False
+
+	def run(self) -> None:
+		def until_stopped(lines:Iterable[bytes]) -> Iterator[bytes]:
+			for line in lines:
+				if self._stop_event.is_set():
+					break
+				yield line
+
+		try:
+			with open(self.fileno, 'wb', buffering=BUFSIZE, closefd=self._closefd) as fout:
+				it: Iterable[bytes] = until_stopped(self.lines)
+				if self.offsets_fileno is not None:
+					index = SparseLineIndex(self.interval)
+					it = index_lines(it, index)
+				fout.writelines(it)
+			if self.offsets_fileno is not None and not self._stop_event.is_set():
+				with open(self.offsets_fileno, 'wb', closefd=False) as offsets:
+					index.dump(offsets)
+		except BaseException as exc:
+			if not self._stop_event.is_set():
+				self.exception = exc
+		finally:
+			# Also cleans up the temporary files of the shuffle
+			if hasattr(self.lines, 'close'):
+				self.lines.close() # type: ignore
+			if self._stop_event.is_set():
+				self.returncode = -9
+			else:
+				self.returncode = 0 if self.exception is None else 1
+
+	def poll(self) -> Optional[int]:
+		return self.returncode
+
+	def wait(self) -> int:
+		self.join()
+		assert self.returncode is not None
+		return self.returncode
+
+	def kill(self) -> None:
+		"""Stops the thread at the next line, or sooner if the shuffle shares its
+		`stop` event. A thread blocked on writing to a pipe nobody reads anymore
+		is unblocked by closing the pipe."""
+		self._stop_event.set()
+		if self.stdout is not None:
+			self.stdout.close()
+
+
+def peak_memory() -> int:
+	"""Peak resident set size in bytes of this process plus that of the largest
+	of its (finished) child processes, e.g. the --processes workers."""
+	# ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+	scale = 1 if sys.platform == 'darwin' else 1024
+	return scale * (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
 
 
 def main() -> None:
 	parser = ArgumentParser()
 	parser.add_argument('--batch-size', type=int, default=1_000_000, help='number of lines per chunk. Note that these chunks are read into memory when being shuffled')
+	parser.add_argument('--memory-limit', '-m', type=parse_size, help='size chunks by memory instead of --batch-size so that all chunks in memory together stay below this many bytes (suffixes K, M, G, T allowed). If merging all chunks at once would take more than that, they are merged in multiple passes. Only for the merge algorithm')
 	parser.add_argument('--threads', '-j', type=int, default=0, help=f'number of concurrent shuffle threads. Defaults to none')
+	parser.add_argument('--read-threads', '-r', type=int, default=1, help='number of files to read and decompress concurrently, and number of threads to decompress BGZF files with. Defaults to 1')
+	parser.add_argument('--processes', action='store_true', help='sort chunks in --threads worker processes instead of threads so sorting is not limited by the GIL')
 	parser.add_argument('--temporary-directory', '-T', type=str, help='temporary directory for shuffling batches')
 	parser.add_argument('--no-shuffle', '-n', action="store_false", help='Do not shuffle, to be used for debugging', dest="shuffle")
+	parser.add_argument('--algorithm', choices=['merge', 'scatter', 'buffer', 'shards'], default='merge', help='merge: shuffle chunks of --batch-size lines and merge them. scatter: distribute lines over --buckets files and shuffle each of those in memory. buffer: read the files in random order and approximately shuffle them through a --buffer-size lines buffer, without temporary files. shards: read the files in random order and shuffle the lines of each --shard-window files in memory. Defaults to merge')
+	parser.add_argument('--numpy', action='store_true', dest='use_numpy', help='draw the random keys and sort the chunks of the merge algorithm with NumPy. Much faster, but for the same seed the order differs from the one without --numpy')
+	parser.add_argument('--compress', '-z', type=str, default='none', choices=['auto', *CODECS], help='compression for the temporary chunks of the merge algorithm. auto picks zstd or lz4 if installed, zlib otherwise. Defaults to none')
+	parser.add_argument('--buffer-size', type=int, default=1_000_000, help='number of lines in memory for the buffer algorithm. Defaults to 1000000')
+	parser.add_argument('--shard-window', type=int, default=1, help='number of files shuffled together in memory by the shards algorithm. Defaults to 1')
+	parser.add_argument('--sample', type=parse_sample, help='shuffle only a random sample of this many lines, or of this fraction of the lines if it is a decimal number, e.g. 0.1. A number of lines costs an extra pass over the files to count them the first time. The count is remembered in --temporary-directory. Not for the shards algorithm')
+	parser.add_argument('--buckets', type=int, default=64, help='number of buckets for the scatter algorithm. Each bucket is read into memory when being shuffled')
+	parser.add_argument('--offsets', type=FileType('wb'), help='also write a sparse index of line offsets of the output to this file, so reading can start at any line without reading the lines before it')
+	parser.add_argument('--offsets-interval', type=int, default=OFFSETS_INTERVAL, help=f'number of lines between the offsets in --offsets. Defaults to {OFFSETS_INTERVAL}')
+	parser.add_argument('--verbose', '-v', action='store_true', help='print statistics, such as the peak memory use, to stderr when done')
 	parser.add_argument('seed', type=int)
 	parser.add_argument('output', type=FileType('wb', bufsize=BUFSIZE), default='-')
 	parser.add_argument('files', nargs='+')
 
 	args = parser.parse_args()
 
-	# Read the lines
-	it: Iterable[bytes] = chain.from_iterable(Reader(filename) for filename in args.files)
+	if args.sample is not None and args.algorithm == 'shards':
+		parser.error('--sample is not supported by the shards algorithm')
 
-	# Shuffle the lines
-	if args.shuffle:
-		it = shuffle(it, lines=args.batch_size, seed=args.seed, threads=args.threads, tmpdir=args.temporary_directory)
+	if args.use_numpy and numpy is None:
+		parser.error('--numpy requires NumPy to be installed')
+
+	it = shuffle_files(args.files, args.seed,
+		no_shuffle=not args.shuffle,
+		algorithm=args.algorithm,
+		batch_size=args.batch_size,
+		memory_limit=args.memory_limit,
+		threads=args.threads,
+		read_threads=args.read_threads,
+		processes=args.processes,
+		tmpdir=args.temporary_directory,
+		compression=args.compress,
+		buffer_size=args.buffer_size,
+		shard_window=args.shard_window,
+		sample=args.sample,
+		buckets=args.buckets,
+		use_numpy=args.use_numpy)
+
+	if args.offsets:
+		index = SparseLineIndex(args.offsets_interval)
+		it = index_lines(it, index)
 
 	args.output.writelines(it)
 
+	if args.offsets:
+		index.dump(args.offsets)
+		args.offsets.close()
+
+	if args.verbose:
+		print(f'peak memory use: {peak_memory() / 2**20:.1f} MiB', file=sys.stderr)
+
 
 if __name__ == '__main__':
 	main()
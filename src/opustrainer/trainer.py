@@ -2,7 +2,11 @@
 """A translation model trainer. It feeds marian different sets of datasets with different thresholds
 for different stages of the training. Data is uncompressed and TSV formatted src\ttrg
 """
+import io
+import fcntl
+import math
 import os
+import glob
 import sys
 import signal
 import argparse
@@ -11,10 +15,16 @@ import subprocess
 import shlex
 import time
 
-from dataclasses import dataclass
-from typing import List, Tuple, Dict, Any, Optional, Union, Type, TextIO, cast, Iterable, Iterable, TypeVar, get_type_hints, get_args, get_origin
+from collections import deque
+from contextlib import closing
+from dataclasses import dataclass, replace
+from queue import Empty, Queue
+from threading import Event, Thread
+from typing import List, Tuple, Dict, Any, Deque, Optional, Union, Type, TextIO, BinaryIO, cast, Generator, Iterable, Iterable, Iterator, Sequence, TypeVar, get_type_hints, get_args, get_origin
 from tempfile import TemporaryFile
-from itertools import islice
+from bisect import bisect_left
+from itertools import groupby
+from operator import itemgetter, methodcaller
 from pathlib import Path
 
 import yaml
@@ -28,6 +38,8 @@ from opustrainer.modifiers.placeholders import PlaceholderTagModifier
 from opustrainer.modifiers.typos import TypoModifier
 from opustrainer.modifiers.retokenize import RetokenizeModifier
 from opustrainer.modifiers.pool import make_modifier_pool
+from opustrainer.shuffle import CODECS, DECOMPRESSORS, IndexedCorpus, IndexedReader, LineReader, ShuffleThread, SparseLineIndex, numpy, read_files, shuffle_files, shuffled_order, split_carriage_returns, parse_sample, parse_size
+from opustrainer.cache import CorpusCache, EpochFile
 from opustrainer import logger
 
 def ignore_sigint():
@@ -51,10 +63,69 @@ MODIFIERS = {
     'Retokenize': RetokenizeModifier,
 }
 
+# Ways a dataset can be shuffled:
+# full: shuffle the entire dataset with opustrainer.shuffle (default)
+# buffer: approximately shuffle it through a buffer, see opustrainer.shuffle.buffer_shuffle
+# none: it is already shuffled, read it as is
+# memory: read it into memory once, and shuffle it there each epoch
+SHUFFLE_POLICIES = ('full', 'buffer', 'none', 'memory')
+
+# Number of bytes of lines DatasetReader reads and validates at a time
+READ_BLOCK_SIZE = 2**20
+
+# Roughly how many times smaller text gets with the compressions in
+# DECOMPRESSORS. Used to estimate the decompressed size of a dataset.
+COMPRESSION_RATIO = 4
+
+# Size in bytes the pipe to the trainer program is enlarged to, if allowed
+PIPE_SIZE = 2**20
+
+# fcntl only has F_SETPIPE_SZ since Python 3.10, and only on Linux
+F_SETPIPE_SZ: Optional[int] = getattr(fcntl, 'F_SETPIPE_SZ', 1031 if sys.platform.startswith('linux') else None)
+
+# Maximum number of buffers per os.writev() call. 1024 on Linux and macOS,
+# which is also what is assumed if the system does not say.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX < 1:
+    IOV_MAX = 1024
+
+# Command line options of opustrainer.shuffle for the keyword arguments of
+# `shuffle_files()` that DatasetReader uses.
+SHUFFLE_OPTIONS = {
+    'no_shuffle': '--no-shuffle',
+    'tmpdir': '--temporary-directory',
+    'algorithm': '--algorithm',
+    'buffer_size': '--buffer-size',
+    'shard_window': '--shard-window',
+    'sample': '--sample',
+    'read_threads': '--read-threads',
+    'compression': '--compress',
+    'use_numpy': '--numpy',
+    'memory_limit': '--memory-limit',
+    'threads': '--threads',
+    'processes': '--processes',
+}
+
+
 @dataclass(frozen=True)
 class Dataset:
     name: str
     files: List[str]
+    # How the dataset is shuffled each epoch, one of SHUFFLE_POLICIES
+    shuffle: str = 'full'
+    # Size of the buffer for the 'buffer' shuffle policy, in lines
+    shuffle_buffer: Optional[int] = None
+    # Shuffle the order of the files, and then the lines of each this many
+    # files together (see `opustrainer.shuffle.shard_shuffle`)
+    shard_window: Optional[int] = None
+    # Make each epoch a fresh random sample of this many lines, or of this
+    # fraction of the lines if it is a float.
+    sample: Optional[Union[int,float]] = None
+    # Number of epochs AsyncDatasetReader shuffles in advance. Defaults to 1.
+    lookahead: Optional[int] = None
 
 
 @dataclass(frozen=True)
@@ -62,6 +133,13 @@ class DatasetState:
     seed: int
     line: int
     epoch: int
+    # Number of lines of the shuffled file read so far, including lines that
+    # were skipped for being invalid. Lets restore() seek instead of reading
+    # `line` lines. None if unknown, e.g. for state files of older versions.
+    position: Optional[int] = None
+    # Number of parts of the line at `position` that were read already, if it
+    # was split at carriage returns (see `split_block()`).
+    part: int = 0
 
 
 @dataclass(frozen=True)
@@ -115,6 +193,50 @@ class TrainerState:
     datasets: Dict[str,DatasetState]
 
 
+def shuffle_error(proc:Union[subprocess.Popen, ShuffleThread]) -> BaseException:
+    """The error of a shuffle that failed. Threads failed with an exception of
+    their own, subprocesses only with their exit status."""
+    if isinstance(proc, ShuffleThread):
+        return proc.exception or RuntimeError('shuffle was stopped')
+    return subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def decompressed_size(files:Iterable[str]) -> int:
+    """Estimated size in bytes of the lines of `files` once decompressed.
+    Compressed files count for COMPRESSION_RATIO times their size."""
+    return sum(
+        os.path.getsize(file) * (COMPRESSION_RATIO if os.path.splitext(file)[1] in DECOMPRESSORS else 1)
+        for file in files)
+
+
+def split_block(lines:List[bytes], positions:Sequence[int]) -> Tuple[List[bytes], List[int]]:
+    """Splits the lines of a block at carriage returns, see
+    `split_carriage_returns()`. The parts of a line keep its position, which
+    counts lines the way the shuffler does. `DatasetState.part` tells them
+    apart."""
+    split: List[bytes] = []
+    split_positions: List[int] = []
+    for line, position in zip(lines, positions):
+        if b'\r' in line:
+            parts = split_carriage_returns(line)
+            split.extend(parts)
+            split_positions.extend([position] * len(parts))
+        else:
+            split.append(line)
+            split_positions.append(position)
+    return split, split_positions
+
+
+@dataclass(frozen=True)
+class ShuffledFile:
+    seed: int
+    proc: Optional[Union[subprocess.Popen, ShuffleThread]] # None if the file was written by an earlier run
+    file: BinaryIO
+    offsets: Optional[BinaryIO] # None if the file is a pipe
+    persisted: Optional[EpochFile] = None
+    order: Optional[Sequence[int]] = None # Set if the file reads a corpus in this order
+
+
 class DatasetReader:
     """Repeats, shuffles and reads a dataset ad infinitum."""
     dataset: Dataset
@@ -123,14 +245,38 @@ class DatasetReader:
     epoch: int
     shuffle: bool
     num_fields: Optional[int]
+    cache: bool
+    algorithm: str
+    persist: bool
+    stream: bool
+    read_threads: int
+    in_process: bool
 
     tmpdir: Optional[str]
 
-    _fh: Optional[TextIO] = None
-    _next_line: str
+    # Shuffle policy, which is the dataset's, unless it is small enough to
+    # shuffle in memory. See `SHUFFLE_POLICIES`.
+    _policy: str
+
+    _fh: Optional[BinaryIO] = None
+    _offsets: Optional[BinaryIO] = None
+    _block: Sequence[bytes] = () # Valid lines read ahead from _fh
+    _block_positions: Sequence[int] = () # Their position in _fh, counting invalid lines
+    _block_index: int = 0 # Next line of _block to return
+    _lines_read: int = 0
+    _cache: Optional[CorpusCache] = None
+    _persisted: Optional[EpochFile] = None
+    _proc: Optional[Union[subprocess.Popen, ShuffleThread]] = None
+    _corpus: Optional[IndexedCorpus] = None
+    _order: Optional[Sequence[int]] = None
+    _epoch_lines: Optional[int] = None # Lines in the last epoch, see `remaining()`
+    _resume: Optional[DatasetState] = None # Restored, but not read from yet
 
     def __init__(self, dataset:Dataset, seed:int, tmpdir:Optional[str]=None, shuffle:bool=True,
-                 num_fields:Optional[int]=None):
+                 num_fields:Optional[int]=None, cache:bool=False, algorithm:str='merge', persist:bool=False,
+                 stream:bool=False, read_threads:int=1, memory_threshold:Optional[int]=None, in_process:bool=False,
+                 compression:str='none', use_numpy:bool=False, memory_limit:Optional[int]=None, threads:int=0,
+                 processes:bool=False):
         """
         Parameters
         ----------
@@ -145,6 +291,47 @@ class DatasetReader:
         num_fields: int, optional
             Optionally specify the number of fields each line should have. Trim to the required number if they are
             more than the necessary fields, or remove lines that don't have the required number of fields.
+        cache : bool
+            Keep a decompressed and validated copy of the dataset in `tmpdir` and read from that instead of from
+            the dataset files. The copy is reused across epochs and restarts. Disabled by default. Ignored for
+            datasets with a `shard_window`, as their shards are shuffled separately.
+        algorithm : str
+            Shuffle algorithm used by `opustrainer.shuffle`, either 'merge' (default) or 'scatter'.
+        persist : bool
+            Write shuffled epochs to named files in `tmpdir` instead of anonymous temporary files, so that after
+            a restart they can be read again instead of shuffling again. Each is deleted once it has been read
+            completely, when a restored reader is already past it, or when the reader is closed with `discard`.
+            Disabled by default.
+        stream : bool
+            Read the shuffled dataset from a pipe while the shuffler is still writing it, instead of from a file
+            once it is done. Lines are available sooner and the shuffled copy is never written to disk, but
+            restoring has to read up to the position instead of seeking. Cannot be combined with `persist`.
+            Datasets with a `shuffle_buffer` are always streamed.
+        read_threads : int
+            Number of files of the dataset that are read and decompressed concurrently. Defaults to 1.
+        memory_threshold : int, optional
+            Datasets that are fully shuffled and whose lines take up at most this many bytes once decompressed
+            (see `decompressed_size()`) are kept in memory and shuffled there instead, as if they had
+            `shuffle: memory`. Disabled by default.
+        in_process : bool
+            Shuffle in a thread of this process instead of in an `opustrainer.shuffle` subprocess. That saves
+            starting a new interpreter every epoch, but the shuffle then shares the GIL with the trainer.
+            Disabled by default.
+        compression : str
+            Compression of the temporary chunk files of the 'merge' algorithm, one of `opustrainer.shuffle.CODECS`
+            or 'auto'. Saves disk space and I/O in `tmpdir` at the cost of CPU. Defaults to 'none'.
+        use_numpy : bool
+            Draw the random keys of the 'merge' algorithm and sort its chunks with NumPy, which is much faster.
+            The order for a seed differs from the one without. Disabled by default.
+        memory_limit : int, optional
+            Size the chunks of the 'merge' algorithm so that they take up at most this many bytes of memory
+            together, instead of a fixed number of lines each, and merge them within that as well. No limit by
+            default.
+        threads : int
+            Number of threads that sort the chunks of the 'merge' algorithm while the next is read. Defaults to
+            0, sorting them in between reading.
+        processes : bool
+            Sort the chunks in `threads` worker processes instead of threads. Disabled by default.
         """
         self.dataset = dataset
         self.seed = seed
@@ -153,190 +340,600 @@ class DatasetReader:
         self.line = 0
         self.shuffle = shuffle
         self.num_fields = num_fields
+        self.cache = cache and dataset.shard_window is None
+        self.algorithm = algorithm
+        self.persist = persist
+        self.stream = stream
+        self.read_threads = read_threads
+        self.in_process = in_process
+        self.compression = compression
+        self.use_numpy = use_numpy
+        self.memory_limit = memory_limit
+        self.threads = threads
+        self.processes = processes
+
+        self._policy = dataset.shuffle
+        if memory_threshold is not None and self._policy == 'full' and dataset.shard_window is None \
+            and decompressed_size(dataset.files) <= memory_threshold:
+            logger.log_once(f"Keeping {dataset.name} in memory")
+            self._policy = 'memory'
+
+        if persist and stream:
+            raise ValueError('Shuffled datasets cannot be both persisted and streamed')
 
     def state(self) -> DatasetState:
-        return DatasetState(self.seed, self.line, self.epoch)
+        if self._resume is not None:
+            return self._resume
+
+        # Position is only meaningful while reading from a shuffled file
+        position, part = self._next_position() if self._fh is not None and not self._fh.closed else (None, 0)
+        return DatasetState(self.seed, self.line, self.epoch, position, part)
 
     def restore(self, state:DatasetState) -> 'DatasetReader':
+        """Continue from `state`. The dataset is only shuffled and read up to
+        where it left off once a line is read, so restoring is cheap, and
+        datasets that are not read from yet cost nothing."""
         self.close()
 
         self.seed = state.seed
         self.epoch = state.epoch
+        self.line = state.line
+        self._resume = state
 
-        # Skip forward
-        for _ in range(state.line):
-            next(self)
+        # Epochs an earlier run persisted that have been read since
+        if self.persist:
+            self._epoch_file(state.seed).remove_earlier()
 
         return self
 
-    def close(self):
+    def prepare(self) -> None:
+        """Get ready to read, e.g. by starting to shuffle, without waiting for
+        it. Readers that shuffle synchronously do nothing until they are read."""
+        pass
+
+    def _apply_resume(self) -> None:
+        """Actually continue from the state given to `restore()`."""
+        assert self._resume is not None
+        state, self._resume = self._resume, None
+
+        if state.position is not None and state.line > 0:
+            # Jump straight to where we left off
+            self._open()
+            self._seek(state.position)
+            # Skip the parts of a line split at carriage returns read already
+            self._block_index += state.part
+            self.line = state.line
+        else:
+            # Skip forward
+            self.line = 0
+            for _ in range(state.line):
+                next(self)
+
+    def close(self, *, discard:bool=False):
+        """Stop reading and shuffling. Persisted epochs are kept for the next
+        run to continue from, unless `discard` is set."""
+        if self._proc:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
         if self._fh:
             self._fh.close()
-
-    def _open(self):
-        logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
-        # Open temporary file which will contain shuffled version of `cat self.files`
-        fh = TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
-
-        # Shuffle data to the temporary file.
-        # TODO: With the reimplementation of shuffle.py, it is technically
-        # feasible to just write to a named pipe (or even stdout) instead of
-        # a temporary file, and let the trainer read directly from that. Not 
-        # sure if that has any performance or stability benefits/drawbacks.
-        subprocess.check_call([sys.executable,
+        if self._persisted is not None and discard:
+            self._persisted.remove()
+            self._persisted = None
+        if self._offsets:
+            self._offsets.close()
+        if self._corpus is not None:
+            self._corpus.close()
+            self._corpus = None
+
+    def remaining(self) -> Optional[int]:
+        """Estimated number of lines left in the current epoch, counting invalid
+        lines as well. Based on the length of the previous epoch, so None
+        during the first, unless the lines are read from a corpus."""
+        if self._epoch_lines is None:
+            return None
+        return max(self._epoch_lines - self._lines_read, 0)
+
+    def _get_cache(self) -> CorpusCache:
+        """Returns the cached copy of the dataset, building it if necessary."""
+        if self._cache is None:
+            cache = CorpusCache(self.dataset.files, tmpdir=self.tmpdir, num_fields=self.num_fields)
+            if not cache.exists():
+                logger.log(f"Caching {self.dataset.name} to {cache.path}")
+                cache.build(self._validate)
+            self._cache = cache
+        return self._cache
+
+    def _files(self) -> List[str]:
+        """Files to read the dataset from"""
+        if self.cache:
+            return [self._get_cache().path]
+        else:
+            return self.dataset.files
+
+    def _shuffle_size(self) -> Tuple[int, int]:
+        """Estimated size in bytes of the file a shuffle writes to `tmpdir`,
+        and of the temporary files it writes there too while it runs. Both
+        hold the decompressed lines, so compressed dataset files count for
+        COMPRESSION_RATIO times their size. The cache is decompressed already."""
+        if self._policy in ('memory', 'none', 'buffer'):
+            return 0, 0
+        size = decompressed_size(self._files())
+        # The merge and scatter algorithms write all lines to chunk files first
+        options = self._shuffle_options()
+        scratch = size if not options.get('no_shuffle') and options['algorithm'] in ('merge', 'scatter') else 0
+        return (0 if self.stream else size), scratch
+
+    def _shuffle_command(self, seed:int, fileno:Optional[int], offsets_fileno:Optional[int]=None) -> List[str]:
+        """Command that writes the shuffled dataset for `seed` to `fileno`, or
+        to stdout if it is None, and optionally a sparse index of its line
+        offsets to `offsets_fileno`."""
+        options: List[str] = []
+        for key, value in self._shuffle_options().items():
+            options += [SHUFFLE_OPTIONS[key]] if value is True else [SHUFFLE_OPTIONS[key], str(value)]
+        return [sys.executable,
             '-m', 'opustrainer.shuffle',
-            *(['--temporary-directory', self.tmpdir] if self.tmpdir else []),
-            *([] if self.shuffle else ['--no-shuffle']),
-            str(self.seed),
-            f'/dev/fd/{fh.fileno()}',
-            *self.dataset.files
-        ], pass_fds=(fh.fileno(),))
+            *options,
+            *(['--offsets', f'/dev/fd/{offsets_fileno}'] if offsets_fileno is not None else []),
+            str(seed),
+            f'/dev/fd/{fileno}' if fileno is not None else '-',
+            *self._files()
+        ]
+
+    def _shuffle_options(self) -> Dict[str, Any]:
+        """Keyword arguments for `shuffle_files()` that differ from its
+        defaults. See `SHUFFLE_OPTIONS` for their command line equivalents."""
+        options: Dict[str, Any] = {}
+        if self.tmpdir:
+            options['tmpdir'] = self.tmpdir
+        if not self.shuffle:
+            options['no_shuffle'] = True
+        if self._policy == 'buffer':
+            options['algorithm'] = 'buffer'
+            if self.dataset.shuffle_buffer is not None:
+                options['buffer_size'] = self.dataset.shuffle_buffer
+        elif self.dataset.shard_window is not None:
+            options['algorithm'] = 'shards'
+            options['shard_window'] = self.dataset.shard_window
+        else:
+            options['algorithm'] = self.algorithm
+        if self.dataset.sample is not None:
+            options['sample'] = self.dataset.sample
+        if self.read_threads > 1:
+            options['read_threads'] = self.read_threads
+        if self.compression != 'none':
+            options['compression'] = self.compression
+        if self.use_numpy:
+            options['use_numpy'] = True
+        if self.memory_limit is not None:
+            options['memory_limit'] = self.memory_limit
+        if self.threads > 0:
+            options['threads'] = self.threads
+        if self.processes:
+            options['processes'] = True
+        return options
+
+    def _spawn_shuffle(self, seed:int, fileno:Optional[int], offsets_fileno:Optional[int]=None) -> Union[subprocess.Popen, ShuffleThread]:
+        """Start shuffling the dataset for `seed` into `fileno`, or into a pipe
+        if it is None. See `_shuffle_command()`. With `in_process` the shuffle
+        runs in a thread instead of a subprocess."""
+        if self.in_process:
+            stop = Event()
+            lines = shuffle_files(self._files(), seed, stop=stop, **self._shuffle_options())
+            thread = ShuffleThread(lines, fileno, offsets_fileno, stop=stop)
+            thread.start()
+            return thread
+        elif fileno is None:
+            return subprocess.Popen(self._shuffle_command(seed, None), stdout=subprocess.PIPE)
+        else:
+            assert offsets_fileno is not None
+            return subprocess.Popen(self._shuffle_command(seed, fileno, offsets_fileno), pass_fds=(fileno, offsets_fileno))
+
+    def _get_corpus(self) -> IndexedCorpus:
+        """Random access to the lines of the dataset. For the `memory` shuffle
+        policy they are read into memory. Otherwise the files are memory-mapped,
+        which only works for uncompressed files (or the cache)."""
+        if self._corpus is None:
+            if self._policy == 'memory':
+                self._corpus = IndexedCorpus.read(self._files(), threads=self.read_threads)
+            elif self.cache:
+                # Use the decompressed copy and the index that comes with it
+                cache = self._get_cache()
+                self._corpus = IndexedCorpus([cache.path], [cache.index()])
+            else:
+                compressed = [file for file in self.dataset.files if os.path.splitext(file)[1] in DECOMPRESSORS]
+                if compressed:
+                    raise ValueError(f"Dataset '{self.dataset.name}' cannot be read through an index because it has compressed files: {compressed} (use --cache)")
+                self._corpus = IndexedCorpus(self.dataset.files)
+        return self._corpus
+
+    def _read_order(self, order:Sequence[int]) -> BinaryIO:
+        """File object that reads the lines of the corpus in `order`."""
+        assert self._corpus is not None
+        return cast(BinaryIO, io.BufferedReader(IndexedReader(self._corpus, order)))
+
+    def _shuffle_corpus(self, seed:int) -> ShuffledFile:
+        """Shuffle the dataset by only shuffling the order in which its lines
+        are read from the corpus."""
+        corpus = self._get_corpus()
+
+        order: Sequence[int]
+        if self.shuffle and self._policy != 'none':
+            order = shuffled_order(len(corpus), seed)
+        else:
+            order = range(len(corpus))
+
+        # The start of a random permutation is as good a sample as any
+        if isinstance(self.dataset.sample, float):
+            order = order[:round(self.dataset.sample * len(order))]
+        elif self.dataset.sample is not None:
+            order = order[:self.dataset.sample]
+
+        return ShuffledFile(seed=seed, proc=None, file=self._read_order(order), offsets=None, order=order)
+
+    def _start_shuffle(self, seed:int) -> ShuffledFile:
+        """Start writing the shuffled dataset for `seed` to a file. With
+        `persist`, a file written by an earlier run is reused instead."""
+        if self._policy == 'memory':
+            return self._shuffle_corpus(seed)
+
+        # Already shuffled, so read it straight from the dataset files
+        if self._policy == 'none':
+            lines = read_files(self._files(), threads=self.read_threads)
+            file = cast(BinaryIO, io.BufferedReader(LineReader(lines)))
+            return ShuffledFile(seed=seed, proc=None, file=file, offsets=None)
+
+        # Shuffling through a buffer is meant to not need any temporary files,
+        # so there is no point in writing its output to one.
+        if self.stream or self._policy == 'buffer':
+            proc = self._spawn_shuffle(seed, None)
+            assert proc.stdout is not None
+            return ShuffledFile(seed=seed, proc=proc, file=cast(BinaryIO, proc.stdout), offsets=None)
+
+        persisted = None
+        if self.persist:
+            persisted = self._epoch_file(seed)
+            if persisted.exists():
+                logger.log(f"Reusing shuffled {self.dataset.name} for seed {seed} from {persisted.path}")
+                fh, offsets = persisted.open()
+                return ShuffledFile(seed=seed, proc=None, file=fh, offsets=offsets, persisted=persisted)
+            fh, offsets = persisted.create()
+        else:
+            # Open temporary file which will contain shuffled version of `cat self.files`
+            fh = cast(BinaryIO, TemporaryFile(mode='w+b', dir=self.tmpdir))
+            offsets = cast(BinaryIO, TemporaryFile(mode='w+b', dir=self.tmpdir))
+
+        # Shuffle data to the temporary file. (See `stream` for reading it
+        # through a pipe instead.)
+        proc = self._spawn_shuffle(seed, fh.fileno(), offsets.fileno())
+        return ShuffledFile(seed=seed, proc=proc, file=fh, offsets=offsets, persisted=persisted)
+
+    def _epoch_file(self, seed:int) -> EpochFile:
+        """Named file for the shuffled epoch of `seed`, see `persist`. With
+        `cache` the epoch is shuffled from the cache, which is identified by
+        the dataset files and the settings it was built with, so it does not
+        have to exist yet."""
+        return EpochFile(self.dataset.files, seed, tmpdir=self.tmpdir,
+            settings=(self.dataset.name, self.shuffle, self.algorithm, self.dataset.sample,
+                self.dataset.shard_window, self.dataset.shuffle_buffer,
+                (CorpusCache.VERSION, self.num_fields) if self.cache else None,
+                # With NumPy the order also depends on how lines are chunked
+                (self.memory_limit,) if self.use_numpy else None))
+
+    def _stop_shuffle(self, shuffled:ShuffledFile, *, discard:bool=False) -> None:
+        """Abort a shuffle started by `_start_shuffle()` and clean up. A
+        persisted shuffle that already finished is kept for the next run,
+        unless `discard` is set."""
+        if shuffled.proc is not None:
+            finished = shuffled.proc.poll() == 0
+            shuffled.proc.kill()
+            shuffled.proc.wait()
+            if shuffled.persisted is not None and finished and not discard:
+                shuffled.persisted.commit()
+            elif shuffled.persisted is not None:
+                shuffled.persisted.discard()
+        if shuffled.persisted is not None and discard:
+            shuffled.persisted.remove()
+        shuffled.file.close()
+        if shuffled.offsets is not None:
+            shuffled.offsets.close()
+
+    def _read_shuffled(self, shuffled:ShuffledFile) -> None:
+        """Wait for the shuffle started by `_start_shuffle()` to finish, and
+        continue reading from its file. Streamed shuffles are read right away
+        and only checked once all lines have been read. Time spent waiting for
+        a shuffle that is still running, also for the first lines of a streamed
+        one, is logged."""
+        running = shuffled.proc is not None and shuffled.proc.poll() is None
+        start = time.monotonic()
+
+        if shuffled.offsets is None:
+            self._proc = shuffled.proc
+        elif shuffled.proc is not None:
+            if shuffled.proc.wait() != 0:
+                self._stop_shuffle(shuffled)
+                raise shuffle_error(shuffled.proc)
+            if shuffled.persisted is not None:
+                shuffled.persisted.commit()
 
         # Replace open file handle with this new file
-        self._fh = cast(TextIO, fh) # TODO: Not sure why TemporaryFile is an
-                                    # IO[str] according to typing, but seems
-                                    # to implement TextIO.
-        self._fh.seek(0)
+        assert self._fh is None or self._fh.closed
+        if self._offsets is not None:
+            self._offsets.close()
+        self._fh = shuffled.file
+        self._offsets = shuffled.offsets
+        self._persisted = shuffled.persisted
+        self._order = shuffled.order
+        if self._order is not None:
+            self._epoch_lines = len(self._order)
+
+        # Make sure we start reading from the start again
+        if self._offsets is not None:
+            self._fh.seek(0)
         self.line = 0
+        self._lines_read = 0
 
-        # Buffer the first line, also asserting that we're not reading an empty file.
-        try:
-            self._read_line()
-        except StopIteration:
+        # Buffer the first lines, also asserting that we're not reading an empty file.
+        if not self._read_block():
             raise RuntimeError('reading from empty shuffled file')
 
-    def _read_line(self) -> None:
-        try:
-            # Try to find the next non-empty line
-            while True:
-                self._next_line = self._fh.readline() # type: ignore # _fh can't be none.
-
-                # Empty return, not even a line ending, means EOF
-                if self._next_line == '':
-                    raise StopIteration
-
-                # We can't call the function inside the string format prior to python 3.12
-                # so we will have it here instead so that we can refer to it when logging if necessary.
-                original_line: str = self._next_line.rstrip('\r\n')
-
-                # Assert that the line is well formed, meaning non of the fields is the empty string
-                # If not, try to get a new line from the corpus
-                fields: List[str] = original_line.split('\t')
-                if any(field == '' for field in fields):
-                    logger.log_once(f"[Trainer] Empty field in {self.dataset.name} line: \"{original_line}\", skipping...", loglevel="WARNING")
-                    continue
-
-                # Try to see if we have the right number of fields and remove lines
-                # that don't have all the fields or remove extra fields.
-                if self.num_fields is not None:
-                    if len(fields) == self.num_fields:
-                        return
-                    elif len(fields) > self.num_fields:
-                        self._next_line = '\t'.join(fields[:self.num_fields]) + '\n'
-                        return
-                    elif len(fields) < self.num_fields:
-                        logger.log_once(f"[Trainer] Expected {self.num_fields} fields in {self.dataset.name} line: \"{original_line}\" but only got {len(fields)}, skipping...", loglevel="WARNING")
-                        continue
+        if running:
+            logger.log(f"Waited {time.monotonic() - start:.1f}s for the shuffle of {self.dataset.name} for epoch {self.epoch}")
 
-                return
-        except StopIteration:
-            self._fh.close() # type: ignore # _fh can't be none.
-            self.seed += 1
-            self.epoch += 1
+    def _open(self):
+        logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
+        self._read_shuffled(self._start_shuffle(self.seed))
+
+    def _validate(self, line:str) -> Optional[str]:
+        """Returns the line if it is well formed, trimmed to `num_fields` if
+        necessary, or `None` if it should be skipped."""
+        # We can't call the function inside the string format prior to python 3.12
+        # so we will have it here instead so that we can refer to it when logging if necessary.
+        original_line: str = line.rstrip('\r\n')
+
+        # Assert that the line is well formed, meaning non of the fields is the empty string
+        # If not, try to get a new line from the corpus
+        fields: List[str] = original_line.split('\t')
+        if any(field == '' for field in fields):
+            logger.log_once(f"[Trainer] Empty field in {self.dataset.name} line: \"{original_line}\", skipping...", loglevel="WARNING")
+            return None
 
-    def __iter__(self):
-        return self
+        # Try to see if we have the right number of fields and remove lines
+        # that don't have all the fields or remove extra fields.
+        if self.num_fields is not None:
+            if len(fields) > self.num_fields:
+                return '\t'.join(fields[:self.num_fields]) + '\n'
+            elif len(fields) < self.num_fields:
+                logger.log_once(f"[Trainer] Expected {self.num_fields} fields in {self.dataset.name} line: \"{original_line}\" but only got {len(fields)}, skipping...", loglevel="WARNING")
+                return None
 
-    def __next__(self) -> str:
-        if not self._fh or self._fh.closed:
-            self._open() # TODO: do we want to do this lazy? Yes, restore()
-                         # might be called twice right now and shuffling is
-                         # expensive.
+        return line
 
+    def _validate_block(self, lines:List[bytes], positions:Sequence[int]) -> Tuple[List[bytes], Sequence[int]]:
+        """Validates a block of lines read from the given positions of the file.
+        Returns the valid lines as `_validate()` would, and their positions.
+        Blocks in which all lines are valid as is, which is by far the most
+        common case, are recognised without looking at the lines one by one.
+        Raises UnicodeDecodeError if the block is not valid UTF-8."""
+        if self._is_valid_block(lines):
+            return lines, positions
+        validated = [self._validate(line.decode('utf-8')) for line in lines]
+        return (
+            [line.encode('utf-8') for line in validated if line is not None],
+            [position for position, line in zip(positions, validated) if line is not None])
+
+    def _is_valid_block(self, lines:List[bytes]) -> bool:
+        """Quick check whether none of the lines has empty fields, and all of
+        them have `num_fields` fields. False if not sure."""
+        block = b''.join(lines)
+
+        # The lines are passed on as bytes, but should still be text
+        block.decode('utf-8')
+
+        # `_read_block()` already split lines at carriage returns, but a stray
+        # one would hide an empty field from the checks below.
+        if b'\r' in block:
+            return False
+
+        # Empty fields (or lines) show up as two separators in a row, or one
+        # at the start or end.
+        if block.endswith(b'\n'):
+            block = block[:-1]
+        block = block.replace(b'\n', b'\t')
+        if block.startswith(b'\t') or block.endswith(b'\t') or b'\t\t' in block:
+            return False
+
+        if self.num_fields is not None:
+            tabs = list(map(methodcaller('count', b'\t'), lines))
+            return min(tabs) == max(tabs) == self.num_fields - 1
+
+        return True
+
+    def _seek(self, position:int) -> None:
+        """Continue reading the current shuffled file at line `position`,
+        counting invalid lines as well, using the offsets the shuffler wrote
+        next to it."""
         assert self._fh is not None
-        line = self._next_line
-        self.line += 1
+        if self._order is not None:
+            # Reading from a corpus, so just continue reading the order at `position`
+            self._fh.close()
+            self._fh = self._read_order(self._order[position:])
+            self._lines_read = position
+        elif self._offsets is not None:
+            self._offsets.seek(0)
+            offset, skip = SparseLineIndex.load(self._offsets).locate(position)
+            self._fh.seek(offset)
+            for _ in range(skip):
+                self._fh.readline()
+            self._lines_read = position
+        elif self._block_positions and position <= self._block_positions[-1]:
+            # Pipes can't seek, but this position has been read already
+            self._block_index = bisect_left(self._block_positions, position)
+            return
+        else:
+            # Pipes can't seek, but at least the lines don't need validating
+            for _ in range(position - self._lines_read):
+                self._fh.readline()
+            self._lines_read = max(position, self._lines_read)
+        self._read_block()
+
+    def _next_position(self) -> Tuple[int, int]:
+        """Position in the shuffled file of the line that is returned next, and
+        the number of parts of it returned already if it was split."""
+        if self._block_index < len(self._block):
+            position = self._block_positions[self._block_index]
+            return position, self._block_index - bisect_left(self._block_positions, position, 0, self._block_index)
+        return self._lines_read, 0
+
+    def _read_block(self) -> bool:
+        """Read the next block of valid lines. At the end of the file, moves on
+        to the next epoch and returns False."""
+        assert self._fh is not None
+        self._block_index = 0
+        while True:
+            lines = self._fh.readlines(READ_BLOCK_SIZE)
 
-        # Read next line into memory and test we're not at EOF
-        self._read_line()
+            # Not even a line ending means EOF
+            if not lines:
+                break
 
-        return line
+            start = self._lines_read
+            self._lines_read += len(lines)
+            positions: Sequence[int] = range(start, self._lines_read)
 
+            # Like text mode used to, also end lines at carriage returns
+            if b'\r' in b''.join(lines):
+                lines, positions = split_block(lines, positions)
 
-@dataclass(frozen=True)
-class ShuffledFile:
-    seed: int
-    proc: subprocess.Popen
-    file: TextIO
+            # Lines in the cache have already been validated
+            if self.cache:
+                self._block, self._block_positions = lines, positions
+            else:
+                self._block, self._block_positions = self._validate_block(lines, positions)
+
+            if self._block:
+                return True
+
+        self._block, self._block_positions = (), ()
+        self._fh.close()
+        self._epoch_lines = self._lines_read
+        self.seed += 1
+        self.epoch += 1
+
+        # A streamed shuffle might have failed half-way
+        if self._proc is not None:
+            proc, self._proc = self._proc, None
+            if proc.wait() != 0:
+                raise shuffle_error(proc)
+
+        # Finished epochs are no longer needed to resume from
+        if self._persisted is not None:
+            self._persisted.remove()
+            self._persisted = None
+
+        return False
+
+    def read_batch(self, size:int) -> List[str]:
+        """Returns the next `size` lines, continuing with the next epoch if
+        needed. Same as calling `next()` `size` times, but faster."""
+        return [line.decode('utf-8') for line in self.read_batch_bytes(size)]
+
+    def read_batch_bytes(self, size:int) -> List[bytes]:
+        """Same as `read_batch()`, but returns the lines as UTF-8 encoded
+        bytes, the way they were read from the shuffled file."""
+        batch: List[bytes] = []
+        while len(batch) < size:
+            if self._resume is not None:
+                self._apply_resume()
+
+            if not self._fh or self._fh.closed:
+                self._open()
+
+            lines = self._block[self._block_index:self._block_index + size - len(batch)]
+            batch.extend(lines)
+            self._block_index += len(lines)
+            self.line += len(lines)
+
+            # Read ahead to make sure we're not at EOF
+            if self._block_index == len(self._block):
+                self._read_block()
+        return batch
+
+    def __iter__(self):
+        return self
 
+    def __next__(self) -> str:
+        return self.read_batch(1)[0]
 
-class AsyncDatasetReader(DatasetReader):
-    _pending: Optional[ShuffledFile]
 
-    def __init__(self, *args, **kwargs):
-        self._pending = None
+class AsyncDatasetReader(DatasetReader):
+    """Reader that starts shuffling the next epoch, or the next `lookahead`
+    epochs of the dataset, as soon as it starts reading the current one. With
+    a `scheduler` they are started once the scheduler gets to them instead."""
+    scheduler: Optional['ShuffleScheduler']
+    lookahead: int
+
+    _pending: Deque[ShuffledFile] # Started shuffles of the next epochs, in order
+    _pending_seeds: Deque[int] # Seeds of the epochs after those, waiting for the scheduler
+
+    def __init__(self, *args, scheduler:Optional['ShuffleScheduler']=None, **kwargs):
+        self.scheduler = scheduler
+        self._pending = deque()
+        self._pending_seeds = deque()
         super().__init__(*args, **kwargs)
+        self.lookahead = self.dataset.lookahead or 1
 
     def _open_async(self, seed:int):
-        # Open temporary file which will contain shuffled version of `cat self.files`
-        fh = TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
-
-        self._pending = ShuffledFile(
-            seed=seed,
-            file=cast(TextIO, fh),
-            proc=subprocess.Popen([sys.executable,
-                '-m', 'opustrainer.shuffle',
-                *(['--temporary-directory', self.tmpdir] if self.tmpdir else []),
-                *([] if self.shuffle else ['--no-shuffle']),
-                str(seed),
-                f'/dev/fd/{fh.fileno()}',
-                *self.dataset.files
-            ], pass_fds=(fh.fileno(),))
-        )
+        if self.scheduler is None:
+            self._pending.append(self._start_shuffle(seed))
+        else:
+            self._pending_seeds.append(seed)
+            self.scheduler.submit(self)
 
-    def _kill_async(self):
-        if self._pending is None:
-            return
+    def prepare(self) -> None:
+        """Start shuffling the epoch that is read next if it is not being read
+        already, so that the first read does not have to wait for all of it."""
+        if (self._fh is None or self._fh.closed) and not self._pending and not self._pending_seeds:
+            self._open_async(self.seed)
+
+    def _start_pending(self) -> ShuffledFile:
+        """Start the first shuffle the scheduler held back."""
+        shuffled = self._start_shuffle(self._pending_seeds.popleft())
+        self._pending.append(shuffled)
+        return shuffled
 
-        self._pending.proc.kill()
-        self._pending.proc.wait()
-        self._pending.file.close()
-        self._pending = None
+    def _kill_async(self, *, discard:bool=False):
+        if self.scheduler is not None:
+            self.scheduler.release(self)
+        self._pending_seeds.clear()
+
+        while self._pending:
+            self._stop_shuffle(self._pending.popleft(), discard=discard)
 
     def _open(self):
         logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
 
-        # First time self._pending is None, but all subsequent calls to _open
-        # should have self._pending be set.
-        if self._pending is None:
-            self._open_async(self.seed)
+        # First time there is nothing pending. Later only if the scheduler has
+        # not started it yet, but it is needed right now.
+        if not self._pending:
+            self._kill_async()
+            self._pending.append(self._start_shuffle(self.seed))
 
         # Assume shuffling has started
-        assert self._pending is not None
-        assert self._pending.seed == self.seed
+        pending = self._pending.popleft()
+        assert pending.seed == self.seed
+        if self.scheduler is not None:
+            self.scheduler.release(self, pending)
 
         # Wait for that to finish (hopefully it already has since it was likely
-        # started last iteration)
-        self._pending.proc.wait()
-        assert self._pending.proc.returncode == 0
-
-        # Swap out the current _fh for the newly prepared one
-        assert self._fh is None or self._fh.closed
-        self._fh = self._pending.file
-        self._pending = None
+        # started epochs ago) and swap out the current _fh for it
+        self._read_shuffled(pending)
 
-        # Make sure we start reading from the start again
-        self._fh.seek(0)
-        self.line = 0
-
-        # Buffer the first line, also asserting that we're not reading an empty file.
-        try:
-            self._read_line()
-        except StopIteration:
-            raise RuntimeError('reading from empty shuffled file')
-
-        # Start shuffling next
-        self._open_async(self.seed + 1)
+        # Start shuffling the next epochs
+        ahead = len(self._pending) + len(self._pending_seeds)
+        for seed in range(self.seed + 1 + ahead, self.seed + 1 + self.lookahead):
+            self._open_async(seed)
 
     def restore(self, state:DatasetState) -> 'AsyncDatasetReader':
         # Note: super().restore() will call close(), which will stop any
@@ -344,9 +941,106 @@ class AsyncDatasetReader(DatasetReader):
         # TODO: Once PEP 673 is available, we can remove this overload entirely.
         return cast('AsyncDatasetReader', super().restore(state))
 
-    def close(self):
-        self._kill_async()
-        super().close()
+    def close(self, *, discard:bool=False):
+        self._kill_async(discard=discard)
+        super().close(discard=discard)
+
+
+class ShuffleScheduler:
+    """Decides when the readers of a trainer start shuffling their next epoch
+    in the background. At most `max_shuffles` shuffles run at the same time,
+    and the shuffled files that have not been read yet, together with the
+    temporary files of the shuffles that are still running, take up at most
+    `max_disk` bytes, as estimated by `DatasetReader._shuffle_size()`. Waiting readers go in order of how
+    soon they run out of lines: the lines left in their epoch divided by their
+    weight in the current stage. A reader that runs out before its turn
+    doesn't wait for it but starts its shuffle right away.
+
+    Waiting shuffles are started by `update()`, which the trainer calls
+    every batch, and whenever a started shuffle is read or cancelled.
+    """
+    max_shuffles: Optional[int]
+    max_disk: Optional[int]
+
+    # Weight of each dataset in the current stage
+    weights: Dict[str, float]
+
+    # Both with the estimated size in bytes of a shuffled file, and of the
+    # temporary files of its shuffle
+    _waiting: Dict[AsyncDatasetReader, Tuple[int, int]]
+    _started: List[Tuple[AsyncDatasetReader, ShuffledFile, int, int]]
+
+    def __init__(self, max_shuffles:Optional[int]=None, max_disk:Optional[int]=None):
+        self.max_shuffles = max_shuffles
+        self.max_disk = max_disk
+        self.weights = {}
+        self._waiting = {}
+        self._started = []
+
+    def submit(self, reader:AsyncDatasetReader) -> None:
+        """Queue the next shuffle of `reader`. Its shuffles are started one
+        after the other."""
+        self._waiting[reader] = reader._shuffle_size()
+
+    def release(self, reader:AsyncDatasetReader, shuffled:Optional[ShuffledFile]=None) -> None:
+        """Forget about the started shuffle `shuffled` of `reader` because it
+        is being read, or about all its shuffles because they were cancelled.
+        Frees up room for the next shuffle."""
+        if shuffled is None:
+            self._waiting.pop(reader, None)
+        started = len(self._started)
+        self._started = [
+            entry for entry in self._started
+            if entry[0] is not reader or (shuffled is not None and entry[1] is not shuffled)
+        ]
+        if len(self._started) < started:
+            self.update()
+
+    def update(self) -> None:
+        """Start as many waiting shuffles as there is room for."""
+        running = 0
+        disk = 0
+        for _, shuffled, size, scratch in self._started:
+            disk += size
+            # Temporary files are removed once the shuffle is done
+            if shuffled.proc is not None and shuffled.proc.poll() is None:
+                running += 1
+                disk += scratch
+        for reader in sorted(self._waiting, key=self._priority):
+            size, scratch = self._waiting[reader]
+            if self.max_shuffles is not None and running >= self.max_shuffles:
+                break
+            # Always allow one, however big, or it would never start
+            if self.max_disk is not None and self._started and disk + size + scratch > self.max_disk:
+                break
+            self._started.append((reader, reader._start_pending(), size, scratch))
+            if not reader._pending_seeds:
+                del self._waiting[reader]
+            running += 1
+            disk += size + scratch
+
+    def _priority(self, reader:AsyncDatasetReader) -> Tuple[float, float]:
+        """Sort key: time until `reader` runs out of the epochs it already
+        has shuffles for, in batches, most urgent first. Datasets not in the
+        current stage go last, and without an estimate a dataset is assumed to
+        run out soon."""
+        weight = self.weights.get(reader.dataset.name, 0.0)
+        if weight <= 0:
+            return math.inf, 0.0
+        remaining = (reader.remaining() or 0) + len(reader._pending) * (reader._epoch_lines or 0)
+        return remaining / weight, -weight
+
+
+class IndexedDatasetReader(DatasetReader):
+    """Reader that, instead of writing a shuffled copy of the dataset each
+    epoch, indexes the line offsets of the dataset files once and only shuffles
+    that index. Lines are then read directly from the memory-mapped files.
+    Only works for uncompressed datasets.
+    """
+    def _open(self):
+        logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
+
+        self._read_shuffled(self._shuffle_corpus(self.seed))
 
 
 class StateLoader:
@@ -364,8 +1058,8 @@ class StateLoader:
             random_state=ymldata['random_state'],
             epoch_tracker_state=ymldata['epoch_tracker_state'],
             datasets={
-                dataset_name: DatasetState(int(seed), int(line), int(epoch))
-                for dataset_name, [seed, line, epoch] in ymldata['datasets'].items()
+                dataset_name: DatasetState(*map(int, dataset_state))
+                for dataset_name, dataset_state in ymldata['datasets'].items()
             }
         )
 
@@ -375,7 +1069,7 @@ class StateLoader:
             'random_state': state.random_state,
             'epoch_tracker_state': state.epoch_tracker_state,
             'datasets': {
-                dataset_name: [state.seed, state.line, state.epoch] #TODO: why a tuple, why not a dict? Isn't a dict more forward compatible?
+                dataset_name: [state.seed, state.line, state.epoch] + ([state.position] if state.position is not None else []) + ([state.part] if state.part else []) #TODO: why a tuple, why not a dict? Isn't a dict more forward compatible?
                 for dataset_name, state in state.datasets.items()
             }
         }, fh, allow_unicode=True, sort_keys=False) #TODO: is safe_dump not sufficient?
@@ -414,13 +1108,100 @@ class CurriculumV1Loader:
         ```yml
         datasets:
           clean: path/to/clean.gz
+          crawled:
+            path: path/to/crawled.gz
+            shuffle_buffer: 1000000
+          sharded:
+            path: path/to/shards/*.gz
+            shard_window: 4
+          large:
+            path: path/to/large.gz
+            sample: 1000000
+          preshuffled:
+            path: path/to/preshuffled.gz
+            shuffle: none
+          small:
+            path: path/to/small.gz
+            lookahead: 3
         ```
         """
         return {
-            name: Dataset(name, [os.path.join(basepath, filepath)])
-            for name, filepath in ymldata['datasets'].items()
+            name: self._load_dataset(name, entry, basepath)
+            for name, entry in ymldata['datasets'].items()
         }
 
+    def _load_dataset(self, name:str, entry:Union[str,List[str],dict], basepath:str) -> Dataset:
+        if not isinstance(entry, dict):
+            return Dataset(name, self._load_paths(name, entry, basepath))
+
+        if 'path' not in entry:
+            raise CurriculumLoaderError(f"dataset '{name}' should be a path, or a mapping with at least a path")
+
+        unknown = set(entry.keys()) - {'path', 'shuffle', 'shuffle_buffer', 'shard_window', 'sample', 'lookahead'}
+        if unknown:
+            raise CurriculumLoaderError(f"dataset '{name}' has unknown options: {', '.join(sorted(unknown))}")
+
+        options: Dict[str,Any] = {}
+        for option in ['shuffle_buffer', 'shard_window', 'lookahead']:
+            try:
+                options[option] = int(entry[option]) if option in entry else None
+            except ValueError:
+                raise CurriculumLoaderError(f"could not convert the {option} of dataset '{name}' to int")
+
+        # A shuffle_buffer implies shuffling through a buffer. And `shuffle: no`
+        # or `shuffle: false` in yaml ends up as False.
+        shuffle = entry.get('shuffle', 'buffer' if options['shuffle_buffer'] is not None else 'full')
+        if isinstance(shuffle, bool):
+            shuffle = 'full' if shuffle else 'none'
+        if shuffle not in SHUFFLE_POLICIES:
+            raise CurriculumLoaderError(f"dataset '{name}' has shuffle '{shuffle}', expected one of: {', '.join(SHUFFLE_POLICIES)}")
+        options['shuffle'] = shuffle
+
+        if options['shuffle_buffer'] is not None and shuffle != 'buffer':
+            raise CurriculumLoaderError(f"dataset '{name}' has a shuffle_buffer, but does not shuffle through a buffer")
+
+        if options['shuffle_buffer'] is not None and options['shuffle_buffer'] < 1:
+            raise CurriculumLoaderError(f"dataset '{name}' has a shuffle_buffer of {options['shuffle_buffer']}, expected at least 1")
+
+        if options['shard_window'] is not None and shuffle != 'full':
+            raise CurriculumLoaderError(f"dataset '{name}' has a shard_window, which only works with the full shuffle")
+
+        if options['shard_window'] is not None and options['shard_window'] < 1:
+            raise CurriculumLoaderError(f"dataset '{name}' has a shard_window of {options['shard_window']}, expected at least 1")
+
+        if options['lookahead'] is not None and options['lookahead'] < 1:
+            raise CurriculumLoaderError(f"dataset '{name}' has a lookahead of {options['lookahead']}, expected at least 1")
+
+        if 'sample' in entry:
+            if options['shard_window'] is not None:
+                raise CurriculumLoaderError(f"dataset '{name}' can have either a sample or a shard_window, not both")
+            if shuffle == 'none':
+                raise CurriculumLoaderError(f"dataset '{name}' is not shuffled, so it cannot be sampled")
+            try:
+                options['sample'] = parse_sample(str(entry['sample']))
+            except ValueError as exc:
+                raise CurriculumLoaderError(f"could not parse the sample of dataset '{name}': {exc!s}")
+
+        return Dataset(name, self._load_paths(name, entry['path'], basepath), **options)
+
+    def _load_paths(self, name:str, paths:Union[str,List[str]], basepath:str) -> List[str]:
+        """Reads a path or a list of paths, any of which can be a glob pattern
+        matching multiple files (e.g. shards of the dataset)."""
+        if isinstance(paths, str):
+            paths = [paths]
+
+        files: List[str] = []
+        for path in paths:
+            path = os.path.join(basepath, path)
+            if glob.has_magic(path):
+                matches = sorted(glob.glob(path))
+                if not matches:
+                    raise CurriculumLoaderError(f"dataset '{name}' has no files matching '{path}'")
+                files.extend(matches)
+            else:
+                files.append(path)
+        return files
+
     def _load_stage_order(self, ymldata:dict) -> List[str]:
         """Reads
         ```yaml
@@ -628,21 +1409,70 @@ class Trainer:
     tmpdir:Optional[str]
     # For debugging purposes, whether to shuffle or not
     shuffle:bool
+    # Whether to read datasets through a decompressed and validated cache
+    cache:bool
+    # Which algorithm opustrainer.shuffle uses
+    shuffle_algorithm:str
+    # Whether to keep shuffled epochs around for restarts
+    persist:bool
+    # Whether to read shuffled epochs while they are being shuffled
+    stream:bool
+    # Number of files per dataset read concurrently
+    read_threads:int
+    # Size in bytes under which datasets are shuffled in memory
+    memory_threshold:Optional[int]
+    # Whether to shuffle in threads instead of subprocesses
+    in_process:bool
+    # Compression of the temporary files of opustrainer.shuffle
+    shuffle_compression:str
+    # Whether opustrainer.shuffle uses NumPy
+    shuffle_numpy:bool
+    # Memory in bytes the chunks of a shuffle may take up
+    shuffle_memory_limit:Optional[int]
+    # Number of threads, or processes, that sort the chunks of a shuffle
+    shuffle_threads:int
+    shuffle_processes:bool
+
+    # Limits the shuffles running in the background, if any
+    scheduler:Optional[ShuffleScheduler]
+
+    # State after the last batch run() yielded, while it is reading ahead
+    _snapshot:Optional[TrainerState] = None
 
     # Reader class to use (I.e. DatasetReader or AsyncDatasetReader)
     _reader_impl: Type[DatasetReader]
 
     def __init__(self, curriculum:Curriculum, *, reader:Type[DatasetReader] = DatasetReader, \
-                 tmpdir:Optional[str]=None, shuffle:bool=True):
+                 tmpdir:Optional[str]=None, shuffle:bool=True, cache:bool=False, shuffle_algorithm:str='merge', persist:bool=False, stream:bool=False, read_threads:int=1, memory_threshold:Optional[int]=None, in_process:bool=False,
+                 max_shuffles:Optional[int]=None, max_shuffle_disk:Optional[int]=None, shuffle_compression:str='none',
+                 shuffle_numpy:bool=False, shuffle_memory_limit:Optional[int]=None, shuffle_threads:int=0, shuffle_processes:bool=False):
         self.curriculum = curriculum
         self.tmpdir = tmpdir
         self.shuffle = shuffle
+        self.cache = cache
+        self.shuffle_algorithm = shuffle_algorithm
+        self.persist = persist
+        self.stream = stream
+        self.read_threads = read_threads
+        self.memory_threshold = memory_threshold
+        self.in_process = in_process
+        self.shuffle_compression = shuffle_compression
+        self.shuffle_numpy = shuffle_numpy
+        self.shuffle_memory_limit = shuffle_memory_limit
+        self.shuffle_threads = shuffle_threads
+        self.shuffle_processes = shuffle_processes
         self._reader_impl = reader
+
+        self.scheduler = None
+        if (max_shuffles is not None or max_shuffle_disk is not None) and issubclass(reader, AsyncDatasetReader):
+            self.scheduler = ShuffleScheduler(max_shuffles, max_shuffle_disk)
+
+        self.readers = {}
         random.seed(self.curriculum.seed)
         first_stage_name = self.curriculum.stages_order[0]
 
-        #TODO: make sure this doesn't do too much work in case we call
-        # restore() manually anyway.
+        # Readers restore lazily, so this is cheap even if restore() is called
+        # again, e.g. by StateTracker.
         self.restore(TrainerState(
             stage=first_stage_name,
             random_state=random.getstate(),
@@ -654,19 +1484,42 @@ class Trainer:
         ))
 
     def restore(self, state:TrainerState):
+        # Stop the shuffles of the readers that are about to be replaced
+        self.close()
+        self._snapshot = None
+
         random.setstate(state.random_state)
         self.stage = self.curriculum.stages[state.stage]
         self.readers = {
             dataset.name: self._reader_impl(dataset, self.curriculum.seed,
                 tmpdir=self.tmpdir,
                 shuffle=self.shuffle,
-                num_fields=self.curriculum.num_fields
+                num_fields=self.curriculum.num_fields,
+                cache=self.cache,
+                algorithm=self.shuffle_algorithm,
+                persist=self.persist,
+                stream=self.stream,
+                read_threads=self.read_threads,
+                memory_threshold=self.memory_threshold,
+                in_process=self.in_process,
+                compression=self.shuffle_compression,
+                use_numpy=self.shuffle_numpy,
+                memory_limit=self.shuffle_memory_limit,
+                threads=self.shuffle_threads,
+                processes=self.shuffle_processes,
+                **({'scheduler': self.scheduler} if self.scheduler is not None else {})
             ).restore(state.datasets[dataset.name])
             for dataset in self.curriculum.datasets.values()
         }
         self.epoch_tracker = EpochTracker(self.readers[self.stage.until_dataset]).restore(state.epoch_tracker_state)
+        self._update_weights()
 
     def state(self) -> TrainerState:
+        if self._snapshot is not None:
+            return self._snapshot
+        return self._current_state()
+
+    def _current_state(self) -> TrainerState:
         return TrainerState(
             stage=self.stage.name if self.stage is not None else '',
             random_state=random.getstate(),
@@ -695,8 +1548,24 @@ class Trainer:
         if self.stage is not None:
             self.epoch_tracker = EpochTracker(self.readers[self.stage.until_dataset])
 
+        self._update_weights()
         return self.stage
 
+    def _update_weights(self):
+        """Let the scheduler know how fast each dataset is read now."""
+        if self.scheduler is not None:
+            self.scheduler.weights = {dataset.name: weight for dataset, weight in self.stage.datasets} if self.stage else {}
+
+    def prepare(self, stage:Stage) -> None:
+        """Start shuffling the datasets read by `stage` all at the same time,
+        instead of each one when it is first read. Only has an effect for
+        readers that shuffle asynchronously."""
+        for dataset, weight in stage.datasets:
+            if weight > 0:
+                self.readers[dataset.name].prepare()
+        if self.scheduler is not None:
+            self.scheduler.update()
+
     def log_stage_information(self):
         if not self.stage:
             return
@@ -721,45 +1590,145 @@ class Trainer:
                 name = type(modifier).__name__
                 logger.log(f" - {name} ({modifier.probability})")
 
-    def run(self, *, batch_size:int=100, chunk_size:int=16, processes:int=0) -> Iterable[List[str]]:
-        """Yield batches, moving through the stages of training as datasets are consumed."""
+    def _read_batches(self, batch_size:int) -> Iterator[Tuple[Stage, List[bytes]]]:
+        """Yield batches of lines read from the datasets according to their
+        weight in the current stage, moving through the stages of training as
+        datasets are consumed."""
         while self.stage is not None:
             self.log_stage_information()
+            self.prepare(self.stage)
 
-            # Stage level modifiers take precedence over global modifiers,
-            # but you can combine them yourself using YAML references.
-            if self.stage.modifiers is not None:
-                modifiers = self.stage.modifiers
-            else:
-                modifiers = self.curriculum.modifiers
+            # The datasets of the next stage are prepared during the last epoch
+            # of this one.
+            upcoming = self.curriculum.next_stage(self.stage)
 
-            with make_modifier_pool(modifiers, processes) as pool:
-                while self.stage.until_epoch is None or self.epoch_tracker.epoch < self.stage.until_epoch:
-                    batch: List[str] = []
+            while self.stage.until_epoch is None or self.epoch_tracker.epoch < self.stage.until_epoch:
+                if upcoming is not None and self.stage.until_epoch is not None \
+                    and self.epoch_tracker.epoch >= self.stage.until_epoch - 1:
+                    self.prepare(upcoming)
+                    upcoming = None
 
-                    # Read from each dataset according to its weight in this stage
-                    # (They will reshuffle and repeat if necessary)
-                    for dataset, weight in self.stage.datasets:
-                        batch.extend(
-                            line.rstrip('\r\n') for line in
-                            islice(self.readers[dataset.name], 0, int(batch_size * weight))
-                        )
+                batch: List[bytes] = []
 
-                    # Apply any modifiers to random lines in the batch, or sentence
-                    # (Multiple modifiers can be applied to the same line)
-                    batch = pool.map(batch, chunk_size)
+                # Read from each dataset according to its weight in this stage
+                # (They will reshuffle and repeat if necessary)
+                for dataset, weight in self.stage.datasets:
+                    batch.extend(
+                        line.rstrip(b'\r\n') for line in
+                        self.readers[dataset.name].read_batch_bytes(int(batch_size * weight))
+                    )
 
-                    if self.shuffle:
-                        random.shuffle(batch)
+                # Start shuffles that were waiting for room
+                if self.scheduler is not None:
+                    self.scheduler.update()
 
-                    # Tell anyone whose listening that something interesting happened
-                    # TODO: Yield something useful, e.g. progress.
-                    yield [line + '\n' for line in batch]
+                yield self.stage, batch
 
             # Move onto next stage. May be `None`, which would end this generator
             self.next_stage()
         logger.log("Finished the last stage")
 
+        # Training won't continue from here, so don't leave shuffled epochs behind
+        for reader in self.readers.values():
+            reader.close(discard=True)
+
+    def _prefetch(self, batches:Iterator[Tuple[Stage, List[bytes]]], depth:int) -> Generator[Tuple[Stage, List[bytes], TrainerState], None, None]:
+        """Read up to `depth` batches ahead in a thread. Each batch comes with
+        the state of the trainer right after it was read, since the trainer
+        itself is ahead by then. Its random state is meaningless: reading does
+        not use the global random generator, only whoever consumes the batches
+        does."""
+        queue: 'Queue[Any]' = Queue(depth)
+        stopped = Event()
+
+        def produce():
+            try:
+                for stage, batch in batches:
+                    queue.put((stage, batch, self._current_state()))
+                    if stopped.is_set():
+                        return
+                queue.put(None)
+            except BaseException as exc:
+                queue.put(exc)
+
+        thread = Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Make room for the producer to notice it should stop
+            stopped.set()
+            while thread.is_alive():
+                try:
+                    queue.get(timeout=0.1)
+                except Empty:
+                    pass
+            thread.join()
+
+    def run(self, *, batch_size:int=100, chunk_size:int=16, processes:int=0, binary:bool=False, prefetch:int=0) -> Iterable[Union[List[str], List[bytes]]]:
+        """Yield batches, moving through the stages of training as datasets are consumed.
+        With `binary` the lines are UTF-8 encoded bytes, which saves decoding
+        them, and of the lines modifiers changed only those are encoded again.
+        With `prefetch`
+        the datasets are read that many batches ahead in a thread, while the
+        modifiers are applied to the earlier ones. The modifier pool works on
+        multiple batches at a time as well. The batches are the same either
+        way, and `state()` is that of the last batch yielded."""
+        # Both reading ahead and the modifier pool working ahead put the
+        # trainer ahead of the batches yielded, so each batch comes with the
+        # state of the trainer right after it was read.
+        self._snapshot = self.state()
+
+        batches: Generator[Tuple[Stage, List[bytes], TrainerState], None, None]
+        if prefetch > 0:
+            batches = self._prefetch(self._read_batches(batch_size), prefetch)
+        else:
+            batches = ((stage, batch, self._current_state()) for stage, batch in self._read_batches(batch_size))
+
+        with closing(batches):
+            for stage, items in groupby(batches, key=itemgetter(0)):
+                # Stage level modifiers take precedence over global modifiers,
+                # but you can combine them yourself using YAML references.
+                if stage.modifiers is not None:
+                    modifiers = stage.modifiers
+                else:
+                    modifiers = self.curriculum.modifiers
+
+                # States of the batches handed to the pool, in order
+                states: Deque[TrainerState] = deque()
+
+                with make_modifier_pool(modifiers, processes) as pool:
+                    # Apply any modifiers to random lines in the batch, or sentence
+                    # (Multiple modifiers can be applied to the same line), and
+                    # shuffle the result.
+                    for batch in pool.imap(self._pool_input(items, states, decode=not binary), chunk_size, shuffle=self.shuffle):
+                        self._snapshot = replace(states.popleft(), random_state=random.getstate())
+
+                        # Tell anyone whose listening that something interesting happened
+                        # TODO: Yield something useful, e.g. progress.
+                        if binary:
+                            yield [line + b'\n' for line in batch]
+                        else:
+                            yield [line + '\n' for line in batch]
+
+        # Done reading ahead, so the trainer's own state is accurate again
+        self._snapshot = None
+
+    def _pool_input(self, items:Iterable[Tuple[Stage, List[bytes], TrainerState]], states:Deque[TrainerState], *, decode:bool) -> Iterator[List[Any]]:
+        """Batches of `items` for the modifier pool, decoded if `decode` is set.
+        Otherwise the pool only decodes the lines for the modifiers, and gives
+        back the ones they left alone as is. Their states are kept in `states`
+        for when they come out of the pool."""
+        for _, batch, state in items:
+            states.append(state)
+            yield [line.decode('utf-8') for line in batch] if decode else batch
+
 class StateTracker:
     """Wraps around the trainer.run() call to restore and dump state its."""
     path: str
@@ -817,6 +1786,88 @@ class StateTracker:
                 self._dump(trainer)
 
 
+class BatchWriter(Thread):
+    """Writes batches of lines to a file descriptor, e.g. the stdin of the
+    trainer program, in a thread of its own. Writing blocks while the trainer
+    is busy, and meanwhile the next batches can be prepared. At most
+    `queue_size` batches wait to be written. The lines of a batch are written
+    with `os.writev()`, without copying them into a single buffer first.
+    """
+    fileno: int
+    exception: Optional[BaseException]
+
+    _queue: 'Queue[Optional[List[bytes]]]'
+
+    def __init__(self, fileno:int, *, queue_size:int=4, pipe_size:Optional[int]=PIPE_SIZE):
+        """
+        Parameters
+        ----------
+        fileno : int
+            File descriptor to write to. It is not closed by the writer.
+        queue_size : int
+            Number of batches that can wait to be written before `write()` blocks.
+        pipe_size : int, optional
+            Size in bytes to enlarge the pipe behind `fileno` to, so the reading
+            end has more to read ahead. Only on Linux, and only up to
+            /proc/sys/fs/pipe-max-size for unprivileged processes. Ignored if
+            not possible.
+        """
+        super().__init__(daemon=True)
+        self.fileno = fileno
+        self.exception = None
+        self._queue = Queue(queue_size)
+
+        if pipe_size is not None and F_SETPIPE_SZ is not None:
+            try:
+                fcntl.fcntl(fileno, F_SETPIPE_SZ, pipe_size)
+            except OSError as exc:
+                logger.log(f"Could not resize pipe to {pipe_size} bytes: {exc}", loglevel="DEBUG")
+
+    def write(self, batch:List[bytes]) -> None:
+        """Queue a batch of lines to be written, waiting for room if needed.
+        Raises the error writing an earlier batch ran into, if any, e.g.
+        BrokenPipeError."""
+        if self.exception is not None:
+            raise self.exception
+        self._queue.put(batch)
+
+    def close(self) -> None:
+        """Wait for the queued batches to be written and stop the thread."""
+        self._queue.put(None)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def run(self) -> None:
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+
+            # Keep emptying the queue after an error, so write() doesn't block
+            if self.exception is not None:
+                continue
+
+            try:
+                for start in range(0, len(batch), IOV_MAX):
+                    self._writev(batch[start:start + IOV_MAX])
+            except BaseException as exc:
+                self.exception = exc
+
+    def _writev(self, buffers:Sequence[bytes]) -> None:
+        while True:
+            written = os.writev(self.fileno, buffers)
+            if written == sum(map(len, buffers)):
+                break
+
+            # Writes can be cut short, e.g. by a signal. Continue with what's left.
+            for n, buffer in enumerate(buffers):
+                if written < len(buffer):
+                    buffers = [memoryview(buffer)[written:], *buffers[n+1:]]
+                    break
+                written -= len(buffer)
+
+
 def print_state(state:TrainerState) -> None:
     logger.log(f"At stage {state.stage}")
     for name, reader in state.datasets.items():
@@ -828,16 +1879,35 @@ def parse_args(args:List[str]) -> argparse.Namespace:
     parser.add_argument("--config", '-c', required=True, type=str, help='YML configuration input.')
     parser.add_argument("--state", '-s', type=str, help='YML state file, defaults to ${CONFIG}.state.')
     parser.add_argument("--sync", action="store_true", help="Do not shuffle async")
+    parser.add_argument("--index", action="store_true", help="Shuffle an index of line offsets and read lines directly from the (uncompressed) dataset files instead of writing a shuffled copy every epoch")
     parser.add_argument("--temporary-directory", '-T', default=None, type=str, help='Temporary dir, used for shuffling and tracking state')
+    parser.add_argument("--cache", action="store_true", help='Keep a decompressed and validated copy of each dataset in the temporary dir and reuse it across epochs and restarts')
+    parser.add_argument("--persist-epochs", action="store_true", help='Write shuffled epochs to the temporary dir so a restarted trainer can continue reading them instead of shuffling again. They are deleted once read, once a restarted trainer is past them, or when training finishes')
+    parser.add_argument("--stream", action="store_true", help='Read shuffled epochs through a pipe while they are being shuffled instead of from a temporary copy')
+    parser.add_argument("--read-threads", type=int, default=1, help='Number of files (e.g. shards) of each dataset to read and decompress concurrently while shuffling. Default is 1')
+    parser.add_argument("--memory-threshold", type=parse_size, default=None, help='Keep datasets whose decompressed lines take up at most this much memory (suffixes K, M, G allowed) in memory and shuffle them there, without a subprocess or temporary files. Disabled by default')
+    parser.add_argument("--shuffle-in-process", action="store_true", help='Shuffle datasets in threads of the trainer instead of in a new opustrainer.shuffle process every epoch')
+    parser.add_argument("--max-shuffles", type=int, default=None, help='Maximum number of datasets shuffled in the background at the same time, the ones that will run out first going first. No limit by default. Not for --sync or --index')
+    parser.add_argument("--max-shuffle-disk", type=parse_size, default=None, help='Maximum size of the shuffled files (suffixes K, M, G allowed) written in the background that are not read yet, and of the temporary files of the shuffles still running, estimated from the decompressed dataset size. No limit by default. Not for --sync or --index')
+    parser.add_argument("--prefetch", type=int, default=0, help='Number of batches to read ahead in a thread while modifiers are applied to the earlier ones and batches are written to the trainer. Disabled by default')
     parser.add_argument("--do-not-resume", '-d', action="store_true", help='Do not resume from the previous training state')
     parser.add_argument("--no-shuffle", '-n', action="store_false", help='Do not shuffle, for debugging', dest="shuffle")
+    parser.add_argument("--shuffle-algorithm", choices=['merge', 'scatter'], default='merge', help='Algorithm used to shuffle datasets. scatter avoids the single-threaded merge, but each of its buckets has to fit in memory. Default is merge')
+    parser.add_argument("--shuffle-compression", choices=['auto', *CODECS], default='none', help='Compression of the temporary chunk files written while shuffling with the merge algorithm. Worth it if the temporary dir is slow, e.g. on a network volume. auto picks zstd or lz4 if installed, zlib otherwise. Default is none')
+    parser.add_argument("--shuffle-numpy", action="store_true", help='Draw the random keys and sort with NumPy while shuffling with the merge algorithm, which is much faster. The order for the same seed differs from the one without')
+    parser.add_argument("--shuffle-memory-limit", type=parse_size, default=None, help='Maximum memory (suffixes K, M, G allowed) the chunks of each shuffle with the merge algorithm take up together, while sorting them and while merging them. By default chunks are 1M lines each')
+    parser.add_argument("--shuffle-threads", type=int, default=0, help='Number of threads per shuffle with the merge algorithm that sort chunks while the next one is read. Default is 0, sorting in between reading')
+    parser.add_argument("--shuffle-processes", action="store_true", help='Sort the chunks in --shuffle-threads worker processes instead of threads, so they are not held back by the GIL')
     parser.add_argument("--batch-size", '-b', type=int, default=100, help='Batch size')
     parser.add_argument("--chunk-size", '-B', type=int, default=16, help='Chunk size of batches fed to modifiers')
     parser.add_argument("--workers", '-j', type=int, default=os.cpu_count() or 1, help='Number of workers')
     parser.add_argument("--log-level", type=str, default="INFO", help="Set log level. Available levels: DEBUG, INFO, WARNING, ERROR, CRITICAL. Default is INFO")
     parser.add_argument("--log-file", '-l', type=str, default=None, help="Target location for logging. Always logs to stderr and optionally to a file.")
     parser.add_argument("trainer", type=str, nargs=argparse.REMAINDER, help="Trainer program that gets fed the input. If empty it is read from config.")
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.shuffle_numpy and numpy is None:
+        parser.error('--shuffle-numpy requires NumPy to be installed')
+    return parsed
 
 
 def main() -> None:
@@ -856,10 +1926,31 @@ def main() -> None:
         if missing_files:
             raise ValueError(f"Dataset '{dataset.name}' is missing files: {missing_files}")
 
+    if args.index:
+        reader: Type[DatasetReader] = IndexedDatasetReader
+    elif args.sync:
+        reader = DatasetReader
+    else:
+        reader = AsyncDatasetReader
+
     trainer = Trainer(curriculum,
-        reader=DatasetReader if args.sync else AsyncDatasetReader,
+        reader=reader,
         tmpdir=args.temporary_directory,
-        shuffle=args.shuffle)
+        shuffle=args.shuffle,
+        cache=args.cache,
+        shuffle_algorithm=args.shuffle_algorithm,
+        persist=args.persist_epochs,
+        stream=args.stream,
+        read_threads=args.read_threads,
+        memory_threshold=args.memory_threshold,
+        in_process=args.shuffle_in_process,
+        max_shuffles=args.max_shuffles,
+        max_shuffle_disk=args.max_shuffle_disk,
+        shuffle_compression=args.shuffle_compression,
+        shuffle_numpy=args.shuffle_numpy,
+        shuffle_memory_limit=args.shuffle_memory_limit,
+        shuffle_threads=args.shuffle_threads,
+        shuffle_processes=args.shuffle_processes)
 
     state_tracker = StateTracker(args.state or f'{args.config}.state', restore=not args.do_not_resume)
 
@@ -869,11 +1960,14 @@ def main() -> None:
     model_trainer = subprocess.Popen(
         args.trainer or shlex.split(config['trainer']),
         stdin=subprocess.PIPE,
-        encoding="utf-8",
         preexec_fn=ignore_sigint) # ignore_sigint makes marian ignore Ctrl-C. We'll stop it from here.
 
     assert model_trainer.stdin is not None
 
+    # Writes to the trainer while the next batches are being prepared
+    writer = BatchWriter(model_trainer.stdin.fileno())
+    writer.start()
+
     # TODO: This logic looks complicated, should be able to do this simpler. Three scenarios:
     #   1. ctrl-c is pressed and trainer is told this is the end of the training data
     #   2. ctrl-c is pressed and trainer has much training data in its buffers, ctrl-c needs to be
@@ -884,8 +1978,8 @@ def main() -> None:
     #      the trainer is already dead at this point.
     try:
         try:
-            for batch in state_tracker.run(trainer, batch_size=args.batch_size, chunk_size=args.chunk_size, processes=args.workers):
-                model_trainer.stdin.writelines(batch)
+            for batch in state_tracker.run(trainer, batch_size=args.batch_size, chunk_size=args.chunk_size, processes=args.workers, binary=True, prefetch=args.prefetch):
+                writer.write(batch)
         except KeyboardInterrupt:
             logger.log("Ctrl-c pressed, stopping training")
 
@@ -894,6 +1988,7 @@ def main() -> None:
         for stage in ['exit', 'terminate', 'kill']:
             try:
                 if stage == 'exit':
+                    writer.close()
                     model_trainer.stdin.close()
                 elif stage == 'terminate':
                     model_trainer.terminate()
@@ -905,7 +2000,7 @@ def main() -> None:
             except KeyboardInterrupt:
                 continue
     except BrokenPipeError:
-        # BrokenPipeError is thrown by writelines() or close() and indicates that the child trainer
+        # BrokenPipeError is thrown by the writer or close() and indicates that the child trainer
         # process is no more. We can safely retrieve its return code and exit with that, it should
         # not block at this point.
         logger.log("trainer stopped reading input")
@@ -101,6 +101,8 @@ class TestEndToEnd(unittest.TestCase):
             with open('contrib/test-data/test_enzh_config_plain_expected.log', 'r', encoding='utf-8') as reflog:
                 # Loglist has one extra `\n` compared to reference list, due to stderr flushing an extra empty line?
                 loglist = process.stderr.splitlines(keepends=True)
+                # Whether a read had to wait for its shuffle depends on timing
+                loglist = [line for line in loglist if '] Waited ' not in line]
                 reference = reflog.readlines()
                 # Strip the time field and test
                 remove_timestamp = lambda line: line.split('[Trainer]', maxsplit=1)[1]
@@ -0,0 +1,97 @@
+import random
+import unittest
+from typing import Iterable, List
+
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.merge import MergeModifier
+from opustrainer.modifiers.surface import UpperCaseModifier
+from opustrainer.modifiers.pool import ModifierPool, ErzatsModifierPool
+
+
+class FailingModifier(Modifier):
+	def __call__(self, batch:List[str]) -> Iterable[str]:
+		for line in batch:
+			if line == 'fail\tfail':
+				raise ValueError('fail')
+			yield line
+
+
+class TestModifierPool(unittest.TestCase):
+	def setUp(self):
+		self.batches = [
+			[f'line {n} {m}\tregel {n} {m}' for m in range(size)]
+			for n, size in enumerate([100, 37, 0, 100, 1, 64, 100, 100])
+		]
+
+	def reference(self, modifiers:List[Modifier], chunksize:int, shuffle:bool):
+		"""Batches as returned by map() one at a time, and the random state
+		after all of them."""
+		random.seed(1)
+		with ModifierPool(modifiers, 2) as pool:
+			batches = []
+			for batch in self.batches:
+				batch = pool.map(batch, chunksize)
+				if shuffle:
+					random.shuffle(batch)
+				batches.append(batch)
+		return batches, random.getstate()
+
+	def test_imap(self):
+		"""Test that imap() gives the same batches, and leaves the same random
+		state behind, as map(). Also when the modifiers change the number of
+		lines, and the batches submitted ahead have to be submitted again."""
+		modifier_sets = {
+			'none': [],
+			'upper': [UpperCaseModifier(0.5)],
+			'merge': [MergeModifier(0.05)],
+		}
+		for name, modifiers in modifier_sets.items():
+			for chunksize in [0, 16]:
+				for shuffle in [False, True]:
+					expected = self.reference(modifiers, chunksize, shuffle)
+					for max_pending in [1, 3, 100]:
+						with self.subTest(modifiers=name, chunksize=chunksize, shuffle=shuffle, max_pending=max_pending):
+							random.seed(1)
+							with ModifierPool(modifiers, 2, max_pending=max_pending) as pool:
+								batches = list(pool.imap(self.batches, chunksize, shuffle=shuffle))
+							self.assertEqual((batches, random.getstate()), expected)
+
+	def test_imap_erzats(self):
+		"""Test that the in-process pool gives the same batches."""
+		expected = self.reference([MergeModifier(0.05)], 16, True)
+		random.seed(1)
+		with ErzatsModifierPool([MergeModifier(0.05)]) as pool:
+			batches = list(pool.imap(self.batches, 16, shuffle=True))
+		self.assertEqual((batches, random.getstate()), expected)
+
+	def test_imap_bytes(self):
+		"""Test that batches of UTF-8 encoded lines give the same lines, encoded,
+		and that lines the modifiers did not change are passed on as they were."""
+		expected, state = self.reference([UpperCaseModifier(0.5)], 16, True)
+		encoded = [[line.encode('utf-8') for line in batch] for batch in self.batches]
+		for pool_class in [ModifierPool, ErzatsModifierPool]:
+			with self.subTest(pool=pool_class.__name__):
+				random.seed(1)
+				with pool_class([UpperCaseModifier(0.5)], 2) as pool:
+					batches = list(pool.imap(encoded, 16, shuffle=True))
+				self.assertEqual(random.getstate(), state)
+				self.assertEqual(batches, [[line.encode('utf-8') for line in batch] for batch in expected])
+
+		originals = {id(line) for batch in encoded for line in batch}
+		random.seed(1)
+		with ErzatsModifierPool([UpperCaseModifier(0.5)]) as pool:
+			batches = list(pool.imap(encoded, 16, shuffle=True))
+		for batch in batches:
+			for line in batch:
+				self.assertEqual(id(line) in originals, not line.isupper())
+
+	def test_imap_error(self):
+		"""Test that an error in one of the chunks is raised when its batch is
+		its turn, and that the pool can still be shut down."""
+		self.batches[3][50] = 'fail\tfail'
+		with ModifierPool([FailingModifier(1.0)], 2) as pool:
+			batches = pool.imap(self.batches, 16)
+			for batch in self.batches[:3]:
+				self.assertEqual(next(batches), batch)
+			with self.assertRaisesRegex(ValueError, 'fail'):
+				next(batches)
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+import bz2
+import gzip
+import io
+import lzma
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+import zlib
+from itertools import islice
+from threading import Event
+from shutil import which
+from unittest.mock import patch
+
+from opustrainer.shuffle import LineIndex, IndexedCorpus, IndexedReader, Reader, read_files, shuffled_order, SparseLineIndex, index_lines, shuffle, scatter_shuffle, buffer_shuffle, shard_shuffle, sample_lines, sample_fraction, shuffle_files, ShuffleThread, parse_sample, parse_size, write_chunk_file, iter_shuffled_file, is_bgzf, CODECS, numpy
+
+
+class TestShuffle(unittest.TestCase):
+	lines = [f'line{n}\n'.encode() for n in range(1000)]
+
+	def test_permutation(self):
+		"""Shuffling yields every line exactly once, in a different order."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			output = list(shuffle(self.lines, 100, seed=1, tmpdir=tmpdir))
+		self.assertEqual(sorted(output), sorted(self.lines))
+		self.assertNotEqual(output, self.lines)
+
+	def test_reproducible(self):
+		"""The same seed gives the same order, regardless of the number of
+		threads sorting the chunks."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			reference = list(shuffle(self.lines, 100, seed=1, threads=0, tmpdir=tmpdir))
+			for threads in [1, 4]:
+				with self.subTest(threads=threads):
+					self.assertEqual(list(shuffle(self.lines, 100, seed=1, threads=threads, tmpdir=tmpdir)), reference)
+			with self.subTest(processes=True):
+				self.assertEqual(list(shuffle(self.lines, 100, seed=1, threads=2, tmpdir=tmpdir, processes=True)), reference)
+			self.assertNotEqual(list(shuffle(self.lines, 100, seed=2, tmpdir=tmpdir)), reference)
+			# All temporary chunks are cleaned up
+			self.assertEqual(os.listdir(tmpdir), [])
+
+
+	def test_memory_limit(self):
+		"""With a memory limit chunks are sized by bytes, which should still
+		give a reproducible permutation."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for threads in [0, 2]:
+				with self.subTest(threads=threads):
+					output = list(shuffle(self.lines, 100, seed=1, threads=threads, tmpdir=tmpdir, memory_limit=10_000))
+					self.assertEqual(sorted(output), sorted(self.lines))
+					self.assertEqual(output, list(shuffle(self.lines, 100, seed=1, threads=threads, tmpdir=tmpdir, memory_limit=10_000)))
+			self.assertEqual(os.listdir(tmpdir), [])
+
+	def test_memory_limit_merge(self):
+		"""With many chunks, merging them stays within the memory limit as well,
+		and gives the same order as merging them all at once."""
+		limit = 3 * 2**20
+		lines = lambda: (f'line{n}\n'.encode() for n in range(100_000))
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for threads in [0, 2]:
+				with self.subTest(threads=threads):
+					# Only keep a checksum of the output, so it doesn't count
+					tracemalloc.start()
+					try:
+						checksum = 0
+						for line in shuffle(lines(), 100, seed=1, threads=threads, tmpdir=tmpdir, memory_limit=limit):
+							checksum = zlib.crc32(line, checksum)
+						_, peak = tracemalloc.get_traced_memory()
+					finally:
+						tracemalloc.stop()
+					self.assertLess(peak, limit)
+					with patch('opustrainer.shuffle.reduce_chunk_files'):
+						output = list(shuffle(lines(), 100, seed=1, threads=threads, tmpdir=tmpdir, memory_limit=limit))
+					self.assertEqual(sorted(output), sorted(lines()))
+					self.assertEqual(checksum, zlib.crc32(b''.join(output)))
+			self.assertEqual(os.listdir(tmpdir), [])
+
+	@unittest.skipIf(numpy is None, 'NumPy is not installed')
+	def test_numpy(self):
+		"""Keys drawn and sorted by NumPy give a different permutation, but
+		just as reproducible."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			reference = list(shuffle(self.lines, 100, seed=1, threads=0, tmpdir=tmpdir, use_numpy=True))
+			self.assertEqual(sorted(reference), sorted(self.lines))
+			self.assertNotEqual(reference, list(shuffle(self.lines, 100, seed=1, threads=0, tmpdir=tmpdir)))
+			for threads in [1, 4]:
+				with self.subTest(threads=threads):
+					self.assertEqual(list(shuffle(self.lines, 100, seed=1, threads=threads, tmpdir=tmpdir, use_numpy=True)), reference)
+			with self.subTest(processes=True):
+				self.assertEqual(list(shuffle(self.lines, 100, seed=1, threads=2, tmpdir=tmpdir, processes=True, use_numpy=True)), reference)
+			self.assertEqual(os.listdir(tmpdir), [])
+
+	def test_compression(self):
+		"""Compressing the temporary chunks does not change the output."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			reference = list(shuffle(self.lines, 100, seed=1, tmpdir=tmpdir))
+			for codec in CODECS:
+				with self.subTest(codec=codec):
+					self.assertEqual(list(shuffle(self.lines, 100, seed=1, threads=2, tmpdir=tmpdir, compression=codec)), reference)
+
+	def test_chunk_file(self):
+		"""Chunk files are read back in the order they were written, spread
+		over multiple blocks."""
+		lines = [b'x' * 1000 + f'{n}\n'.encode() for n in range(1000)]
+		keys = [n / 1000 for n in range(1000)]
+		order = list(reversed(range(1000)))
+		for codec in CODECS.values():
+			with self.subTest(codec=codec.name), tempfile.NamedTemporaryFile() as fh:
+				write_chunk_file(fh, keys, lines, order, codec)
+				fh.flush()
+				records = list(iter_shuffled_file(fh.name, codec))
+				self.assertEqual([line for _, line in records], [lines[n] for n in order])
+				self.assertTrue(all(abs(key - keys[n]) < 1e-6 for (key, _), n in zip(records, order)))
+
+	def test_parse_size(self):
+		self.assertEqual(parse_size('1024'), 1024)
+		self.assertEqual(parse_size('4k'), 4096)
+		self.assertEqual(parse_size('1.5G'), 3 * 2**29)
+		self.assertEqual(parse_size('2MB'), 2 * 2**20)
+
+
+class TestShuffleThread(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmpdir.name, 'lines.txt')
+		with open(self.path, 'wb') as fh:
+			fh.writelines(f'line{n}\n'.encode() for n in range(1000))
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_same_as_subprocess(self):
+		"""Shuffling in a thread writes the same lines and offsets as the
+		opustrainer.shuffle command does for the same options."""
+		for algorithm in ['merge', 'scatter', 'buffer']:
+			with self.subTest(algorithm=algorithm), tempfile.TemporaryFile() as fh, tempfile.TemporaryFile() as offsets:
+				output = subprocess.check_output([sys.executable, '-m', 'opustrainer.shuffle', '--algorithm', algorithm, '--batch-size', '100', '--buffer-size', '100', '-T', self.tmpdir.name, '1', '-', self.path])
+				thread = ShuffleThread(shuffle_files([self.path], 1, algorithm=algorithm, batch_size=100, buffer_size=100, tmpdir=self.tmpdir.name), fh.fileno(), offsets.fileno(), interval=10)
+				thread.start()
+				self.assertEqual(thread.wait(), 0)
+				fh.seek(0)
+				self.assertEqual(fh.read(), output)
+				offsets.seek(0)
+				offset, skip = SparseLineIndex.load(offsets).locate(55)
+				fh.seek(offset)
+				self.assertEqual(fh.readlines()[skip], output.splitlines(keepends=True)[55])
+
+	def test_pipe(self):
+		"""Without a file descriptor the lines are read through `stdout`."""
+		thread = ShuffleThread(shuffle_files([self.path], 1, algorithm='buffer', buffer_size=100))
+		thread.start()
+		assert thread.stdout is not None
+		self.assertEqual(len(thread.stdout.readlines()), 1000)
+		self.assertEqual(thread.wait(), 0)
+
+	def test_kill(self):
+		"""A thread blocked on a pipe that is not read stops when killed, and
+		cleans up its temporary files."""
+		with open(self.path, 'ab') as fh:
+			fh.writelines(f'line{n}\n'.encode() for n in range(1000, 100_000))
+		thread = ShuffleThread(shuffle_files([self.path], 1, batch_size=1000, tmpdir=self.tmpdir.name))
+		thread.start()
+		assert thread.stdout is not None
+		thread.stdout.readline()
+		thread.kill()
+		self.assertNotEqual(thread.wait(), 0)
+		self.assertIsNone(thread.exception)
+		self.assertEqual(os.listdir(self.tmpdir.name), ['lines.txt'])
+
+	def test_kill_early(self):
+		"""A thread killed before the shuffle yields its first line stops
+		reading and sorting right away if it shares the shuffle's stop event,
+		and cleans up the chunk files it did write."""
+		with open(self.path, 'ab') as fh:
+			fh.writelines(f'line{n}\n'.encode() for n in range(1000, 1_000_000))
+		for threads in [0, 2]:
+			with self.subTest(threads=threads):
+				stop = Event()
+				thread = ShuffleThread(shuffle_files([self.path], 1, batch_size=100_000, threads=threads, tmpdir=self.tmpdir.name, stop=stop), stop=stop)
+				thread.start()
+				time.sleep(0.2)
+				start = time.monotonic()
+				thread.kill()
+				self.assertNotEqual(thread.wait(), 0)
+				self.assertLess(time.monotonic() - start, 1.0)
+				self.assertIsNone(thread.exception)
+				self.assertEqual(os.listdir(self.tmpdir.name), ['lines.txt'])
+
+	def test_error(self):
+		"""Errors while shuffling are kept, not raised in the thread."""
+		thread = ShuffleThread(shuffle_files([self.path, '/nonexistent'], 1))
+		thread.start()
+		assert thread.stdout is not None
+		thread.stdout.read()
+		self.assertEqual(thread.wait(), 1)
+		self.assertIsInstance(thread.exception, FileNotFoundError)
+
+
+class TestScatterShuffle(unittest.TestCase):
+	lines = [f'line{n}\n'.encode() for n in range(1000)]
+
+	def test_permutation(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			output = list(scatter_shuffle(self.lines, 8, seed=1, tmpdir=tmpdir))
+			self.assertEqual(os.listdir(tmpdir), [])
+		self.assertEqual(sorted(output), sorted(self.lines))
+		self.assertNotEqual(output, self.lines)
+
+	def test_reproducible(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			reference = list(scatter_shuffle(self.lines, 8, seed=1, threads=0, tmpdir=tmpdir))
+			for threads in [1, 4]:
+				with self.subTest(threads=threads):
+					self.assertEqual(list(scatter_shuffle(self.lines, 8, seed=1, threads=threads, tmpdir=tmpdir)), reference)
+			self.assertNotEqual(list(scatter_shuffle(self.lines, 8, seed=2, tmpdir=tmpdir)), reference)
+
+
+class TestBufferShuffle(unittest.TestCase):
+	lines = [f'line{n}\n'.encode() for n in range(1000)]
+
+	def test_permutation(self):
+		output = list(buffer_shuffle(self.lines, 100, seed=1))
+		self.assertEqual(sorted(output), sorted(self.lines))
+		self.assertNotEqual(output, self.lines)
+		self.assertEqual(output, list(buffer_shuffle(self.lines, 100, seed=1)))
+		self.assertNotEqual(output, list(buffer_shuffle(self.lines, 100, seed=2)))
+
+	def test_bounded(self):
+		"""Lines can't be yielded before they have been read into the buffer."""
+		output = list(buffer_shuffle(self.lines, 10, seed=1))
+		self.assertTrue(all(self.lines.index(line) < n + 10 for n, line in enumerate(output)))
+
+	def test_small_input(self):
+		"""Inputs that fit in the buffer are shuffled entirely."""
+		output = list(buffer_shuffle(self.lines[:50], 100, seed=1))
+		self.assertEqual(sorted(output), sorted(self.lines[:50]))
+
+
+class TestShardShuffle(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.shards = []
+		for shard in range(10):
+			path = os.path.join(self.tmpdir.name, f'shard{shard}.gz')
+			with gzip.open(path, 'wb') as fh:
+				fh.writelines(f'{shard}:{n}\n'.encode() for n in range(100))
+			self.shards.append(path)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_windows(self):
+		"""Every line is yielded once, and lines of the same window together."""
+		output = list(shard_shuffle(self.shards, 3, seed=1))
+		self.assertEqual(len(output), 1000)
+		self.assertEqual(len(set(output)), 1000)
+		windows = [{line.split(b':')[0] for line in output[n:n+300]} for n in range(0, 900, 300)]
+		self.assertTrue(all(len(window) == 3 for window in windows))
+		self.assertEqual(len(set.union(*windows)), 9)
+
+	def test_reproducible(self):
+		reference = list(shard_shuffle(self.shards, 3, seed=1))
+		self.assertEqual(list(shard_shuffle(self.shards, 3, seed=1, threads=4)), reference)
+		self.assertNotEqual(list(shard_shuffle(self.shards, 3, seed=2)), reference)
+
+
+class TestSample(unittest.TestCase):
+	lines = [f'line{n}\n'.encode() for n in range(1000)]
+
+	def test_sample_lines(self):
+		"""Exactly that many lines are selected, in order, differently per seed."""
+		sample = list(sample_lines(self.lines, len(self.lines), 100, seed=1))
+		self.assertEqual(len(sample), 100)
+		self.assertEqual(sample, sorted(sample, key=self.lines.index))
+		self.assertEqual(sample, list(sample_lines(self.lines, len(self.lines), 100, seed=1)))
+		self.assertNotEqual(sample, list(sample_lines(self.lines, len(self.lines), 100, seed=2)))
+		self.assertEqual(list(sample_lines(self.lines, len(self.lines), 1000, seed=1)), self.lines)
+
+	def test_sample_count(self):
+		"""The lines are only counted for the first sample, after which the
+		count is remembered in the temporary directory."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'lines')
+			with open(path, 'wb') as fh:
+				fh.writelines(self.lines)
+			self.assertEqual(len(list(shuffle_files([path], 1, sample=100, tmpdir=tmpdir))), 100)
+			counts = [name for name in os.listdir(tmpdir) if name.startswith('opustrainer-lines-')]
+			self.assertEqual(len(counts), 1)
+			# Pretend there are only 100 lines, which means all of those are sampled
+			with open(os.path.join(tmpdir, counts[0]), 'w') as fh:
+				fh.write('100')
+			self.assertEqual(sorted(shuffle_files([path], 1, sample=100, tmpdir=tmpdir)), sorted(self.lines[:100]))
+
+	def test_sample_fraction(self):
+		sample = list(sample_fraction(self.lines, 0.1, seed=1))
+		self.assertTrue(50 < len(sample) < 150)
+		self.assertEqual(sample, list(sample_fraction(self.lines, 0.1, seed=1)))
+
+	def test_parse_sample(self):
+		self.assertEqual(parse_sample('1000'), 1000)
+		self.assertEqual(parse_sample('0.5'), 0.5)
+		self.assertEqual(parse_sample('1e-3'), 0.001)
+		with self.assertRaises(ValueError):
+			parse_sample('1.5')
+
+
+class TestIndexedCorpus(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.files = []
+		for name, content in [('a', b'a0\na1\na2\n'), ('empty', b''), ('b', b'b0\nb1')]:
+			path = os.path.join(self.tmpdir.name, name)
+			with open(path, 'wb') as fh:
+				fh.write(content)
+			self.files.append(path)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_line_index(self):
+		"""Offsets point to the start of each line, and the last line does not
+		need to end with a newline."""
+		index = LineIndex.build(b'a\nbc\nd')
+		self.assertEqual(list(index.offsets), [0, 2, 5, 6])
+		self.assertEqual(len(index), 3)
+		self.assertEqual(len(LineIndex.build(b'a\nbc\n')), 2)
+
+	def test_sparse_line_index(self):
+		"""Seeking to the located offset and skipping lines arrives at the line."""
+		lines = [f'{"x" * (n % 13)}{n}\n'.encode() for n in range(100)]
+		index = SparseLineIndex(8)
+		data = b''.join(index_lines(lines, index))
+		self.assertEqual(len(index.offsets), 13)
+		fh = io.BytesIO()
+		index.dump(fh)
+		fh.seek(0)
+		index = SparseLineIndex.load(fh)
+		self.assertEqual(index.interval, 8)
+		for line in [0, 7, 8, 50, 99]:
+			with self.subTest(line=line):
+				reader = io.BytesIO(data)
+				offset, skip = index.locate(line)
+				reader.seek(offset)
+				for _ in range(skip):
+					reader.readline()
+				self.assertEqual(reader.readline(), lines[line])
+
+	def test_random_access(self):
+		corpus = IndexedCorpus(self.files)
+		try:
+			self.assertEqual(len(corpus), 5)
+			self.assertEqual([corpus[n] for n in range(len(corpus))], [b'a0\n', b'a1\n', b'a2\n', b'b0\n', b'b1'])
+		finally:
+			corpus.close()
+
+	def test_read(self):
+		"""Reading the files into memory gives the same lines as mapping them."""
+		with gzip.open(self.files[0] + '.gz', 'wb') as fh:
+			fh.write(b'a0\na1\na2\n')
+		corpus = IndexedCorpus.read([self.files[0] + '.gz', *self.files[1:]])
+		self.assertEqual(len(corpus.maps), 1)
+		self.assertEqual([corpus[n] for n in range(len(corpus))], [b'a0\n', b'a1\n', b'a2\n', b'b0\n', b'b1\n'])
+
+	def test_permuted_read(self):
+		"""Reading through a permutation yields every line exactly once, and
+		the same seed yields the same order."""
+		corpus = IndexedCorpus(self.files)
+		try:
+			read = lambda order: io.TextIOWrapper(io.BufferedReader(IndexedReader(corpus, order)), encoding='utf-8').readlines()
+			lines = read(shuffled_order(len(corpus), 1))
+			self.assertEqual(sorted(lines), ['a0\n', 'a1\n', 'a2\n', 'b0\n', 'b1\n'])
+			self.assertEqual(lines, read(shuffled_order(len(corpus), 1)))
+		finally:
+			corpus.close()
+
+
+def bgzf_compress(data:bytes, member_size:int) -> bytes:
+	"""Compresses data as BGZF, i.e. gzip members of at most `member_size`
+	bytes of input each with their compressed size in a BC subfield."""
+	output = []
+	for pos in range(0, len(data), member_size):
+		chunk = data[pos:pos+member_size]
+		compressor = zlib.compressobj(wbits=-15)
+		deflated = compressor.compress(chunk) + compressor.flush()
+		header = b'\x1f\x8b\x08\x04' + bytes(6) + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, 18 + len(deflated) + 8 - 1)
+		output.append(header + deflated + struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+	return b''.join(output)
+
+
+class TestReader(unittest.TestCase):
+	data = b''.join(f'line{n}\n'.encode() for n in range(10000))
+
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def write(self, name:str, data:bytes) -> str:
+		path = os.path.join(self.tmpdir.name, name)
+		with open(path, 'wb') as fh:
+			fh.write(data)
+		return path
+
+	def test_codecs(self):
+		files = {
+			'plain.txt': self.data,
+			'single.gz': gzip.compress(self.data),
+			'multi.gz': gzip.compress(self.data[:1000]) + gzip.compress(self.data[1000:]),
+			'bgzf.gz': bgzf_compress(self.data, 1000),
+			'text.xz': lzma.compress(self.data),
+			'text.bz2': bz2.compress(self.data),
+		}
+		if which('zstd'):
+			files['text.zst'] = subprocess.run(['zstd', '-cq'], input=self.data, stdout=subprocess.PIPE, check=True).stdout
+		expected = self.data.splitlines(keepends=True)
+		for name, data in files.items():
+			path = self.write(name, data)
+			for threads in [1, 4]:
+				with self.subTest(name=name, threads=threads):
+					self.assertEqual(list(Reader(path, threads=threads)), expected)
+
+	def test_python_fallback(self):
+		"""Without decompressors installed Python's own modules are used."""
+		path = self.write('text.xz', lzma.compress(self.data))
+		with patch.dict('opustrainer.shuffle.DECOMPRESSORS', {'.xz': [['not-installed-xz', '-cd']]}):
+			self.assertEqual(list(Reader(path)), self.data.splitlines(keepends=True))
+
+	def test_bgzf(self):
+		"""BGZF files are recognised, and lines spanning members are joined."""
+		path = self.write('bgzf.gz', bgzf_compress(self.data + b'last', 333))
+		self.assertTrue(is_bgzf(path))
+		self.assertFalse(is_bgzf(self.write('plain.gz', gzip.compress(self.data))))
+		self.assertEqual(list(Reader(path, threads=3)), (self.data + b'last').splitlines(keepends=True))
+
+	def test_bgzf_corrupt(self):
+		data = bytearray(bgzf_compress(self.data, 1000))
+		data[-5] ^= 0xff # Mess up the size in the trailer of the last member
+		path = self.write('corrupt.gz', bytes(data))
+		with self.assertRaises(ValueError):
+			list(Reader(path, threads=2))
+
+	def test_read_files(self):
+		"""Reading files concurrently yields their lines in the same order."""
+		paths = [
+			self.write(f'{n}.gz', gzip.compress(f'file{n}\n'.encode() * 5000))
+			for n in range(5)
+		]
+		expected = list(read_files(paths))
+		self.assertEqual(len(expected), 25000)
+		for threads in [2, 8]:
+			with self.subTest(threads=threads):
+				self.assertEqual(list(read_files(paths, threads=threads)), expected)
+		with self.subTest(stopped=True):
+			# Stopping half-way does not hang on the threads reading ahead
+			lines = read_files(paths, threads=3)
+			self.assertEqual(list(islice(lines, 100)), expected[:100])
+			lines.close()
+
+	def test_read_files_error(self):
+		paths = [self.write('a.txt', b'a\n'), os.path.join(self.tmpdir.name, 'missing.txt')]
+		with self.assertRaises(FileNotFoundError):
+			list(read_files(paths, threads=2))
@@ -1,34 +1,46 @@
 #!/usr/bin/env python3
 '''Tests the available functionality'''
+import fcntl
+import gzip
 import os
+import subprocess
+import sys
 import tempfile
+import time
 import unittest
 
-from typing import IO, Type
+from typing import IO, Dict, Type, cast
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from dataclasses import replace
 from textwrap import dedent
 from io import StringIO
 from itertools import chain
 
 import yaml
 
-from opustrainer.trainer import Curriculum, CurriculumLoaderError, Dataset, DatasetReader, AsyncDatasetReader, CurriculumLoader, Trainer, StateTracker, Stage
+from opustrainer.trainer import COMPRESSION_RATIO, Curriculum, CurriculumLoaderError, Dataset, DatasetState, DatasetReader, AsyncDatasetReader, IndexedDatasetReader, ShuffleScheduler, BatchWriter, CurriculumLoader, Trainer, StateTracker, StateLoader, TrainerState, EpochTrackerState, Stage
 from opustrainer.logger import log_once
+from opustrainer.shuffle import numpy
 
 TEST_FILE: str
+TEST_TMPDIR: tempfile.TemporaryDirectory
 
 def setUpModule():
-	global TEST_FILE
+	global TEST_FILE, TEST_TMPDIR
 	fd, TEST_FILE = tempfile.mkstemp(text=True)
 	
 	with open(fd, 'w') as fh:
 		for n in range(1000):
 			fh.write(f'line{n}\n')
 
+	TEST_TMPDIR = tempfile.TemporaryDirectory()
+
 
 def tearDownModule():
 	os.unlink(TEST_FILE)
+	TEST_TMPDIR.cleanup()
 
 
 class TestDatasetReader(unittest.TestCase):
@@ -50,6 +62,34 @@ class TestDatasetReader(unittest.TestCase):
 		self.assertEqual(set(counter[key] for key in counter.keys()), {3})
 		# ideally in a different order than previous read.
 
+	def test_carriage_returns(self):
+		"""Test that carriage returns end lines too, like they did when the
+		shuffled file was read as text."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'test.tsv')
+			with open(path, 'wb') as fh:
+				fh.write(b'a\tb\rc\td\n' b'e\tf\r\n' b'g\th\n')
+			with closing(self.reader(Dataset('test', [path], shuffle='none'), seed=1, num_fields=2)) as reader:
+				self.assertEqual(sorted(line for _, line in zip(range(4), reader)), ['a\tb\n', 'c\td\n', 'e\tf\n', 'g\th\n'])
+
+	def test_carriage_returns_resume(self):
+		"""Test that resuming in the middle of a line that was split at carriage
+		returns continues with its next part, not with its first."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'test.tsv')
+			with open(path, 'wb') as fh:
+				fh.write(b'a\tb\rc\td\re\tf\n' b'g\th\n')
+			dataset = Dataset('test', [path])
+			for read in range(1, 4):
+				with self.subTest(read=read):
+					with closing(self.reader(dataset, seed=1, num_fields=2)) as reader:
+						lines = [next(reader) for _ in range(read)]
+						state = reader.state()
+					with closing(self.reader(dataset, seed=1, num_fields=2)) as reader:
+						reader.restore(state)
+						lines += [next(reader) for _ in range(4 - read)]
+					self.assertEqual(sorted(lines), ['a\tb\n', 'c\td\n', 'e\tf\n', 'g\th\n'])
+
 	def test_shuffled_read(self):
 		"""That that when we read 2000 lines from a 1000 line testfile, we read
 		each line twice, but we do read them in a different order.
@@ -124,12 +164,550 @@ class TestDatasetReader(unittest.TestCase):
 		# They also should have the same order
 		self.assertEqual(lines1, lines2)
 
+	def test_read_batch(self):
+		"""Test that reading batches gives the same lines as reading one line at
+		a time, also across epochs."""
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234)) as reader:
+			lines = [line for _, line in zip(range(2500), reader)]
+			state = reader.state()
+
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234)) as reader:
+			batches = [reader.read_batch(size) for size in [0, 1, 999, 1000, 500]]
+			self.assertEqual([len(batch) for batch in batches], [0, 1, 999, 1000, 500])
+			self.assertEqual(list(chain.from_iterable(batches)), lines)
+			self.assertEqual(reader.state(), state)
+
+	def test_resume_position(self):
+		"""Test whether resuming by seeking to the position in the shuffled file
+		yields the same lines as skipping to it line by line, also when some of
+		the lines in the dataset are invalid.
+		"""
+		with tempfile.NamedTemporaryFile('w', dir=TEST_TMPDIR.name) as fh:
+			for n in range(3000):
+				fh.write(f'{n}\t{n}\n' if n % 97 else f'{n}\t\n')
+			fh.flush()
+			dataset = Dataset('test', [fh.name])
+
+			for skip in [1, 1500, 2900]:
+				with closing(self.reader(dataset, seed=1234)) as reader:
+					for _ in zip(range(skip), reader):
+						pass
+					state = reader.state()
+					expected = [line for _, line in zip(range(1000), reader)]
+				self.assertIsNotNone(state.position)
+
+				for resume in [state, replace(state, position=None)]:
+					with self.subTest(skip=skip, position=resume.position), closing(self.reader(dataset, seed=1234)) as reader:
+						reader.restore(resume)
+						# Nothing happens until the reader is read from
+						self.assertEqual(reader.state(), resume)
+						self.assertEqual([line for _, line in zip(range(1000), reader)], expected)
+
+
+class TestDatasetReaderValidation(unittest.TestCase):
+	def test_validate_block(self):
+		"""Test that validating lines in bulk gives the same result as
+		validating them one by one."""
+		lines = [
+			'a\tb\tc\n', 'a\tb\n', 'a\tb\tc\td\n', '\ta\tb\n', 'a\t\tb\n', 'a\tb\t\n',
+			'a\tb\t\r\n', 'a\tb\tc\r\n', '\n', '\r\n', 'a\t\rb\tc\n', 'a\tb\tc',
+		]
+		for num_fields in [None, 2, 3]:
+			reader = DatasetReader(Dataset('test', [TEST_FILE]), seed=1, num_fields=num_fields)
+			for line in lines:
+				block = ['a\tb\tc\n', line, 'x\ty\tz\n'] if line.endswith('\n') else ['a\tb\tc\n', line]
+				with self.subTest(num_fields=num_fields, line=line):
+					validated = [reader._validate(line) for line in block]
+					expected = [line.encode() for line in validated if line is not None]
+					positions = [10 + n for n, line in enumerate(validated) if line is not None]
+					valid, valid_positions = reader._validate_block([line.encode() for line in block], range(10, 10 + len(block)))
+					self.assertEqual((valid, list(valid_positions)), (expected, positions))
+				with self.subTest(num_fields=num_fields, line=line, first=True):
+					self.assertEqual(reader._validate_block([line.encode() for line in block[1:]], range(10, 10 + len(block) - 1))[0], [line.encode() for line in validated[1:] if line is not None])
+
+	def test_validate_block_encoding(self):
+		"""Test that lines that are not valid UTF-8 are not passed on."""
+		reader = DatasetReader(Dataset('test', [TEST_FILE]), seed=1)
+		with self.assertRaises(UnicodeDecodeError):
+			reader._validate_block([b'a\tb\n', b'\xff\tb\n'], range(2))
+
 
 class TestAsyncDatasetReader(TestDatasetReader):
 	"""Run all the same tests, but on the async reader that shuffles in advance."""
 	reader = AsyncDatasetReader
 
 
+class TestIndexedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but on the reader that only shuffles an index."""
+	reader = IndexedDatasetReader
+
+
+class TestScatterDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle with the scatter algorithm."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, algorithm='scatter', **kwargs)
+
+
+class TestCompressedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but compress the shuffle's temporary files."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, compression='zlib', **kwargs)
+
+	def test_shuffle_command(self):
+		"""Test that the compression is passed on to the shuffle command."""
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1)) as reader:
+			command = reader._shuffle_command(1, None)
+			self.assertEqual(command[command.index('--compress') + 1], 'zlib')
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestNumpyDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle with NumPy, with more than one
+	chunk, sorted by other threads."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, use_numpy=True, memory_limit=2**14, threads=2, **kwargs)
+
+	def test_shuffle_command(self):
+		"""Test that the options are passed on to the shuffle command."""
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1)) as reader:
+			command = reader._shuffle_command(1, None)
+			self.assertIn('--numpy', command)
+			self.assertEqual(command[command.index('--memory-limit') + 1], str(2**14))
+			self.assertEqual(command[command.index('--threads') + 1], '2')
+
+
+class TestCachedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but read from the decompressed dataset cache."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, cache=True, tmpdir=TEST_TMPDIR.name, **kwargs)
+
+	def test_cache_reuse(self):
+		"""Test that the cache is only written once, and that a new reader for
+		the same dataset reads from the existing cache."""
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234)) as reader:
+			lines1 = [line for _, line in zip(range(1000), reader)]
+			cache = reader._get_cache()
+			mtime = os.stat(cache.path).st_mtime_ns
+
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234)) as reader:
+			lines2 = [line for _, line in zip(range(1000), reader)]
+			self.assertEqual(reader._get_cache().path, cache.path)
+
+		self.assertEqual(os.stat(cache.path).st_mtime_ns, mtime)
+		self.assertEqual(lines1, lines2)
+
+
+class TestPersistedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but keep the shuffled epochs in named files."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, persist=True, tmpdir=TEST_TMPDIR.name, **kwargs)
+
+	def test_persist_reuse(self):
+		"""Test that a restored reader continues reading the shuffled file of
+		the reader it restores from, and that it is removed once read."""
+		dataset = Dataset('test', [TEST_FILE])
+
+		with closing(AsyncDatasetReader(dataset, seed=1234)) as reader:
+			expected = [line for _, line in zip(range(1000), reader)]
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with closing(AsyncDatasetReader(dataset, seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				lines = [line for _, line in zip(range(500), reader)]
+				state = reader.state()
+				path = reader._persisted.path
+
+			with closing(AsyncDatasetReader(dataset, seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				reader.restore(state)
+				lines.append(next(reader))
+				self.assertEqual(reader._fh.name, path)
+				lines.extend(line for _, line in zip(range(499), reader))
+				self.assertEqual(reader.epoch, 1)
+				self.assertFalse(os.path.exists(path))
+
+		self.assertEqual(lines, expected)
+
+	def test_persist_settings(self):
+		"""Test that an epoch is not reused by a reader that would shuffle it
+		differently, e.g. with another shard window."""
+		dataset = Dataset('test', [TEST_FILE, TEST_FILE], shard_window=1)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with closing(AsyncDatasetReader(dataset, seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				next(reader)
+				state = reader.state()
+				path = reader._persisted.path
+
+			with closing(AsyncDatasetReader(replace(dataset, shard_window=2), seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				reader.restore(state)
+				next(reader)
+				self.assertNotEqual(reader._fh.name, path)
+
+	def test_persist_cleanup(self):
+		"""Test that epochs shuffled in advance are kept for the next run, that
+		a reader restored past some of them removes those, and that closing
+		with `discard` removes the rest."""
+		dataset = Dataset('test', [TEST_FILE], lookahead=2)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			def seeds():
+				return sorted(int(name[:-len('.tsv')].rsplit('-', 1)[1]) for name in os.listdir(tmpdir) if name.endswith('.tsv'))
+
+			with closing(AsyncDatasetReader(dataset, seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				for _ in zip(range(500), reader):
+					pass
+				for shuffled in reader._pending:
+					shuffled.proc.wait()
+			self.assertEqual(seeds(), [1234, 1235, 1236])
+
+			with closing(AsyncDatasetReader(dataset, seed=1234, persist=True, tmpdir=tmpdir)) as reader:
+				reader.restore(DatasetState(seed=1235, line=0, epoch=1))
+				self.assertEqual(seeds(), [1235, 1236])
+				next(reader)
+				reader.close(discard=True)
+			self.assertEqual(os.listdir(tmpdir), [])
+
+
+class TestStreamedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but read the shuffler's output through a pipe."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, stream=True, **kwargs)
+
+	def test_shuffle_failure(self):
+		"""Test that a shuffler that fails half-way is not mistaken for the end
+		of the epoch."""
+		with closing(self.reader(Dataset('test', [TEST_FILE, '/nonexistent']), seed=1234)) as reader:
+			with self.assertRaises(subprocess.CalledProcessError):
+				for _ in zip(range(1000), reader):
+					pass
+
+
+class TestInProcessDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle in a thread instead of a subprocess."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, in_process=True, **kwargs)
+
+	def test_shuffle_failure(self):
+		"""Test that the error of a shuffle that failed is raised as is."""
+		with closing(self.reader(Dataset('test', [TEST_FILE, '/nonexistent']), seed=1234)) as reader:
+			with self.assertRaises(FileNotFoundError):
+				next(reader)
+
+	def test_close_early(self):
+		"""Test that closing the reader does not wait for the shuffle to finish
+		reading and sorting the dataset first."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'large.tsv')
+			with open(path, 'w') as fh:
+				fh.writelines(f'line{n}\tregel{n}\n' for n in range(1_000_000))
+			reader = self.reader(Dataset('large', [path]), seed=1234, tmpdir=tmpdir)
+			reader.prepare()
+			time.sleep(0.1)
+			start = time.monotonic()
+			reader.close()
+			self.assertLess(time.monotonic() - start, 1.0)
+			self.assertEqual(os.listdir(tmpdir), ['large.tsv'])
+
+
+class TestInProcessStreamedDatasetReader(TestStreamedDatasetReader):
+	"""Run all the same tests, but stream from a thread instead of a subprocess."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, in_process=True, stream=True, **kwargs)
+
+	def test_shuffle_failure(self):
+		"""Test that a shuffle that fails half-way raises its own error."""
+		with closing(self.reader(Dataset('test', [TEST_FILE, '/nonexistent']), seed=1234)) as reader:
+			with self.assertRaises(FileNotFoundError):
+				for _ in zip(range(1000), reader):
+					pass
+
+
+class TestScheduledDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but with a scheduler that only allows a single
+	shuffle in the background."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, scheduler=ShuffleScheduler(max_shuffles=1), **kwargs)
+
+
+class TestShuffleScheduler(unittest.TestCase):
+	def test_priority(self):
+		"""Test that with only room for one shuffle the dataset that will run
+		out first goes first, and the other once that one is being read."""
+		scheduler = ShuffleScheduler(max_disk=os.path.getsize(TEST_FILE))
+		scheduler.weights = {'slow': 0.2, 'fast': 0.8}
+		slow = AsyncDatasetReader(Dataset('slow', [TEST_FILE]), seed=1, scheduler=scheduler)
+		fast = AsyncDatasetReader(Dataset('fast', [TEST_FILE]), seed=1, scheduler=scheduler)
+		with closing(slow), closing(fast):
+			slow._open_async(1)
+			fast._open_async(1)
+			scheduler.update()
+			self.assertEqual(len(slow._pending), 0)
+			self.assertEqual(len(fast._pending), 1)
+
+			# Reading the shuffled file makes room for the next
+			next(fast)
+			self.assertEqual(len(slow._pending), 1)
+			self.assertEqual(len(fast._pending), 0)
+
+	def test_temporary_files(self):
+		"""Test that a running merge shuffle counts with its chunk files, which
+		are gone once it is done."""
+		scheduler = ShuffleScheduler(max_disk=3 * os.path.getsize(TEST_FILE))
+		scheduler.weights = {'slow': 0.2, 'fast': 0.8}
+		slow = AsyncDatasetReader(Dataset('slow', [TEST_FILE]), seed=1, scheduler=scheduler)
+		fast = AsyncDatasetReader(Dataset('fast', [TEST_FILE]), seed=1, scheduler=scheduler)
+		with closing(slow), closing(fast):
+			self.assertEqual(fast._shuffle_size(), (os.path.getsize(TEST_FILE), os.path.getsize(TEST_FILE)))
+			slow._open_async(1)
+			fast._open_async(1)
+			scheduler.update()
+			self.assertEqual(len(slow._pending), 0)
+			self.assertEqual(len(fast._pending), 1)
+
+			fast._pending[0].proc.wait()
+			scheduler.update()
+			self.assertEqual(len(slow._pending), 1)
+
+	def test_shuffle_size(self):
+		"""Test that the size of compressed datasets is estimated decompressed,
+		and that only algorithms with chunk files count with them."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'test.gz')
+			with open(TEST_FILE, 'rb') as fin, gzip.open(path, 'wb') as fout:
+				fout.write(fin.read())
+			size = COMPRESSION_RATIO * os.path.getsize(path)
+			for kwargs, dataset, expected in [
+				({}, Dataset('test', [path]), (size, size)),
+				({'stream': True}, Dataset('test', [path]), (0, size)),
+				({'cache': True, 'tmpdir': tmpdir}, Dataset('test', [path]), (os.path.getsize(TEST_FILE),) * 2),
+				({}, Dataset('test', [path], shard_window=1), (size, 0)),
+				({}, Dataset('test', [path], shuffle='buffer'), (0, 0)),
+			]:
+				with self.subTest(**kwargs, dataset=dataset), closing(AsyncDatasetReader(dataset, seed=1, **kwargs)) as reader:
+					self.assertEqual(reader._shuffle_size(), expected)
+
+	def test_priority_estimate(self):
+		"""Test that a dataset read slowly still goes first if it has few lines
+		left, unless the shuffle of its next epoch already started."""
+		scheduler = ShuffleScheduler()
+		scheduler.weights = {'slow': 0.2, 'fast': 0.8}
+		slow = AsyncDatasetReader(Dataset('slow', [TEST_FILE]), seed=1, scheduler=scheduler)
+		fast = AsyncDatasetReader(Dataset('fast', [TEST_FILE]), seed=1, scheduler=scheduler)
+		with closing(slow), closing(fast):
+			slow._epoch_lines = fast._epoch_lines = 1000
+			slow._lines_read = 800
+			fast._lines_read = 0
+			self.assertLess(scheduler._priority(slow), scheduler._priority(fast))
+			slow._open_async(2)
+			scheduler.update()
+			self.assertLess(scheduler._priority(fast), scheduler._priority(slow))
+
+	def test_needed_now(self):
+		"""Test that a reader that runs out does not wait for the scheduler."""
+		scheduler = ShuffleScheduler(max_shuffles=0)
+		with closing(AsyncDatasetReader(Dataset('test', [TEST_FILE]), seed=1, scheduler=scheduler)) as reader:
+			lines = [line for _, line in zip(range(3000), reader)]
+			self.assertEqual(len(set(lines)), 1000)
+			self.assertEqual(reader.epoch, 3)
+			self.assertEqual(len(reader._pending), 0)
+
+
+class TestBufferedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but approximately shuffle through a buffer."""
+	def reader(self, dataset, *args, **kwargs):
+		return AsyncDatasetReader(replace(dataset, shuffle='buffer', shuffle_buffer=100), *args, **kwargs)
+
+
+class TestLookaheadDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle three epochs in advance."""
+	def reader(self, dataset, *args, **kwargs):
+		return AsyncDatasetReader(replace(dataset, lookahead=3), *args, **kwargs)
+
+	def test_lookahead(self):
+		"""Test that the next three epochs are being shuffled, each with the
+		seed of its epoch, and that they are logged when they are waited for."""
+		with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234)) as reader:
+			with self.assertLogs(level='INFO') as logs:
+				next(reader)
+			self.assertEqual([shuffled.seed for shuffled in reader._pending], [1235, 1236, 1237])
+			self.assertRegex(logs.output[-1], r'^INFO:.*Waited [0-9.]+s for the shuffle of test for epoch 0')
+			lines = [line for _, line in zip(range(2999), reader)]
+			self.assertEqual([shuffled.seed for shuffled in reader._pending], [1237, 1238, 1239])
+			self.assertEqual(reader.epoch, 3)
+
+
+class TestShuffleWait(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmpdir.name, 'large.tsv')
+		with open(self.path, 'w') as fh:
+			fh.writelines(f'line{n}\tregel{n}\n' for n in range(200_000))
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_logged(self):
+		"""Test that every read that waits for a shuffle that is still running
+		logs how long it waited, whether it reads from a file or a pipe, and
+		whether the shuffle runs in a subprocess or a thread."""
+		for reader, kwargs in [
+			(DatasetReader, {}),
+			(AsyncDatasetReader, {}),
+			(AsyncDatasetReader, {'stream': True}),
+			(AsyncDatasetReader, {'in_process': True}),
+			(AsyncDatasetReader, {'in_process': True, 'stream': True}),
+		]:
+			with self.subTest(reader=reader.__name__, **kwargs), \
+				closing(reader(Dataset('large', [self.path]), seed=1234, tmpdir=self.tmpdir.name, **kwargs)) as dataset_reader:
+				with self.assertLogs(level='INFO') as logs:
+					next(dataset_reader)
+				self.assertRegex('\n'.join(logs.output), r'INFO:.*Waited [0-9.]+s for the shuffle of large for epoch 0')
+
+
+class TestShardedDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle (the only) shard in memory."""
+	def reader(self, dataset, *args, **kwargs):
+		return AsyncDatasetReader(replace(dataset, shard_window=1), *args, read_threads=2, **kwargs)
+
+
+class TestMemoryDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but shuffle the dataset in memory."""
+	def reader(self, dataset, *args, **kwargs):
+		return AsyncDatasetReader(replace(dataset, shuffle='memory'), *args, **kwargs)
+
+
+class TestResidentDatasetReader(TestDatasetReader):
+	"""Run all the same tests, but on a dataset small enough to keep in memory."""
+	def reader(self, *args, **kwargs):
+		return AsyncDatasetReader(*args, memory_threshold=2**20, **kwargs)
+
+	def test_threshold(self):
+		"""Test that only datasets under the threshold are kept in memory."""
+		size = os.path.getsize(TEST_FILE)
+		for threshold, policy in [(size, 'memory'), (size - 1, 'full'), (None, 'full')]:
+			with self.subTest(threshold=threshold), \
+				closing(AsyncDatasetReader(Dataset('test', [TEST_FILE]), seed=1234, memory_threshold=threshold)) as reader:
+				self.assertEqual(reader._policy, policy)
+				next(reader)
+				self.assertEqual(reader._pending[0].proc is None, policy == 'memory')
+
+	def test_threshold_compressed(self):
+		"""Test that compressed datasets are compared by their size once
+		decompressed, not by their size on disk."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'test.gz')
+			with open(TEST_FILE, 'rb') as fin, gzip.open(path, 'wb') as fout:
+				fout.write(fin.read())
+			size = COMPRESSION_RATIO * os.path.getsize(path)
+			for threshold, policy in [(size, 'memory'), (size - 1, 'full')]:
+				with self.subTest(threshold=threshold), \
+					closing(AsyncDatasetReader(Dataset('test', [path]), seed=1234, memory_threshold=threshold)) as reader:
+					self.assertEqual(reader._policy, policy)
+
+
+class TestUnshuffledDatasetReader(unittest.TestCase):
+	def test_passthrough(self):
+		"""Test that datasets that are already shuffled are read as is, every
+		epoch, also when compressed."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			path = os.path.join(tmpdir, 'test.gz')
+			with gzip.open(path, 'wt') as fh:
+				fh.writelines(f'line{n}\n' for n in range(100))
+			for reader in [DatasetReader, AsyncDatasetReader]:
+				with self.subTest(reader=reader.__name__), \
+					closing(reader(Dataset('test', [path], shuffle='none'), seed=1234)) as reader:
+					lines = [line for _, line in zip(range(150), reader)]
+					self.assertEqual(reader.epoch, 1)
+					self.assertEqual(lines, [f'line{n}\n' for n in chain(range(100), range(50))])
+					# Resuming works the same as for any other dataset
+					state = reader.state()
+				with closing(reader.__class__(Dataset('test', [path], shuffle='none'), seed=1234)) as resumed:
+					resumed.restore(state)
+					self.assertEqual(next(resumed), 'line50\n')
+
+
+class TestSampledDatasetReader(unittest.TestCase):
+	def test_sample(self):
+		"""Test that each epoch is a different random sample of the dataset."""
+		for reader in [DatasetReader, AsyncDatasetReader, IndexedDatasetReader]:
+			with self.subTest(reader=reader.__name__), \
+				closing(reader(Dataset('test', [TEST_FILE], sample=100), seed=1234, tmpdir=TEST_TMPDIR.name)) as reader:
+				epoch1 = [line for _, line in zip(range(100), reader)]
+				self.assertEqual(reader.epoch, 1)
+				epoch2 = [line for _, line in zip(range(100), reader)]
+				self.assertEqual(reader.epoch, 2)
+				self.assertEqual(len(set(epoch1)), 100)
+				self.assertNotEqual(set(epoch1), set(epoch2))
+				self.assertTrue(set(epoch1) < {f'line{n}\n' for n in range(1000)})
+
+	def test_sample_fraction(self):
+		for reader in [AsyncDatasetReader, IndexedDatasetReader]:
+			with self.subTest(reader=reader.__name__), \
+				closing(reader(Dataset('test', [TEST_FILE], sample=0.1), seed=1234)) as reader:
+				lines = 0
+				while reader.epoch == 0:
+					next(reader)
+					lines += 1
+				self.assertTrue(50 < lines < 150)
+
+
+class TestStateLoader(unittest.TestCase):
+	def test_position(self):
+		"""Dataset positions are stored, and state files without them can still
+		be read."""
+		loader = StateLoader()
+		for dataset_state in [DatasetState(1, 2, 3, 4, 5), DatasetState(1, 2, 3, 4), DatasetState(1, 2, 3)]:
+			with self.subTest(state=dataset_state):
+				state = TrainerState('start', None, EpochTrackerState(0, 0), {'clean': dataset_state})
+				fh = StringIO()
+				loader.dump(state, fh)
+				fh.seek(0)
+				self.assertEqual(loader.load(fh), state)
+
+
+class TestBatchWriter(unittest.TestCase):
+	def test_write(self):
+		"""Test that batches, also ones larger than IOV_MAX lines, arrive whole
+		and in order."""
+		batches = [[f'{n}\t{m}\n'.encode() for m in range(size)] for n, size in enumerate([1, 0, 100, 3000])]
+		read_fd, write_fd = os.pipe()
+		with open(read_fd, 'rb') as fin, ThreadPoolExecutor(1) as pool:
+			writer = BatchWriter(write_fd, queue_size=1)
+			writer.start()
+			# The pipe is too small for all batches, so read while writing
+			reader = pool.submit(fin.read)
+			for batch in batches:
+				writer.write(batch)
+			writer.close()
+			os.close(write_fd)
+			self.assertEqual(reader.result(), b''.join(chain.from_iterable(batches)))
+
+	@unittest.skipUnless(sys.platform.startswith('linux'), 'pipes can only be resized on Linux')
+	def test_pipe_size(self):
+		read_fd, write_fd = os.pipe()
+		try:
+			BatchWriter(write_fd, pipe_size=2**18)
+			self.assertEqual(fcntl.fcntl(write_fd, getattr(fcntl, 'F_GETPIPE_SZ', 1032)), 2**18)
+		finally:
+			os.close(read_fd)
+			os.close(write_fd)
+
+	def test_broken_pipe(self):
+		"""Test that writing to a trainer that stopped reading raises
+		BrokenPipeError, and that writing doesn't block after that."""
+		read_fd, write_fd = os.pipe()
+		os.close(read_fd)
+		writer = BatchWriter(write_fd, queue_size=1)
+		writer.start()
+		try:
+			with self.assertRaises(BrokenPipeError):
+				for _ in range(10):
+					writer.write([b'line\n'])
+					time.sleep(0.01)
+				writer.close()
+		finally:
+			os.close(write_fd)
+
+
 class TestTrainer(unittest.TestCase):
 	def test_resume(self):
 		"""End-to-end test for resuming training where we test that a resumed
@@ -181,6 +759,69 @@ class TestTrainer(unittest.TestCase):
 			
 		self.assertEqual(batches, batches_ref)
 
+	def test_prefetch(self):
+		"""Test that reading ahead gives the same batches, also with modifiers
+		and across stages, and that the state saved while reading ahead is
+		that of the last batch that was yielded."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.4',
+				'until medium 1',
+			],
+			'modifiers': [
+				{'UpperCase': 0.25}
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum)) as trainer_ref:
+			batches_ref = list(trainer_ref.run())
+
+		for prefetch in [1, 4]:
+			with self.subTest(prefetch=prefetch), tempfile.TemporaryDirectory() as tmpdir:
+				with closing(Trainer(curriculum)) as trainer:
+					self.assertEqual(list(trainer.run(prefetch=prefetch)), batches_ref)
+					self.assertEqual(trainer.state().stage, '')
+
+				state_tracker = StateTracker(os.path.join(tmpdir, 'state_file'))
+
+				with closing(Trainer(curriculum)) as trainer1:
+					batches = [batch for _, batch in zip(range(10), state_tracker.run(trainer1, prefetch=prefetch))]
+
+				with closing(Trainer(curriculum)) as trainer2:
+					batches.extend(state_tracker.run(trainer2, prefetch=prefetch))
+
+				self.assertEqual(batches, batches_ref)
+
+	def test_prefetch_error(self):
+		"""Test that errors reading ahead end up with whoever reads the batches."""
+		curriculum = CurriculumLoader().load({
+			'datasets': {'clean': 'contrib/test-data/clean'},
+			'stages': ['start'],
+			'start': ['clean 1.0', 'until clean 1'],
+			'seed': 1111
+		})
+		with closing(Trainer(curriculum)) as trainer:
+			trainer.readers['clean'].read_batch_bytes = lambda size: 1/0
+			with self.assertRaises(ZeroDivisionError):
+				list(trainer.run(prefetch=2))
+
 	def test_deterministic_parallel(self):
 		"""End-to-end test to confirm that training with 2 workers or with 4 workers
 		should yield the same training data going to the trainer.
@@ -225,6 +866,155 @@ class TestTrainer(unittest.TestCase):
 
 		self.assertEqual(batches_linear, batches_parallel)
 
+	def test_binary(self):
+		"""Test that batches of bytes are the same as the text batches, both for
+		stages with and without modifiers."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': {
+				'mix': [
+					'clean 0.6',
+					'medium 0.4',
+					'until medium 1'
+				],
+				'modifiers': [
+					{'UpperCase': 0.25}
+				],
+			},
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum)) as trainer:
+			batches = list(trainer.run())
+
+		with closing(Trainer(curriculum)) as trainer:
+			batches_binary = list(trainer.run(binary=True))
+
+		self.assertEqual(batches_binary, [[line.encode('utf-8') for line in batch] for batch in batches])
+
+	def test_persist_finished(self):
+		"""Test that no shuffled epochs are left behind once the last stage is
+		finished."""
+		config = {
+			'datasets': {
+				'clean': {'path': 'contrib/test-data/clean', 'lookahead': 2},
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with closing(Trainer(curriculum, reader=AsyncDatasetReader, persist=True, tmpdir=tmpdir)) as trainer:
+				batches = iter(trainer.run())
+				next(batches)
+				self.assertTrue(any(name.startswith('opustrainer-epoch-') for name in os.listdir(tmpdir)))
+				for _ in batches:
+					pass
+				self.assertEqual(os.listdir(tmpdir), [])
+
+	def test_prepare(self):
+		"""End-to-end test that datasets are not read before they are needed,
+		that all datasets of a stage start shuffling together, and that the
+		datasets of the next stage start shuffling during its last epoch."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+				'dirty': 'contrib/test-data/dirty'
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'dirty 0',
+				'until clean 2'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.3',
+				'dirty 0.1',
+				'until medium 1',
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum, reader=AsyncDatasetReader)) as trainer:
+			readers = cast(Dict[str, AsyncDatasetReader], trainer.readers)
+			self.assertTrue(all(reader._fh is None and not reader._pending for reader in readers.values()))
+
+			trainer.prepare(curriculum.stages['start'])
+			self.assertEqual([len(readers[name]._pending) for name in ['clean', 'medium', 'dirty']], [1, 1, 0])
+
+			batches = iter(trainer.run())
+			while trainer.epoch_tracker.epoch < 1:
+				self.assertEqual(len(readers['dirty']._pending), 0)
+				next(batches)
+			next(batches)
+			self.assertEqual(len(readers['dirty']._pending), 1)
+			self.assertEqual(readers['dirty'].line, 0)
+
+	def test_scheduled(self):
+		"""End-to-end test that limiting the shuffles running in the background
+		does not change the training data."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+				'dirty': 'contrib/test-data/dirty'
+			},
+			'stages': [
+				'start',
+			],
+			'start': [
+				'clean 0.6',
+				'medium 0.3',
+				'dirty 0.1',
+				'until medium 2',
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum, reader=AsyncDatasetReader)) as trainer:
+			batches_ref = list(trainer.run())
+
+		with closing(Trainer(curriculum, reader=AsyncDatasetReader, max_shuffles=1, max_shuffle_disk=1)) as trainer:
+			assert trainer.scheduler is not None
+			self.assertEqual(trainer.scheduler.weights, {'clean': 0.6, 'medium': 0.3, 'dirty': 0.1})
+			batches = list(trainer.run())
+
+		self.assertEqual(batches, batches_ref)
+
 
 class TestCurriculumLoader(unittest.TestCase):
 	def test_simple(self):
@@ -263,6 +1053,72 @@ class TestCurriculumLoader(unittest.TestCase):
 		self.assertEqual(curriculum.seed, 1111)
 		self.assertEqual(len(curriculum.modifiers), 1)
 
+	def test_dataset_options(self):
+		"""Test loading datasets with options next to their path"""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'dirty': {
+					'path': 'contrib/test-data/dirty',
+					'shuffle_buffer': 1000,
+				},
+			},
+			'stages': [
+				'start'
+			],
+			'start': [
+				'clean 0.5',
+				'dirty 0.5',
+				'until clean 5'
+			],
+			'seed': 1111,
+		}
+		curriculum = CurriculumLoader().load(config)
+		self.assertEqual(curriculum.datasets, {
+			'clean': Dataset(name='clean', files=['./contrib/test-data/clean']),
+			'dirty': Dataset(name='dirty', files=['./contrib/test-data/dirty'], shuffle='buffer', shuffle_buffer=1000),
+		})
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for name in ['b.gz', 'a.gz', 'c.txt']:
+				open(os.path.join(tmpdir, name), 'w').close()
+			config['datasets']['sharded'] = {'path': ['*.gz', 'c.txt'], 'shard_window': 2}
+			config['datasets']['globbed'] = '*.txt'
+			curriculum = CurriculumLoader().load(config, basepath=tmpdir)
+			self.assertEqual(curriculum.datasets['sharded'], Dataset('sharded', [os.path.join(tmpdir, name) for name in ['a.gz', 'b.gz', 'c.txt']], shard_window=2))
+			self.assertEqual(curriculum.datasets['globbed'], Dataset('globbed', [os.path.join(tmpdir, 'c.txt')]))
+
+			config['datasets']['globbed'] = '*.tsv'
+			with self.assertRaisesRegex(CurriculumLoaderError, "no files matching"):
+				CurriculumLoader().load(config, basepath=tmpdir)
+			del config['datasets']['globbed'], config['datasets']['sharded']
+
+		for shuffle, expected in [('memory', 'memory'), ('none', 'none'), (False, 'none')]:
+			with self.subTest(shuffle=shuffle):
+				config['datasets']['clean'] = {'path': 'contrib/test-data/clean', 'shuffle': shuffle}
+				self.assertEqual(CurriculumLoader().load(config).datasets['clean'].shuffle, expected)
+
+		config['datasets']['clean'] = {'path': 'contrib/test-data/clean', 'lookahead': 2}
+		self.assertEqual(CurriculumLoader().load(config).datasets['clean'].lookahead, 2)
+
+		for options, error in [
+			({'shuffle': 'partial'}, 'expected one of'),
+			({'shuffle': 'none', 'sample': 10}, 'cannot be sampled'),
+			({'shuffle': 'memory', 'shuffle_buffer': 10}, 'does not shuffle through a buffer'),
+			({'lookahead': 0}, 'lookahead of 0, expected at least 1'),
+			({'shuffle_buffer': 0}, 'shuffle_buffer of 0, expected at least 1'),
+			({'shard_window': 0}, 'shard_window of 0, expected at least 1'),
+		]:
+			with self.subTest(options=options):
+				config['datasets']['clean'] = {'path': 'contrib/test-data/clean', **options}
+				with self.assertRaisesRegex(CurriculumLoaderError, error):
+					CurriculumLoader().load(config)
+		config['datasets']['clean'] = 'contrib/test-data/clean'
+
+		config['datasets']['dirty']['shuffle_buffr'] = 10
+		with self.assertRaisesRegex(CurriculumLoaderError, 'unknown options: shuffle_buffr'):
+			CurriculumLoader().load(config)
+
 	def test_no_until(self):
 		"""Test that omitting the until clause raises an error"""
 		config = {
@@ -435,10 +1291,19 @@ class TestCurriculumLoader(unittest.TestCase):
 			}
 			curriculum = CurriculumLoader().load(config)
 
-			for reader in [DatasetReader, AsyncDatasetReader]:
-				with self.subTest(reader=reader.__name__), \
+			readers = [
+				(DatasetReader, False),
+				(AsyncDatasetReader, False),
+				(IndexedDatasetReader, False),
+				(AsyncDatasetReader, True),
+				(IndexedDatasetReader, True),
+			]
+
+			for reader, cache in readers:
+				with self.subTest(reader=reader.__name__, cache=cache), \
+				 tempfile.TemporaryDirectory() as tmpdir, \
 				 self.assertLogs(level='WARNING') as logger_ctx, \
-				 closing(Trainer(curriculum, reader=reader)) as trainer:
+				 closing(Trainer(curriculum, reader=reader, tmpdir=tmpdir, cache=cache)) as trainer:
 					# Reset the log_once cache
 					log_once.cache_clear()
 